@@ -0,0 +1,133 @@
+"""Amenities as a per-listing bitmask.
+
+``properties.amenity_mask`` has bit ``id - 1`` set for every amenity the
+listing has, so amenity ids 1 to MAX_AMENITY_ID fit a signed BIGINT. A
+filter on several amenities ("pool AND parking AND gym") is a single
+predicate on the properties table, ``mask & wanted = wanted``, instead of
+one join per amenity. Listing payloads decode the mask against the cached
+amenity names without touching property_amenities.
+
+property_amenities stays the source of truth. set_amenities() writes the
+rows and the mask together in the caller's transaction. The column and its
+backfill come from an Alembic revision; ``flask amenity-masks`` recomputes
+every mask, e.g. after bulk seeding.
+"""
+from collections import defaultdict
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, delete, insert, select, update
+from models import db, Amenity, Property, PropertyAmenity
+import click
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MAX_AMENITY_ID = 63
+AMENITY_CACHE_TTL = float(os.getenv("AMENITY_CACHE_TTL", 300))
+
+# (expires at, {amenity id: name})
+_names = None
+_lock = threading.Lock()
+
+
+def amenity_names():
+    """{amenity id: name}, cached per process for AMENITY_CACHE_TTL seconds"""
+    global _names
+    now = time.monotonic()
+    current = _names
+    if current and current[0] > now:
+        return current[1]
+    names = dict(db.session.execute(select(Amenity.id, Amenity.name).order_by(Amenity.id)).all())
+    with _lock:
+        _names = (now + AMENITY_CACHE_TTL, names)
+    return names
+
+
+def amenity_mask(amenity_ids):
+    """Bitmask of the given amenity ids; ids above MAX_AMENITY_ID are skipped"""
+    mask = 0
+    for amenity_id in amenity_ids:
+        if 1 <= amenity_id <= MAX_AMENITY_ID:
+            mask |= 1 << (amenity_id - 1)
+        else:
+            logger.warning("Amenity %s has no bit in amenity_mask and can't be filtered on", amenity_id)
+    return mask
+
+
+def mask_ids(mask):
+    """Amenity ids in a mask"""
+    return [amenity_id for amenity_id in range(1, MAX_AMENITY_ID + 1) if mask and mask >> (amenity_id - 1) & 1]
+
+
+def decode_mask(mask):
+    """Names of the amenities in a mask, by amenity id"""
+    names = amenity_names()
+    return [names[amenity_id] for amenity_id in mask_ids(mask) if amenity_id in names]
+
+
+def has_amenities(mask):
+    """SQL condition: the listing has every amenity in ``mask``"""
+    return Property.amenity_mask.op("&")(mask) == mask
+
+
+def parse_amenity_ids(value):
+    """Amenity ids from "1,3" or a JSON list. Returns None if the value is malformed or names unknown amenities."""
+    if value is None or not str(value).strip():
+        return []
+    try:
+        if str(value).strip().startswith("["):
+            ids = [int(amenity_id) for amenity_id in json.loads(value)]
+        else:
+            ids = [int(amenity_id) for amenity_id in str(value).split(",") if amenity_id.strip()]
+    except (TypeError, ValueError):
+        return None
+    known = amenity_names()
+    if any(amenity_id not in known or amenity_id > MAX_AMENITY_ID for amenity_id in ids):
+        return None
+    return sorted(set(ids))
+
+
+def set_amenities(property_id, amenity_ids):
+    """Replace a listing's amenities and its mask in the current transaction"""
+    db.session.execute(delete(PropertyAmenity).where(PropertyAmenity.property_id == property_id))
+    if amenity_ids:
+        db.session.execute(insert(PropertyAmenity), [
+            {"property_id": property_id, "amenity_id": amenity_id} for amenity_id in amenity_ids
+        ])
+    db.session.execute(
+        update(Property).where(Property.id == property_id).values(amenity_mask=amenity_mask(amenity_ids)),
+        execution_options={"synchronize_session": False},
+    )
+
+
+def refresh_amenity_masks(property_ids=None):
+    """Recompute masks from property_amenities (all listings by default). Returns how many were set."""
+    query = select(PropertyAmenity.property_id, PropertyAmenity.amenity_id)
+    reset = update(Property).values(amenity_mask=0)
+    if property_ids is not None:
+        query = query.where(PropertyAmenity.property_id.in_(property_ids))
+        reset = reset.where(Property.id.in_(property_ids))
+    amenities = defaultdict(list)
+    for property_id, amenity_id in db.session.execute(query):
+        amenities[property_id].append(amenity_id)
+
+    db.session.execute(reset, execution_options={"synchronize_session": False})
+    if amenities:
+        db.session.connection().execute(
+            update(Property.__table__)
+            .where(Property.__table__.c.id == bindparam("property_id"))
+            .values(amenity_mask=bindparam("mask")),
+            [{"property_id": property_id, "mask": amenity_mask(ids)} for property_id, ids in amenities.items()],
+        )
+    db.session.commit()
+    return len(amenities)
+
+
+@click.command("amenity-masks")
+@with_appcontext
+def amenity_masks_command():
+    """Recompute properties.amenity_mask for every listing."""
+    click.echo(f"Set amenity masks for {refresh_amenity_masks()} listings")
@@ -0,0 +1,188 @@
+"""Agent analytics from a daily fact table.
+
+``agent_daily_facts`` has one row per agent, listing and day. Each row
+counts page views, booked visits (pending or completed), inquiries and
+favorites by the day they were created. Completed payments are counted as
+revenue on rows with property_id 0, by the day they completed (their last
+update), so a payment that completes long after it was created still lands
+in the window the next run re-reads. ``flask aggregate-analytics`` (run it
+hourly from cron or the job runner) fills the table incrementally. Each run
+re-aggregates the days from ANALYTICS_LOOKBACK_DAYS before the newest fact
+onwards. A visit canceled within that window of its booking day drops out
+of the counts; one canceled later stays counted on its booking day until a
+``--full`` run. The first run, or ``--full``, aggregates everything,
+including the archive tables. Facts outlive the archival of their source
+rows.
+
+/agent/analytics only reads the agent's slice of the fact table through
+the primary key, so any date range costs two small grouped queries.
+"""
+from datetime import date, datetime, time, timedelta
+from flask.cli import with_appcontext
+from sqlalchemy import case, delete, func, insert, literal, select
+from models import db, Property, View, ViewArchive, Inquiry, InquiryArchive, Favorite, Payment, AgentDailyFact
+import click
+import os
+
+ANALYTICS_LOOKBACK_DAYS = int(os.getenv("ANALYTICS_LOOKBACK_DAYS", 3))
+INSERT_BATCH_SIZE = 5000
+
+FACT_COLUMNS = ("views", "visits", "inquiries", "favorites", "revenue")
+VISIT_STATUSES = ("pending", "completed")
+INTERVALS = ("day", "week", "month")
+
+
+def _as_date(value):
+    # SQLite returns date() as text
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _grouped(column, created_at, property_id, value, conditions, since, agent_id=None):
+    """One fact source grouped by day, agent and listing; the agent comes from the listing unless given"""
+    day = func.date(created_at)
+    join_listing = agent_id is None
+    if join_listing:
+        agent_id = Property.agent_id
+    query = select(literal(column), day, agent_id, property_id, value).where(*conditions)
+    if join_listing:
+        query = query.join(Property, Property.id == property_id)
+    if since is not None:
+        query = query.where(created_at >= since)
+    return query.group_by(day, agent_id, property_id)
+
+
+def payment_completed_at():
+    """When a payment completed: its last update, or its creation for payments inserted as complete"""
+    # updated_at is only bumped by updates; inserts get a stale Python-side default
+    return case((Payment.updated_at > Payment.created_at, Payment.updated_at), else_=Payment.created_at)
+
+
+def fact_sources(since=None, include_archived=False):
+    """Grouped (fact column, day, agent id, property id, value) queries for activity created since ``since``"""
+    sources = [
+        _grouped("views", View.created_at, View.property_id, func.count(), [View.status == "viewed"], since),
+        _grouped("visits", View.created_at, View.property_id, func.count(), [View.status.in_(VISIT_STATUSES)],
+                 since),
+        _grouped("inquiries", Inquiry.created_at, Inquiry.property_id, func.count(), [], since,
+                 agent_id=Inquiry.agent_id),
+        _grouped("favorites", Favorite.created_at, Favorite.property_id, func.count(), [], since),
+        _grouped("revenue", payment_completed_at(), literal(0), func.sum(Payment.amount),
+                 [Payment.status == "complete"], since, agent_id=Payment.agent_id),
+    ]
+    if include_archived:
+        sources += [
+            _grouped("views", ViewArchive.created_at, ViewArchive.property_id, func.count(),
+                     [ViewArchive.status == "viewed"], since),
+            _grouped("visits", ViewArchive.created_at, ViewArchive.property_id, func.count(),
+                     [ViewArchive.status.in_(VISIT_STATUSES)], since),
+            _grouped("inquiries", InquiryArchive.created_at, InquiryArchive.property_id, func.count(), [], since,
+                     agent_id=InquiryArchive.agent_id),
+        ]
+    return sources
+
+
+def aggregate_facts(full=False):
+    """Re-aggregate facts from the lookback window on (everything when ``full``). Returns (rows, first day)."""
+    start = None
+    if not full:
+        newest = _as_date(db.session.scalar(select(func.max(AgentDailyFact.day))))
+        start = newest - timedelta(days=ANALYTICS_LOOKBACK_DAYS) if newest else None
+    since = datetime.combine(start, time.min) if start else None
+
+    facts = {}
+    for query in fact_sources(since, include_archived=start is None):
+        for column, day, agent_id, property_id, value in db.session.execute(query):
+            if agent_id is None or day is None:
+                continue
+            fact = facts.setdefault((agent_id, _as_date(day), property_id), dict.fromkeys(FACT_COLUMNS, 0))
+            fact[column] += int(value or 0)
+
+    stale = delete(AgentDailyFact)
+    if start:
+        stale = stale.where(AgentDailyFact.day >= start)
+    db.session.execute(stale)
+    now = datetime.now()
+    rows = [
+        {"agent_id": agent_id, "day": day, "property_id": property_id, **values, "updated_at": now}
+        for (agent_id, day, property_id), values in facts.items()
+    ]
+    for offset in range(0, len(rows), INSERT_BATCH_SIZE):
+        db.session.execute(insert(AgentDailyFact), rows[offset:offset + INSERT_BATCH_SIZE])
+    db.session.commit()
+    return len(rows), start
+
+
+def _bucket(day, interval):
+    if interval == "week":
+        return day - timedelta(days=day.weekday())
+    if interval == "month":
+        return day.replace(day=1)
+    return day
+
+
+def _ratio(numerator, denominator):
+    return round(numerator / denominator, 4) if denominator else None
+
+
+def funnel(totals):
+    return {
+        "view_to_favorite": _ratio(totals["favorites"], totals["views"]),
+        "view_to_inquiry": _ratio(totals["inquiries"], totals["views"]),
+        "view_to_visit": _ratio(totals["visits"], totals["views"]),
+        "inquiry_to_visit": _ratio(totals["visits"], totals["inquiries"]),
+    }
+
+
+def agent_analytics(agent_id, start, end, interval="day", property_id=None, listings_limit=20):
+    """Time series, totals, funnel ratios and per-listing breakdown for an agent between two dates (inclusive)"""
+    sums = [func.sum(getattr(AgentDailyFact, column)).label(column) for column in FACT_COLUMNS]
+    conditions = [AgentDailyFact.agent_id == agent_id, AgentDailyFact.day >= start, AgentDailyFact.day <= end]
+    if property_id is not None:
+        conditions.append(AgentDailyFact.property_id == property_id)
+
+    # Every bucket in the range is present so charts don't need to fill gaps
+    series = {}
+    day = start
+    while day <= end:
+        series.setdefault(_bucket(day, interval), dict.fromkeys(FACT_COLUMNS, 0))
+        day += timedelta(days=1)
+    for row in db.session.execute(
+        select(AgentDailyFact.day, *sums).where(*conditions).group_by(AgentDailyFact.day)
+    ):
+        point = series[_bucket(_as_date(row.day), interval)]
+        for column in FACT_COLUMNS:
+            point[column] += int(getattr(row, column) or 0)
+
+    totals = dict.fromkeys(FACT_COLUMNS, 0)
+    for point in series.values():
+        for column in FACT_COLUMNS:
+            totals[column] += point[column]
+
+    listings = []
+    for row in db.session.execute(
+        select(AgentDailyFact.property_id, Property.title, *sums)
+        .outerjoin(Property, Property.id == AgentDailyFact.property_id)
+        .where(*conditions, AgentDailyFact.property_id != 0)
+        .group_by(AgentDailyFact.property_id, Property.title)
+        .order_by(func.sum(AgentDailyFact.views).desc(), AgentDailyFact.property_id)
+        .limit(listings_limit)
+    ):
+        counts = {column: int(getattr(row, column) or 0) for column in FACT_COLUMNS if column != "revenue"}
+        listings.append({"property_id": row.property_id, "title": row.title, **counts, "funnel": funnel(counts)})
+
+    return {
+        "series": [{"date": bucket.isoformat(), **values} for bucket, values in sorted(series.items())],
+        "totals": totals,
+        "funnel": funnel(totals),
+        "listings": listings,
+    }
+
+
+@click.command("aggregate-analytics")
+@click.option("--full", is_flag=True, help="re-aggregate all history instead of the recent days")
+@with_appcontext
+def aggregate_analytics_command(full):
+    """Fill agent_daily_facts from views, inquiries, favorites and payments."""
+    db.create_all()
+    rows, start = aggregate_facts(full)
+    click.echo(f"Wrote {rows} fact rows " + (f"from {start.isoformat()}" if start else "for all history"))
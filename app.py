@@ -1,12 +1,29 @@
 from flask import Flask, send_from_directory
 from flask_migrate import Migrate
 from models import db, User
+from database import configure_database, instrument_engine, init_routing
+from instrumentation import init_query_profiler
+from metrics import init_metrics
+from media import purge_media_command
+from archival import archive_command
+from recommendations import build_similar_command
+from feed import build_preferences_command
+from market_stats import market_stats_command
+from notifications import dispatch_notifications_command
+from analytics import aggregate_analytics_command
+# Also registers the job handlers run by the embedded worker
+from tasks import worker_command
+from saved_searches import match_saved_searches_command
+from amenities import amenity_masks_command
 from flask_restful import Api, Resource
 from flask_bcrypt import Bcrypt
 from resources.auth import Signup, Login, Logout
-from resources.admin import UsersResource, AdminStatsResource, PendingAgentAproval, RecentUsers, PropertyResource, AgentApproval
-from resources.user import UserProfileResource, UserStatsResource, SavedPropertiesResource, RecentActivitiesResource, UserPropertiesResource, UserPropertyDetailResource, ToggleFavoriteResource, RecordPropertyViewResource, CreateInquiryResource, UserInquiriesResource, UserConversationsResource, ConversationMessagesResource, StartConversationResource, ScheduleVisitResource, UserScheduledVisitsResource
-from resources.agent import AgentStatsResource, AgentPropertiesResource, AgentInquiriesResource, AgentPropertyDetailResource, AgentPropertyCreateResource, AgentPropertyUpdateResource, AgentPropertyDeleteResource
+from resources.admin import UsersResource, AdminStatsResource, PendingAgentAproval, RecentUsers, PropertyResource, AgentApproval, DatabasePoolResource
+from resources.user import UserProfileResource, UserStatsResource, SavedPropertiesResource, RecentActivitiesResource, UserPropertiesResource, AmenitiesResource, UserFeedResource, SavedSearchesResource, SavedSearchResource, SavedSearchMatchesResource, UserPropertyDetailResource, UserPropertyPageResource, ToggleFavoriteResource, RecordPropertyViewResource, CreateInquiryResource, UserInquiriesResource, UserConversationsResource, ConversationMessagesResource, StartConversationResource, ScheduleVisitResource, UserScheduledVisitsResource, PropertyAvailableSlotsResource, PropertySimilarResource
+from resources.market import MarketStatsResource
+from resources.catalog import PropertyFacetsResource
+from resources.notification import NotificationsResource, NotificationUnreadCountResource, NotificationReadResource, NotificationReadAllResource
+from resources.agent import AgentStatsResource, AgentAnalyticsResource, AgentPropertiesResource, AgentInquiriesResource, AgentPropertyDetailResource, AgentPropertyCreateResource, AgentPropertyUpdateResource, AgentPropertyDeleteResource, AgentAvailabilityResource, AgentPropertyImportResource, AgentPropertyExportResource
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
 import os
@@ -17,19 +34,14 @@ load_dotenv(override=True)
 # Initialized flask app
 app = Flask(__name__)
 
-# configure db URI
-database_url = os.getenv("DATABASE_URL")
-if not database_url:
-    # Fallback for local development
-    database_url = "sqlite:///agsproperties.db"
-    
-app.config["SQLALCHEMY_DATABASE_URI"] = database_url
-
-# Disable SQL echo to prevent logging loop
-app.config["SQLALCHEMY_ECHO"] = True
+# configure db URI, connection pool and SQL echo (off unless SQL_ECHO is set)
+configure_database(app)
 
 app.config["BUNDLE_ERRORS"] = True
 
+# bcrypt work factor for new hashes; existing hashes are upgraded on login
+app.config["BCRYPT_LOG_ROUNDS"] = int(os.getenv("BCRYPT_LOG_ROUNDS", 12))
+
 # Setup flask-JWT-extended extension
 # Use environment variable or fallback to a fixed default (for development only)
 jwt_secret = os.getenv("JWT_SECRET_KEY")
@@ -54,7 +66,7 @@ CORS(
     supports_credentials=True,
     methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
     allow_headers=["Content-Type", "Authorization", "X-Requested-With"],
-    expose_headers=["Content-Type", "Authorization"],
+    expose_headers=["Content-Type", "Authorization", "Server-Timing"],
     max_age=86400,
     automatic_options=True  # Let Flask-CORS handle OPTIONS automatically
 )
@@ -65,6 +77,49 @@ migrate = Migrate(app, db)
 # init our db
 db.init_app(app)
 
+# flask purge-media: retry removal of uploaded files left behind by deletes
+app.cli.add_command(purge_media_command)
+
+# flask archive: move sold/expired listings and old activity out of the hot tables
+app.cli.add_command(archive_command)
+
+# flask build-similar: precompute the similar listings served by /properties/<id>/similar
+app.cli.add_command(build_similar_command)
+
+# flask build-preferences: recompute the per-user vectors behind /user/feed
+app.cli.add_command(build_preferences_command)
+
+# flask market-stats: rebuild the rollup behind /market/stats
+app.cli.add_command(market_stats_command)
+
+# flask aggregate-analytics: roll recent activity into the facts behind /agent/analytics
+app.cli.add_command(aggregate_analytics_command)
+
+# flask dispatch-notifications: deliver anything left in the notification outbox
+app.cli.add_command(dispatch_notifications_command)
+
+# flask worker: run queued background jobs and the periodic maintenance jobs
+app.cli.add_command(worker_command)
+
+# flask match-saved-searches: match recent listings against saved searches (safety net for the worker)
+app.cli.add_command(match_saved_searches_command)
+
+# flask amenity-masks: recompute properties.amenity_mask behind amenity filtering
+app.cli.add_command(amenity_masks_command)
+
+with app.app_context():
+    for engine in db.engines.values():
+        instrument_engine(engine)
+
+# route GET traffic to read replicas when DATABASE_REPLICA_URLS is set
+init_routing(app, db)
+
+# count queries per request, flag N+1 patterns and add Server-Timing headers
+init_query_profiler(app)
+
+# per-route latency/status/query metrics, served on /metrics
+init_metrics(app)
+
 # initialize flask restful
 api = Api(app)
 
@@ -114,8 +169,10 @@ api.add_resource(AdminStatsResource, '/admin/stats')
 api.add_resource(PendingAgentAproval, '/admin/pending-approvals')
 api.add_resource(AgentApproval, '/admin/approve/<int:user_id>')
 api.add_resource(RecentUsers, '/admin/recent-users')
+api.add_resource(DatabasePoolResource, '/admin/db-pool')
 
 api.add_resource(PropertyResource, '/properties')
+api.add_resource(PropertyFacetsResource, '/properties/facets')
 
 # user routes
 api.add_resource(UserProfileResource, '/user/profile')
@@ -123,7 +180,13 @@ api.add_resource(UserStatsResource, '/user/stats')
 api.add_resource(SavedPropertiesResource, '/user/saved-properties')
 api.add_resource(RecentActivitiesResource, '/user/recent-activity')
 api.add_resource(UserPropertiesResource, '/user/properties')
+api.add_resource(AmenitiesResource, '/amenities')
+api.add_resource(UserFeedResource, '/user/feed')
+api.add_resource(SavedSearchesResource, '/user/saved-searches')
+api.add_resource(SavedSearchResource, '/user/saved-searches/<int:search_id>')
+api.add_resource(SavedSearchMatchesResource, '/user/saved-searches/<int:search_id>/matches')
 api.add_resource(UserPropertyDetailResource, '/user/properties/<int:property_id>')
+api.add_resource(UserPropertyPageResource, '/user/properties/<int:property_id>/page')
 api.add_resource(ToggleFavoriteResource, '/user/favorite')
 api.add_resource(RecordPropertyViewResource, '/user/record-view')
 
@@ -139,15 +202,30 @@ api.add_resource(ConversationMessagesResource, '/user/conversations/<int:convers
 # Visit scheduling routes
 api.add_resource(ScheduleVisitResource, '/user/schedule-visit')
 api.add_resource(UserScheduledVisitsResource, '/user/scheduled-visits')
+api.add_resource(PropertyAvailableSlotsResource, '/properties/<int:property_id>/available-slots')
+api.add_resource(PropertySimilarResource, '/properties/<int:property_id>/similar')
 
 # agents routes
 api.add_resource(AgentStatsResource, '/agent/stats')
+api.add_resource(AgentAnalyticsResource, '/agent/analytics')
 api.add_resource(AgentPropertiesResource, '/agent/properties')
 api.add_resource(AgentPropertyDetailResource, '/agent/properties/<int:property_id>')
 api.add_resource(AgentPropertyCreateResource, '/agent/properties/create')
+api.add_resource(AgentPropertyImportResource, '/agent/properties/import')
+api.add_resource(AgentPropertyExportResource, '/agent/properties/export')
 api.add_resource(AgentPropertyUpdateResource, '/agent/properties/<int:property_id>/edit')
 api.add_resource(AgentPropertyDeleteResource, '/agent/properties/<int:property_id>/delete')
 api.add_resource(AgentInquiriesResource, '/agent/inquiries')
+api.add_resource(AgentAvailabilityResource, '/agent/availability')
+
+# market routes
+api.add_resource(MarketStatsResource, '/market/stats')
+
+# notification routes
+api.add_resource(NotificationsResource, '/notifications')
+api.add_resource(NotificationUnreadCountResource, '/notifications/unread-count')
+api.add_resource(NotificationReadAllResource, '/notifications/read-all')
+api.add_resource(NotificationReadResource, '/notifications/<int:notification_id>/read')
 
 
 
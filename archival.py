@@ -0,0 +1,134 @@
+"""Archival of listings and activity nobody browses any more.
+
+The catalog and stats endpoints only read live rows:
+
+* Listings are soft-deleted by setting ``properties.archived_at``. A
+  listing counts as sold once it has a transaction that closed more than
+  ARCHIVE_SOLD_AFTER_DAYS ago. It counts as expired when it has not been
+  listed or edited for ARCHIVE_LISTINGS_AFTER_DAYS. The rows stay in place
+  because favorites, conversations and reviews still point at them. Editing
+  a listing brings it back.
+* Page view events (status "viewed") older than ARCHIVE_VIEWS_AFTER_DAYS
+  move to ``views_archive``, and closed inquiries older than
+  ARCHIVE_INQUIRIES_AFTER_DAYS move to ``inquiries_archive``. Rows keep
+  their ids and are moved in batches of ARCHIVE_BATCH_SIZE, with one
+  INSERT ... SELECT and one DELETE per batch, each batch in its own
+  transaction. Visits are never archived, so scheduling is unaffected.
+
+Run ``flask archive`` on a schedule (e.g. nightly from cron). Archived data
+is still reachable with ``include_archived=true`` on the agent endpoints.
+``properties.archived_at`` and the archive tables come from an Alembic
+revision (``flask db upgrade``).
+"""
+from datetime import datetime, timedelta
+from flask.cli import with_appcontext
+from sqlalchemy import and_, delete, exists, func, insert, or_, select, update
+from listing_changes import listings_changed
+from models import db, Property, Transaction, View, ViewArchive, Inquiry, InquiryArchive
+import click
+import os
+
+ARCHIVE_LISTINGS_AFTER_DAYS = int(os.getenv("ARCHIVE_LISTINGS_AFTER_DAYS", 365))
+ARCHIVE_SOLD_AFTER_DAYS = int(os.getenv("ARCHIVE_SOLD_AFTER_DAYS", 30))
+ARCHIVE_VIEWS_AFTER_DAYS = int(os.getenv("ARCHIVE_VIEWS_AFTER_DAYS", 180))
+ARCHIVE_INQUIRIES_AFTER_DAYS = int(os.getenv("ARCHIVE_INQUIRIES_AFTER_DAYS", 180))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 5000))
+
+VIEW_COLUMNS = ("id", "property_id", "user_id", "agent_id", "sheduled_time", "status", "created_at", "updated_at")
+INQUIRY_COLUMNS = ("id", "user_id", "agent_id", "property_id", "message", "status", "reply", "created_at", "updated_at")
+
+
+def archivable_listings(now):
+    """WHERE clause for live listings that are sold or expired at ``now``"""
+    expired = now - timedelta(days=ARCHIVE_LISTINGS_AFTER_DAYS)
+    sold = now - timedelta(days=ARCHIVE_SOLD_AFTER_DAYS)
+    return and_(
+        Property.archived_at.is_(None),
+        or_(
+            and_(Property.listing_date < expired, func.coalesce(Property.updated_at, Property.listing_date) < expired),
+            exists().where(Transaction.property_id == Property.id, Transaction.closing_date < sold),
+        ),
+    )
+
+
+def archive_listings(now=None, dry_run=False):
+    """Soft-delete sold/expired listings. Returns how many were (or would be) archived."""
+    now = now or datetime.now()
+    condition = archivable_listings(now)
+    if dry_run:
+        return db.session.scalar(select(func.count()).select_from(Property).where(condition))
+    archived_ids = db.session.scalars(select(Property.id).where(condition)).all()
+    result = db.session.execute(
+        # updated_at is left alone so archiving doesn't look like an edit
+        update(Property).where(condition).values(archived_at=now, updated_at=Property.updated_at),
+        execution_options={"synchronize_session": False},
+    )
+    listings_changed(archived_ids)
+    db.session.commit()
+    return result.rowcount
+
+
+def move_rows(source, archive, columns, condition, batch_size=ARCHIVE_BATCH_SIZE, dry_run=False):
+    """Move rows matching ``condition`` from ``source`` to ``archive`` in batches. Returns rows moved."""
+    if dry_run:
+        return db.session.scalar(select(func.count()).select_from(source).where(condition))
+
+    source_columns = [getattr(source, column) for column in columns]
+    moved = 0
+    while True:
+        ids = list(db.session.scalars(select(source.id).where(condition).order_by(source.id).limit(batch_size)))
+        if not ids:
+            return moved
+        db.session.execute(insert(archive).from_select(columns, select(*source_columns).where(source.id.in_(ids))))
+        db.session.execute(delete(source).where(source.id.in_(ids)), execution_options={"synchronize_session": False})
+        db.session.commit()
+        moved += len(ids)
+
+
+def archive_views(now=None, dry_run=False):
+    cutoff = (now or datetime.now()) - timedelta(days=ARCHIVE_VIEWS_AFTER_DAYS)
+    return move_rows(View, ViewArchive, VIEW_COLUMNS, and_(View.status == "viewed", View.created_at < cutoff),
+                     dry_run=dry_run)
+
+
+def archive_inquiries(now=None, dry_run=False):
+    cutoff = (now or datetime.now()) - timedelta(days=ARCHIVE_INQUIRIES_AFTER_DAYS)
+    last_activity = func.coalesce(Inquiry.updated_at, Inquiry.created_at)
+    return move_rows(Inquiry, InquiryArchive, INQUIRY_COLUMNS, and_(Inquiry.status == "closed", last_activity < cutoff),
+                     dry_run=dry_run)
+
+
+def run_archival(now=None, dry_run=False):
+    """Run every archival step. Returns {step: rows}."""
+    now = now or datetime.now()
+    return {
+        "listings": archive_listings(now, dry_run),
+        "views": archive_views(now, dry_run),
+        "inquiries": archive_inquiries(now, dry_run),
+    }
+
+
+def view_counts(property_ids, include_archived=False):
+    """{property_id: views}, optionally adding archived views"""
+    if not property_ids:
+        return {}
+    counts = dict(db.session.execute(
+        select(View.property_id, func.count()).where(View.property_id.in_(property_ids)).group_by(View.property_id)
+    ).all())
+    if include_archived:
+        for property_id, n in db.session.execute(
+            select(ViewArchive.property_id, func.count())
+            .where(ViewArchive.property_id.in_(property_ids))
+            .group_by(ViewArchive.property_id)
+        ):
+            counts[property_id] = counts.get(property_id, 0) + n
+    return counts
+
+
+@click.command("archive")
+@click.option("--dry-run", is_flag=True, help="only count what would be archived")
+@with_appcontext
+def archive_command(dry_run):
+    """Archive sold/expired listings, old page views and closed inquiries."""
+    for step, rows in run_archival(dry_run=dry_run).items():
+        click.echo(f"{step}: {rows} {'would be ' if dry_run else ''}archived")
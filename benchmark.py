@@ -0,0 +1,258 @@
+"""Benchmarks for the API, run in-process against the Flask test client.
+
+A single process issuing requests back to back is what one sync gunicorn
+worker can do, so requests/sec here is throughput per worker.
+
+Uses a throwaway SQLite database unless --database-url is given:
+
+    python benchmark.py auth --rounds 10,12 --duration 5
+    python benchmark.py workload --preset small --requests 20
+    python benchmark.py workload --preset production --workloads detail,stats,inbox
+
+``workload`` fills the database with synthetic data (see datagen.py) and then
+replays scripted requests against the catalog, detail, stats, inbox and
+upload endpoints, reporting latency percentiles and SQL queries per request.
+"""
+from io import BytesIO
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+
+def setup_app(database_url=None):
+    """Import the app bound to the benchmark database and create the schema"""
+    if not database_url:
+        database_url = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="ags-bench-"), "bench.db")
+    os.environ["DATABASE_URL"] = database_url
+
+    from app import app
+    from models import db
+
+    with app.app_context():
+        # app.py loads .env with override=True, refuse to run against anything else
+        if db.engine.url.render_as_string(hide_password=False) != database_url:
+            raise SystemExit(f"Refusing to benchmark against {db.engine.url!r}; pass --database-url explicitly")
+        db.engine.echo = False
+        db.create_all()
+    return app
+
+
+def run_for(duration, fn):
+    """Call fn repeatedly for ``duration`` seconds and return per-call latencies"""
+    latencies = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        fn(len(latencies))
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def report(name, latencies, statuses=None):
+    total = sum(latencies)
+    line = (f"{name:<32} {len(latencies):>7} req  {len(latencies) / total if total else 0:>9.1f} req/s"
+            f"  mean {statistics.mean(latencies) * 1000:>8.2f} ms")
+    if statuses:
+        line += "  " + " ".join(f"{code}x{count}" for code, count in sorted(statuses.items()))
+    print(line)
+
+
+def bench_auth(app, args):
+    """Login and signup throughput for each bcrypt cost"""
+    from models import db, User, UserProfile
+    from passwords import hash_password
+
+    client = app.test_client()
+    password = "bench-password"
+
+    for rounds in args.rounds:
+        app.config["BCRYPT_LOG_ROUNDS"] = rounds
+        email = f"login-{rounds}@bench.local"
+
+        with app.app_context():
+            user = User(first_name="Bench", last_name="Login", phone=f"login-{rounds}", email=email,
+                        password=hash_password(password, rounds=rounds), role="user", is_verified=True)
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(UserProfile(user_id=user.id))
+            db.session.commit()
+
+        print(f"\nbcrypt rounds = {rounds}")
+        statuses = {}
+
+        def login(i):
+            response = client.post("/login", json={"email": email, "password": password})
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        report("login", run_for(args.duration, login), statuses)
+
+        statuses = {}
+
+        def bad_login(i):
+            response = client.post("/login", json={"email": email, "password": "wrong"})
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        report("login (wrong password)", run_for(args.duration, bad_login), statuses)
+
+        statuses = {}
+
+        def signup(i):
+            response = client.post("/signup", json={
+                "first_name": "Bench", "last_name": "Signup", "phone": f"s-{rounds}-{i}",
+                "email": f"signup-{rounds}-{i}@bench.local", "password": password, "role": "user",
+            })
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        report("signup", run_for(args.duration, signup), statuses)
+
+        statuses = {}
+
+        def duplicate_signup(i):
+            response = client.post("/signup", json={
+                "first_name": "Bench", "last_name": "Signup", "phone": f"dup-{rounds}-{i}",
+                "email": email, "password": password, "role": "user",
+            })
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        report("signup (email taken)", run_for(args.duration, duplicate_signup), statuses)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * pct // 100))
+    return ordered[int(rank) - 1]
+
+
+def workload_scenarios(ids):
+    """Scripted requests per workload: (name, role, fn(rng) -> (method, url, kwargs))"""
+    def property_id(rng):
+        return rng.choice(ids["properties"])
+
+    def upload(rng):
+        data = {
+            "title": "Benchmark upload", "price": str(rng.randint(10, 90) * 100000), "listing_type": "sale",
+            "property_type_id": str(ids["property_type"]), "bedrooms": "3", "city": "Nairobi", "neighborhood": "Karen",
+            "images": [(BytesIO(os.urandom(64 * 1024)), f"photo{n}.jpg") for n in range(3)],
+        }
+        return "post", "/agent/properties/create", {"data": data, "content_type": "multipart/form-data"}
+
+    return {
+        "catalog": [
+            ("GET /properties", None, lambda rng: ("get", "/properties", {})),
+            ("GET /user/properties", None, lambda rng: ("get", "/user/properties", {})),
+        ],
+        "detail": [
+            ("GET /user/properties/<id>", None, lambda rng: ("get", f"/user/properties/{property_id(rng)}", {})),
+            ("GET /properties/<id>/available-slots", None,
+             lambda rng: ("get", f"/properties/{property_id(rng)}/available-slots", {})),
+        ],
+        "stats": [
+            ("GET /user/stats", "user", lambda rng: ("get", "/user/stats", {})),
+            ("GET /agent/stats", "agent", lambda rng: ("get", "/agent/stats", {})),
+            ("GET /agent/properties", "agent", lambda rng: ("get", "/agent/properties?limit=20", {})),
+        ],
+        "inbox": [
+            ("GET /user/conversations", "user", lambda rng: ("get", "/user/conversations", {})),
+            ("GET /user/inquiries", "user", lambda rng: ("get", "/user/inquiries?limit=20", {})),
+            ("GET /agent/inquiries", "agent", lambda rng: ("get", "/agent/inquiries?limit=20", {})),
+            ("GET /user/scheduled-visits", "user", lambda rng: ("get", "/user/scheduled-visits?limit=20", {})),
+        ],
+        "upload": [
+            ("POST /agent/properties/create", "agent", upload),
+        ],
+    }
+
+
+def bench_workload(app, args):
+    """Generate synthetic data, then replay scripted workloads"""
+    from datagen import Volumes, generate, print_progress
+    from flask_jwt_extended import create_access_token
+    from instrumentation import count_queries
+    from models import db, User, Property, Property_type
+    from utils import build_claims
+    import resources.agent
+
+    # Keep benchmark uploads out of the repo's uploads/ folder
+    resources.agent.UPLOAD_FOLDER = tempfile.mkdtemp(prefix="ags-bench-uploads-")
+
+    with app.app_context():
+        if not args.skip_generate:
+            volumes = Volumes.preset(args.preset, properties=args.properties, views=args.views,
+                                     conversations=args.conversations, users=args.users)
+            print(f"Generating {args.preset} dataset: {volumes.as_dict()}")
+            started = time.perf_counter()
+            generate(volumes, seed=args.seed, progress=print_progress() if args.verbose else None)
+            print(f"Generated in {time.perf_counter() - started:.1f}s")
+
+        ids = {
+            "properties": [row.id for row in db.session.query(Property.id)],
+            "property_type": db.session.query(Property_type.id).limit(1).scalar(),
+        }
+        tokens = {}
+        for role in ("user", "agent"):
+            users = User.query.filter_by(role=role).order_by(User.id).limit(50).all()
+            tokens[role] = [create_access_token(identity=u.id, additional_claims=build_claims(u)) for u in users]
+        db.session.remove()
+
+    if not ids["properties"]:
+        raise SystemExit("No properties in the database, run without --skip-generate")
+
+    client = app.test_client()
+    rng = random.Random(args.seed)
+    scenarios = workload_scenarios(ids)
+
+    print(f"\n{'endpoint':<40} {'n':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8}  status")
+    for workload in args.workloads:
+        for name, role, make_request in scenarios[workload]:
+            latencies, queries, statuses = [], [], {}
+            for i in range(args.warmup + args.requests):
+                method, url, kwargs = make_request(rng)
+                headers = {"Authorization": f"Bearer {rng.choice(tokens[role])}"} if role else {}
+                with count_queries() as stats:
+                    start = time.perf_counter()
+                    response = getattr(client, method)(url, headers=headers, **kwargs)
+                    elapsed = time.perf_counter() - start
+                if i < args.warmup:
+                    continue
+                latencies.append(elapsed)
+                queries.append(stats.count)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+            print(f"{name:<40} {len(latencies):>5} {percentile(latencies, 50) * 1000:>9.2f} "
+                  f"{percentile(latencies, 95) * 1000:>9.2f} {percentile(latencies, 99) * 1000:>9.2f} "
+                  f"{statistics.mean(queries):>8.1f}  " + " ".join(f"{c}x{n}" for c, n in sorted(statuses.items())))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="database to benchmark against (default: temporary SQLite file)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    auth = subparsers.add_parser("auth", help="login/signup throughput per bcrypt cost")
+    auth.add_argument("--rounds", type=lambda v: [int(r) for r in v.split(",")], default=[10, 12],
+                      help="comma separated bcrypt costs (default: 10,12)")
+    auth.add_argument("--duration", type=float, default=5, help="seconds per scenario (default: 5)")
+    auth.set_defaults(func=bench_auth)
+
+    workload = subparsers.add_parser("workload", help="latency percentiles and queries per request on synthetic data")
+    workload.add_argument("--preset", choices=["tiny", "small", "production"], default="small",
+                          help="dataset size (default: small)")
+    workload.add_argument("--properties", type=int, help="override the preset's property count")
+    workload.add_argument("--views", type=int, help="override the preset's view count")
+    workload.add_argument("--conversations", type=int, help="override the preset's conversation count")
+    workload.add_argument("--users", type=int, help="override the preset's user count")
+    workload.add_argument("--seed", type=int, default=42, help="random seed for data and request mix (default: 42)")
+    workload.add_argument("--skip-generate", action="store_true", help="reuse data already in --database-url")
+    workload.add_argument("--workloads", type=lambda v: v.split(","), default=["catalog", "detail", "stats", "inbox", "upload"],
+                          help="comma separated subset of catalog,detail,stats,inbox,upload")
+    workload.add_argument("--requests", type=int, default=20, help="measured requests per endpoint (default: 20)")
+    workload.add_argument("--warmup", type=int, default=2, help="unmeasured requests per endpoint (default: 2)")
+    workload.add_argument("--verbose", action="store_true", help="print insert progress while generating")
+    workload.set_defaults(func=bench_workload)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(setup_app(args.database_url), args)
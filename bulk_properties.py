@@ -0,0 +1,359 @@
+"""Bulk property import and export for agents.
+
+Imports stream CSV or NDJSON rows from the request body and never hold the
+whole file in memory. Valid rows are collected into chunks of
+IMPORT_CHUNK_SIZE. For each chunk, property types and locations are resolved
+with one query each, and any missing ones are created together (locations
+are deduplicated by locations.location_key). The
+properties and their property_locations are then inserted with one
+statement each and the chunk is committed. If a chunk fails, only that
+chunk is rolled back and its rows are reported as failed.
+
+Columns (CSV header or NDJSON keys):
+
+    title, price, listing_type                      required
+    property_type or property_type_id               required, unknown type names are created
+    description, currency, status, bedrooms, bathrooms, area_size, area_unit
+    country, state, city, neighborhood, latitude, longitude
+
+Exports write the same columns plus ``id``, so an export can be edited and
+imported again (``id`` is ignored on import, rows are always created).
+"""
+from datetime import datetime
+from io import TextIOWrapper
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import SQLAlchemyError
+from models import db, Property, Property_type, Location, PropertyLocation
+from locations import LOCATION_FIELDS, location_key, resolve_locations
+from listing_changes import listings_changed
+import csv
+import json
+import os
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", 500))
+IMPORT_MAX_ROWS = int(os.getenv("IMPORT_MAX_ROWS", 50000))
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", 500))
+EXPORT_BATCH_SIZE = 1000
+EXPORT_ROWS_PER_CHUNK = 100
+
+STATUSES = ("onsale", "onrent", "lease")
+INT_FIELDS = ("bedrooms", "bathrooms", "area_size")
+# Largest value an INTEGER column takes on every database
+MAX_INT = 2**31 - 1
+
+EXPORT_COLUMNS = [
+    "id", "title", "description", "price", "currency", "listing_type", "status", "property_type", "property_type_id",
+    "bedrooms", "bathrooms", "area_size", "area_unit", "country", "state", "city", "neighborhood", "latitude", "longitude",
+    "listing_date",
+]
+
+FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def detect_format(content_type, filename=None, requested=None):
+    """csv or ndjson from an explicit ?format=, the file extension or the content type"""
+    if requested:
+        return requested if requested in FORMATS else None
+    if filename:
+        extension = filename.rsplit(".", 1)[-1].lower()
+        if extension in ("csv", "ndjson", "jsonl"):
+            return "csv" if extension == "csv" else "ndjson"
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if content_type in ("text/csv", "application/csv"):
+        return "csv"
+    if content_type in ("application/x-ndjson", "application/ndjson", "application/jsonl"):
+        return "ndjson"
+    return None
+
+
+def read_rows(stream, fmt):
+    """Yield (row number, dict or None, error) from a binary stream, one line at a time"""
+    text = TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        for row in reader:
+            # Extra cells are collected under the None key
+            if None in row:
+                yield reader.line_num, None, "Row has more cells than the header"
+            else:
+                yield reader.line_num, row, None
+        return
+
+    for line_num, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield line_num, None, "Invalid JSON"
+            continue
+        if not isinstance(row, dict):
+            yield line_num, None, "Each line must be a JSON object"
+            continue
+        yield line_num, row, None
+
+
+def _text(row, field):
+    value = row.get(field)
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+
+def _int(row, field, errors, minimum=0, maximum=MAX_INT):
+    value = _text(row, field)
+    if value is None:
+        return None
+    try:
+        number = int(float(value))
+    except (ValueError, OverflowError):
+        errors.append(f"{field} must be a number")
+        return None
+    if number < minimum:
+        errors.append(f"{field} must be at least {minimum}")
+        return None
+    if number > maximum:
+        errors.append(f"{field} must be at most {maximum}")
+        return None
+    return number
+
+
+def validate_row(row):
+    """Return (values, errors) for one input row"""
+    errors = []
+    values = {
+        "title": _text(row, "title"),
+        "description": _text(row, "description"),
+        "price": _int(row, "price", errors),
+        "currency": _text(row, "currency") or "Ksh",
+        "listing_type": _text(row, "listing_type"),
+        "status": _text(row, "status") or "onsale",
+        "area_unit": _text(row, "area_unit"),
+        "property_type": _text(row, "property_type"),
+        "property_type_id": _int(row, "property_type_id", errors, minimum=1),
+        "latitude": _text(row, "latitude"),
+        "longitude": _text(row, "longitude"),
+    }
+    for field in INT_FIELDS:
+        values[field] = _int(row, field, errors)
+    for field in LOCATION_FIELDS:
+        values[field] = _text(row, field)
+
+    if not values["title"]:
+        errors.append("title is required")
+    if _text(row, "price") is None:
+        errors.append("price is required")
+    if not values["listing_type"]:
+        errors.append("listing_type is required")
+    if values["status"] not in STATUSES:
+        errors.append(f"status must be one of {', '.join(STATUSES)}")
+    if not values["property_type"] and _text(row, "property_type_id") is None:
+        errors.append("property_type or property_type_id is required")
+
+    return values, errors
+
+
+class PropertyImporter:
+    """Validates rows and inserts them for one agent in chunked transactions"""
+
+    def __init__(self, agent_id, chunk_size=IMPORT_CHUNK_SIZE, dry_run=False):
+        self.agent_id = agent_id
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.rows = 0
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self.property_ids = []
+        self._chunk = []
+        # Lookups carried across chunks so each type is queried once per import
+        self._type_ids = {}
+        self._known_type_ids = set()
+
+    def add_error(self, row_number, messages):
+        self.failed += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append({"row": row_number, "errors": messages})
+
+    def add(self, row_number, row):
+        self.rows += 1
+        values, errors = validate_row(row)
+        if errors:
+            self.add_error(row_number, errors)
+            return
+        self._chunk.append((row_number, values))
+        if len(self._chunk) >= self.chunk_size:
+            self.flush()
+
+    def run(self, rows):
+        """Consume read_rows() output. Returns False when IMPORT_MAX_ROWS was exceeded."""
+        for row_number, row, error in rows:
+            if self.rows >= IMPORT_MAX_ROWS:
+                self.flush()
+                return False
+            if error:
+                self.rows += 1
+                self.add_error(row_number, [error])
+            else:
+                self.add(row_number, row)
+        self.flush()
+        return True
+
+    def flush(self):
+        chunk, self._chunk = self._chunk, []
+        if not chunk:
+            return
+        try:
+            self._resolve_types(chunk)
+            chunk = self._drop_unknown_type_ids(chunk)
+            if not chunk:
+                return
+            location_ids = resolve_locations([values for _, values in chunk])
+            ids = self._insert_properties(chunk, location_ids)
+            if self.dry_run:
+                db.session.rollback()
+                self._type_ids.clear()
+            else:
+                listings_changed(ids)
+                db.session.commit()
+                self.property_ids.extend(ids)
+            self.imported += len(chunk)
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            # Ids created in the rolled back transaction are gone
+            self._type_ids.clear()
+            for row_number, _ in chunk:
+                self.add_error(row_number, [f"Database error: {e.__class__.__name__}"])
+
+    def _resolve_types(self, chunk):
+        names = {values["property_type"].lower(): values["property_type"]
+                 for _, values in chunk if not values["property_type_id"]}
+        missing = [lower for lower in names if lower not in self._type_ids]
+        if missing:
+            for type_id, name in db.session.execute(
+                select(Property_type.id, Property_type.name).where(func.lower(Property_type.name).in_(missing))
+            ):
+                self._type_ids.setdefault(name.lower(), type_id)
+            new_types = [Property_type(name=names[lower]) for lower in missing if lower not in self._type_ids]
+            if new_types:
+                db.session.add_all(new_types)
+                db.session.flush()
+                for property_type in new_types:
+                    self._type_ids[property_type.name.lower()] = property_type.id
+
+        ids = {values["property_type_id"] for _, values in chunk if values["property_type_id"]} - self._known_type_ids
+        if ids:
+            self._known_type_ids.update(db.session.scalars(select(Property_type.id).where(Property_type.id.in_(ids))))
+
+    def _drop_unknown_type_ids(self, chunk):
+        valid = []
+        for row_number, values in chunk:
+            type_id = values["property_type_id"]
+            if type_id and type_id not in self._known_type_ids:
+                self.add_error(row_number, [f"property_type_id {type_id} does not exist"])
+                continue
+            values["property_type_id"] = type_id or self._type_ids[values["property_type"].lower()]
+            valid.append((row_number, values))
+        return valid
+
+    def _insert_properties(self, chunk, location_ids):
+        now = datetime.now()
+        rows = [
+            {
+                "title": values["title"], "description": values["description"], "price": values["price"],
+                "currency": values["currency"], "listing_type": values["listing_type"], "status": values["status"],
+                "property_type_id": values["property_type_id"], "agent_id": self.agent_id,
+                "bedrooms": values["bedrooms"], "bathrooms": values["bathrooms"], "area_size": values["area_size"],
+                "area_unit": values["area_unit"], "listing_date": now, "updated_at": now,
+            }
+            for _, values in chunk
+        ]
+        ids = list(db.session.scalars(
+            insert(Property).returning(Property.id, sort_by_parameter_order=True), rows
+        ))
+
+        links = []
+        for property_id, (_, values) in zip(ids, chunk):
+            key = location_key(*(values[field] for field in LOCATION_FIELDS))
+            if key:
+                links.append({"property_id": property_id, "location_id": location_ids[key]})
+        if links:
+            db.session.execute(insert(PropertyLocation), links)
+        return ids
+
+    def report(self):
+        return {
+            "rows": self.rows,
+            "imported": self.imported,
+            "failed": self.failed,
+            "dry_run": self.dry_run,
+            "errors": sorted(self.errors, key=lambda error: error["row"]),
+            "errors_truncated": self.failed > len(self.errors),
+        }
+
+
+def export_rows(agent_id):
+    """Yield an agent's listings as dicts of EXPORT_COLUMNS, fetched in batches"""
+    # One location per property (the first linked one)
+    first_location = (
+        select(PropertyLocation.property_id, func.min(PropertyLocation.location_id).label("location_id"))
+        .group_by(PropertyLocation.property_id)
+        .subquery()
+    )
+    query = (
+        select(Property, Property_type.name, Location)
+        .join(Property_type, Property_type.id == Property.property_type_id, isouter=True)
+        .join(first_location, first_location.c.property_id == Property.id, isouter=True)
+        .join(Location, Location.id == first_location.c.location_id, isouter=True)
+        .where(Property.agent_id == agent_id)
+        .order_by(Property.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    for prop, type_name, location in db.session.execute(query):
+        yield {
+            "id": prop.id, "title": prop.title, "description": prop.description, "price": prop.price,
+            "currency": prop.currency, "listing_type": prop.listing_type, "status": prop.status,
+            "property_type": type_name, "property_type_id": prop.property_type_id,
+            "bedrooms": prop.bedrooms, "bathrooms": prop.bathrooms, "area_size": prop.area_size,
+            "area_unit": prop.area_unit,
+            "country": location.country if location else None, "state": location.state if location else None,
+            "city": location.city if location else None, "neighborhood": location.neighborhood if location else None,
+            "latitude": location.latitude if location else None, "longitude": location.longitude if location else None,
+            "listing_date": prop.listing_date.isoformat() if prop.listing_date else None,
+        }
+
+
+class _LineBuffer:
+    """File-like target for csv.writer that hands back what was written"""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(data)
+
+    def pop(self):
+        data = "".join(self.parts)
+        self.parts = []
+        return data
+
+
+def export_stream(agent_id, fmt):
+    """Generator of response chunks in csv or ndjson"""
+    buffer = _LineBuffer()
+    if fmt == "csv":
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+
+    for n, row in enumerate(export_rows(agent_id), start=1):
+        if fmt == "csv":
+            writer.writerow(["" if row[c] is None else row[c] for c in EXPORT_COLUMNS])
+        else:
+            buffer.write(json.dumps(row) + "\n")
+        if n % EXPORT_ROWS_PER_CHUNK == 0:
+            yield buffer.pop()
+    yield buffer.pop()
@@ -0,0 +1,342 @@
+"""In-memory catalog snapshot for filtered browsing with facet counts.
+
+Each process keeps the live listings as parallel NumPy arrays, one per
+field. Prices, bedrooms and amenity masks are stored as numbers; listing
+type, property type, city and neighborhood as dictionary codes. A
+/properties/facets request turns every filter into a boolean mask over
+those arrays. The result set is the AND of all masks. Each facet is counted
+with np.bincount over the AND of every *other* mask, so users see what
+picking another value would give. The database is only asked for the
+cards of the returned page.
+
+Listing writes call listings_changed() (see listing_changes.py), which
+adds the ids they touched to ``catalog_changes`` in their own transaction. At most every
+CATALOG_REFRESH_INTERVAL seconds, a read replays the changes after the
+snapshot's watermark. It reloads just those listings, overwrites or appends
+their rows, and marks listings that left the catalog as dead. Replays build
+a new snapshot, so concurrent readers never see a half-applied one. Change
+ids skipped by the watermark (transactions still in flight on Postgres) are
+re-checked for CATALOG_GAP_SECONDS. The snapshot is rebuilt from scratch
+every CATALOG_REBUILD_SECONDS, or once a quarter of its rows are dead. One
+thread builds it outside the replay lock while the others keep serving and
+replaying the old snapshot, then swaps it in; the first build is the only
+one readers wait for.
+
+    CATALOG_REFRESH_INTERVAL  seconds between change replays (default: 2)
+    CATALOG_REBUILD_SECONDS   seconds between full rebuilds (default: 900)
+    CATALOG_CHANGE_KEEP_DAYS  catalog_changes rows are pruned after this many days (default: 1)
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import delete, func, insert, or_, select, true
+from models import db, Property, PropertyLocation, Location, Property_type, CatalogChange
+from amenities import amenity_names, MAX_AMENITY_ID
+import numpy as np
+import os
+import threading
+import time
+
+CATALOG_REFRESH_INTERVAL = float(os.getenv("CATALOG_REFRESH_INTERVAL", 2))
+CATALOG_REBUILD_SECONDS = float(os.getenv("CATALOG_REBUILD_SECONDS", 900))
+CATALOG_CHANGE_KEEP_DAYS = int(os.getenv("CATALOG_CHANGE_KEEP_DAYS", 1))
+CATALOG_GAP_SECONDS = 60
+CATALOG_DEAD_FRACTION = 0.25
+
+# Lower bounds of the price facet buckets; the last bucket is open-ended
+PRICE_BUCKETS = (0, 25_000, 50_000, 100_000, 250_000, 1_000_000, 5_000_000, 10_000_000, 25_000_000, 50_000_000)
+# Listings with more bedrooms are counted as "5+"
+MAX_BEDROOM_FACET = 5
+
+CODED_FIELDS = ("listing_type", "property_type", "city", "neighborhood")
+SORTS = ("newest", "price_asc", "price_desc")
+
+
+class Dictionary:
+    """Codes for the distinct values of a text field, matched case-insensitively; append-only"""
+
+    def __init__(self):
+        self.labels = []
+        self._codes = {}
+
+    def encode(self, value):
+        if value is None or not str(value).strip():
+            return -1
+        key = str(value).strip().lower()
+        code = self._codes.get(key)
+        if code is None:
+            code = self._codes[key] = len(self.labels)
+            self.labels.append(str(value).strip())
+        return code
+
+    def lookup(self, value):
+        """Code of ``value``; -2, which matches nothing, if no listing has it"""
+        return self._codes.get(str(value).strip().lower(), -2)
+
+
+class Snapshot:
+    """One process's columnar copy of the live listings; never modified once published"""
+
+    def __init__(self, dictionaries, columns, rows, watermark, gaps, built_at):
+        self.dictionaries = dictionaries
+        # {field: array}, all of the same length, plus "id" and "live"
+        self.columns = columns
+        # property id -> row
+        self.rows = rows
+        self.watermark = watermark
+        # change id -> monotonic time after which it is given up on
+        self.gaps = gaps
+        self.built_at = built_at
+        self.dead = int(np.count_nonzero(~columns["live"]))
+
+    def __len__(self):
+        return len(self.columns["id"])
+
+
+def record_listing_changes(property_ids):
+    """Note listings whose catalog data changed, in the current transaction"""
+    if property_ids:
+        db.session.execute(insert(CatalogChange), [{"property_id": property_id} for property_id in property_ids])
+
+
+def _listing_rows(condition):
+    first_location_id = (
+        select(PropertyLocation.location_id)
+        .where(PropertyLocation.property_id == Property.id)
+        .order_by(PropertyLocation.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    return db.session.execute(
+        select(
+            Property.id, Property.listing_type, Property_type.name.label("property_type"), Location.city,
+            Location.neighborhood, Property.price, Property.bedrooms, Property.bathrooms, Property.amenity_mask,
+            Property.listing_date,
+        )
+        .outerjoin(Property_type, Property_type.id == Property.property_type_id)
+        .outerjoin(Location, Location.id == first_location_id)
+        .where(Property.archived_at.is_(None), condition)
+    ).all()
+
+
+def _columns(rows, dictionaries):
+    def numbers(values, dtype, missing):
+        return np.array([missing if value is None else value for value in values], dtype=dtype)
+
+    columns = {
+        "id": np.array([row.id for row in rows], dtype=np.int64),
+        "live": np.ones(len(rows), dtype=bool),
+        "price": numbers((row.price for row in rows), np.float64, np.nan),
+        "bedrooms": numbers((row.bedrooms for row in rows), np.int16, -1),
+        "bathrooms": numbers((row.bathrooms for row in rows), np.int16, -1),
+        "amenity_mask": numbers((row.amenity_mask for row in rows), np.int64, 0),
+        "listed": numbers((row.listing_date.timestamp() if row.listing_date else None for row in rows),
+                          np.float64, 0),
+    }
+    for field in CODED_FIELDS:
+        encode = dictionaries[field].encode
+        columns[field] = np.array([encode(getattr(row, field)) for row in rows], dtype=np.int32)
+    return columns
+
+
+def build_snapshot():
+    """Load every live listing into a new snapshot"""
+    # Replaying a change twice is harmless, so start a gap window back to cover transactions still committing
+    recent = datetime.now() - timedelta(seconds=CATALOG_GAP_SECONDS)
+    watermark = db.session.scalar(select(func.min(CatalogChange.id) - 1).where(CatalogChange.created_at >= recent))
+    if watermark is None:
+        watermark = db.session.scalar(select(func.max(CatalogChange.id))) or 0
+    dictionaries = {field: Dictionary() for field in CODED_FIELDS}
+    columns = _columns(_listing_rows(true()), dictionaries)
+    rows = {property_id: i for i, property_id in enumerate(columns["id"].tolist())}
+    return Snapshot(dictionaries, columns, rows, watermark, {}, time.monotonic())
+
+
+def replay(snapshot):
+    """A snapshot with the changes recorded since ``snapshot`` applied"""
+    now = time.monotonic()
+    changes = db.session.execute(
+        select(CatalogChange.id, CatalogChange.property_id)
+        .where(or_(CatalogChange.id > snapshot.watermark, CatalogChange.id.in_(list(snapshot.gaps))))
+    ).all()
+    change_ids = {change_id for change_id, _ in changes}
+    watermark = max([snapshot.watermark, *change_ids])
+    gaps = {change_id: expires for change_id, expires in snapshot.gaps.items()
+            if change_id not in change_ids and expires > now}
+    for change_id in range(snapshot.watermark + 1, watermark):
+        if change_id not in change_ids:
+            gaps[change_id] = now + CATALOG_GAP_SECONDS
+    if not changes:
+        return Snapshot(snapshot.dictionaries, snapshot.columns, snapshot.rows, watermark, gaps, snapshot.built_at)
+
+    property_ids = {property_id for _, property_id in changes}
+    loaded = _columns(_listing_rows(Property.id.in_(property_ids)), snapshot.dictionaries)
+    columns = {field: values.copy() for field, values in snapshot.columns.items()}
+    rows = dict(snapshot.rows)
+
+    positions = np.array([rows.get(property_id, -1) for property_id in loaded["id"].tolist()], dtype=np.int64)
+    existing = positions >= 0
+    for field, values in loaded.items():
+        columns[field][positions[existing]] = values[existing]
+    if not existing.all():
+        start = len(columns["id"])
+        for field, values in loaded.items():
+            columns[field] = np.concatenate([columns[field], values[~existing]])
+        for i, property_id in enumerate(loaded["id"][~existing].tolist()):
+            rows[property_id] = start + i
+
+    # Changed listings that didn't load were deleted or archived
+    gone = property_ids - set(loaded["id"].tolist())
+    columns["live"][[rows[property_id] for property_id in gone if property_id in rows]] = False
+    return Snapshot(snapshot.dictionaries, columns, rows, watermark, gaps, snapshot.built_at)
+
+
+_snapshot = None
+_checked_at = 0.0
+_lock = threading.Lock()
+_build_lock = threading.Lock()
+
+
+def _rebuild_due(snapshot):
+    return snapshot is None or time.monotonic() - snapshot.built_at > CATALOG_REBUILD_SECONDS \
+        or snapshot.dead > CATALOG_DEAD_FRACTION * len(snapshot)
+
+
+def catalog_snapshot():
+    """This process's snapshot, brought up to date at most every CATALOG_REFRESH_INTERVAL seconds"""
+    global _snapshot, _checked_at
+    current = _snapshot
+    if current and time.monotonic() - _checked_at < CATALOG_REFRESH_INTERVAL:
+        return current
+    # Full builds run outside _lock: only the first makes readers wait, later ones keep serving the old snapshot
+    if _rebuild_due(current) and _build_lock.acquire(blocking=current is None):
+        try:
+            if _rebuild_due(_snapshot):
+                built = build_snapshot()
+                with _lock:
+                    _snapshot, _checked_at = built, time.monotonic()
+            return _snapshot
+        finally:
+            _build_lock.release()
+    # One thread replays; the others wait for its result rather than repeating the work
+    with _lock:
+        current = _snapshot
+        if time.monotonic() - _checked_at < CATALOG_REFRESH_INTERVAL:
+            return current
+        current = replay(current)
+        _snapshot, _checked_at = current, time.monotonic()
+    return current
+
+
+def _value_counts(codes, labels):
+    counts = np.bincount(codes[codes >= 0], minlength=len(labels))
+    present = sorted(np.flatnonzero(counts).tolist(), key=lambda code: (-counts[code], labels[code]))
+    return [{"value": labels[code], "count": int(counts[code])} for code in present]
+
+
+def _bedroom_counts(bedrooms):
+    counts = np.bincount(np.minimum(bedrooms[bedrooms >= 0], MAX_BEDROOM_FACET), minlength=MAX_BEDROOM_FACET + 1)
+    return [
+        {"value": n, "label": f"{n}+" if n == MAX_BEDROOM_FACET else str(n), "count": int(counts[n])}
+        for n in np.flatnonzero(counts).tolist()
+    ]
+
+
+def _price_counts(prices):
+    known = prices[~np.isnan(prices)]
+    buckets = np.maximum(np.searchsorted(PRICE_BUCKETS, known, side="right") - 1, 0)
+    counts = np.bincount(buckets, minlength=len(PRICE_BUCKETS))
+    return [
+        {"min": low, "max": PRICE_BUCKETS[i + 1] if i + 1 < len(PRICE_BUCKETS) else None, "count": int(counts[i])}
+        for i, low in enumerate(PRICE_BUCKETS)
+    ]
+
+
+def _amenity_counts(masks):
+    return [
+        {"id": amenity_id, "name": name, "count": int(np.count_nonzero(masks & (1 << (amenity_id - 1))))}
+        for amenity_id, name in amenity_names().items()
+        if amenity_id <= MAX_AMENITY_ID
+    ]
+
+
+def _sort_keys(columns, indexes, sort):
+    """(sort key, id) of the given rows, negated for descending sorts so every order is ascending with NaN last"""
+    keys = columns["price" if sort.startswith("price") else "listed"][indexes]
+    ids = columns["id"][indexes]
+    return (keys, ids) if sort == "price_asc" else (-keys, -ids)
+
+
+def browse(filters, sort="newest", after=None, limit=20):
+    """(ids of one page, total matches, facet counts, ``after`` of the next page) for the live listings matching ``filters``
+
+    ``after`` is the (sort key, id) of the previous page's last listing, None for a missing price, so pages
+    don't shift when the snapshot changes between requests.
+    """
+    snapshot = catalog_snapshot()
+    columns = snapshot.columns
+
+    conditions = {}
+    for field in CODED_FIELDS:
+        if filters.get(field):
+            conditions[field] = columns[field] == snapshot.dictionaries[field].lookup(filters[field])
+    if filters.get("min_price") is not None or filters.get("max_price") is not None:
+        # NaN prices compare False, so listings without a price drop out of price filters
+        in_range = np.ones(len(snapshot), dtype=bool)
+        if filters.get("min_price") is not None:
+            in_range &= columns["price"] >= filters["min_price"]
+        if filters.get("max_price") is not None:
+            in_range &= columns["price"] <= filters["max_price"]
+        conditions["price"] = in_range
+    if filters.get("min_bedrooms") is not None:
+        conditions["bedrooms"] = columns["bedrooms"] >= filters["min_bedrooms"]
+    if filters.get("min_bathrooms") is not None:
+        conditions["bathrooms"] = columns["bathrooms"] >= filters["min_bathrooms"]
+    if filters.get("amenities"):
+        conditions["amenities"] = (columns["amenity_mask"] & filters["amenities"]) == filters["amenities"]
+
+    def matching(skip=None):
+        selected = columns["live"].copy()
+        for name, condition in conditions.items():
+            if name != skip:
+                selected &= condition
+        return selected
+
+    selected = matching()
+    facets = {field: _value_counts(columns[field][matching(field)], snapshot.dictionaries[field].labels)
+              for field in CODED_FIELDS}
+    facets["bedrooms"] = _bedroom_counts(columns["bedrooms"][matching("bedrooms")])
+    facets["price"] = _price_counts(columns["price"][matching("price")])
+    facets["amenities"] = _amenity_counts(columns["amenity_mask"][selected])
+
+    indexes = np.flatnonzero(selected)
+    total = len(indexes)
+    if after is not None:
+        keys, ids = _sort_keys(columns, indexes, sort)
+        key, after_id = (np.nan if after[0] is None else after[0]), after[1]
+        if sort != "price_asc":
+            key, after_id = -key, -after_id
+        if np.isnan(key):
+            later = np.isnan(keys) & (ids > after_id)
+        else:
+            later = (keys > key) | ((keys == key) & (ids > after_id)) | np.isnan(keys)
+        indexes = indexes[later]
+
+    keys, ids = _sort_keys(columns, indexes, sort)
+    # np.lexsort sorts by the last key first; the id breaks ties so the cursor is exact
+    page = indexes[np.lexsort((ids, keys))[:limit]]
+    next_after = None
+    if len(indexes) > limit:
+        last = page[-1]
+        key = float(columns["price" if sort.startswith("price") else "listed"][last])
+        next_after = (None if np.isnan(key) else key, int(columns["id"][last]))
+    return columns["id"][page].tolist(), total, facets, next_after
+
+
+def prune_catalog_changes(now=None):
+    """Delete changes older than CATALOG_CHANGE_KEEP_DAYS; snapshots are rebuilt long before. Returns rows deleted."""
+    cutoff = (now or datetime.now()) - timedelta(days=CATALOG_CHANGE_KEEP_DAYS)
+    result = db.session.execute(
+        delete(CatalogChange).where(CatalogChange.created_at < cutoff),
+        execution_options={"synchronize_session": False},
+    )
+    db.session.commit()
+    return result.rowcount
@@ -0,0 +1,356 @@
+"""Database engine configuration.
+
+Everything is driven by environment variables so production, staging and
+local development share one code path:
+
+    DATABASE_URL              database to connect to (default: local SQLite file)
+    SQL_ECHO                  log every statement (default: off)
+    DB_POOL_SIZE              persistent connections per process (default: 5)
+    DB_MAX_OVERFLOW           extra connections allowed under load (default: 10)
+    DB_POOL_TIMEOUT           seconds to wait for a free connection (default: 10)
+    DB_POOL_RECYCLE           seconds before a connection is replaced (default: 1800)
+    DB_POOL_PRE_PING          test connections on checkout (default: on)
+    DB_STATEMENT_TIMEOUT_MS   Postgres statement_timeout (default: 30000, 0 disables)
+    DB_JOB_STATEMENT_TIMEOUT_MS statement_timeout of the long batch jobs (default: 900000)
+    DATABASE_REPLICA_URLS     comma separated read replicas (default: none)
+    DB_REPLICA_MAX_LAG        seconds of lag before a replica is skipped (default: 5)
+    DB_REPLICA_CHECK_INTERVAL seconds between replica lag checks (default: 5)
+    DB_STICKY_SECONDS         how long a client reads from the primary after writing (default: 10)
+
+Read replicas are registered as ``replica_<n>`` binds. ``RoutingSession``
+sends queries made while serving GET/HEAD requests to a healthy replica and
+everything else, including flushes, to the primary. After a request writes,
+the client (by user id and by cookie) reads from the primary for
+DB_STICKY_SECONDS so it sees its own writes.
+"""
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.pool import QueuePool
+import os
+import random
+import threading
+import time
+
+REPLICA_PREFIX = "replica_"
+READ_METHODS = ("GET", "HEAD")
+REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", 5))
+REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", 5))
+STICKY_SECONDS = float(os.getenv("DB_STICKY_SECONDS", 10))
+STICKY_COOKIE = "db_primary_until"
+JOB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_JOB_STATEMENT_TIMEOUT_MS", 900000))
+
+
+def env_flag(name, default=False):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def database_url():
+    url = os.getenv("DATABASE_URL")
+    if not url:
+        # Fallback for local development
+        return "sqlite:///agsproperties.db"
+    # Heroku/Render style URLs are not accepted by SQLAlchemy
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]
+    return url
+
+
+class PoolStats:
+    """Process-wide connection pool counters"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.invalidations = 0
+            self.timeouts = 0
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+
+    def record_wait(self, seconds, timed_out=False):
+        with self._lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def incr(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self, pool=None):
+        with self._lock:
+            data = {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "invalidations": self.invalidations,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": round(self.wait_seconds_total, 6),
+                "wait_seconds_max": round(self.wait_seconds_max, 6),
+                "wait_seconds_avg": round(self.wait_seconds_total / self.checkouts, 6) if self.checkouts else 0.0,
+            }
+        if isinstance(pool, QueuePool):
+            data.update({
+                "pool_size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": pool.overflow(),
+            })
+        return data
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            pool_stats.record_wait(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_stats.record_wait(time.perf_counter() - start)
+        return connection
+
+
+def engine_options(url):
+    """SQLALCHEMY_ENGINE_OPTIONS for the given database URL"""
+    if url.startswith("sqlite"):
+        # SQLite has no server side pool or statement timeout to tune
+        return {"pool_pre_ping": False}
+
+    options = {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 10)),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": env_flag("DB_POOL_PRE_PING", True),
+    }
+
+    statement_timeout = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 30000))
+    if url.startswith("postgresql") and statement_timeout > 0:
+        options["connect_args"] = {"options": f"-c statement_timeout={statement_timeout}"}
+
+    return options
+
+
+def replica_urls():
+    urls = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+    return ["postgresql://" + url[len("postgres://"):] if url.startswith("postgres://") else url for url in urls]
+
+
+def configure_database(app):
+    """Set the Flask-SQLAlchemy config keys. Call before db.init_app(app)."""
+    url = database_url()
+    app.config["SQLALCHEMY_DATABASE_URI"] = url
+    app.config["SQLALCHEMY_ECHO"] = env_flag("SQL_ECHO")
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(url)
+    app.config["SQLALCHEMY_BINDS"] = {
+        f"{REPLICA_PREFIX}{i}": {"url": replica_url, **engine_options(replica_url)}
+        for i, replica_url in enumerate(replica_urls())
+    }
+
+
+def instrument_engine(engine):
+    """Count pool events on an engine. Call once per engine after db.init_app(app)."""
+    event.listen(engine, "connect", lambda *args: pool_stats.incr("connects"))
+    event.listen(engine, "checkout", lambda *args: pool_stats.incr("checkouts"))
+    event.listen(engine, "checkin", lambda *args: pool_stats.incr("checkins"))
+    event.listen(engine, "invalidate", lambda *args: pool_stats.incr("invalidations"))
+
+
+def has_column(bind, table, column):
+    """True when ``table`` exists and has ``column``; migrations skip what db.create_all() already made"""
+    inspector = inspect(bind)
+    return inspector.has_table(table) and column in {c["name"] for c in inspector.get_columns(table)}
+
+
+def has_index(bind, table, name):
+    """True when ``table`` exists and has an index called ``name``"""
+    inspector = inspect(bind)
+    return inspector.has_table(table) and name in {i["name"] for i in inspector.get_indexes(table)}
+
+
+@contextmanager
+def statement_timeout(session, milliseconds):
+    """Override the statement timeout for every transaction the session runs inside the block (Postgres only)"""
+    if isinstance(session, scoped_session):
+        session = session()
+    set_timeout = text(f"SET LOCAL statement_timeout = {int(milliseconds)}")
+
+    def on_begin(session, transaction, connection):
+        if connection.dialect.name == "postgresql":
+            connection.execute(set_timeout)
+
+    # Long jobs commit in batches, so each new transaction needs its own SET LOCAL
+    event.listen(session, "after_begin", on_begin)
+    try:
+        if session.in_transaction():
+            on_begin(session, None, session.connection())
+        yield
+    finally:
+        event.remove(session, "after_begin", on_begin)
+
+
+class ReplicaHealth:
+    """Caches replica lag checks so each replica is probed at most once per interval"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._status = {}
+
+    def is_healthy(self, key, engine):
+        now = time.monotonic()
+        with self._lock:
+            checked_at, healthy = self._status.get(key, (None, True))
+            if checked_at is not None and now - checked_at < REPLICA_CHECK_INTERVAL:
+                return healthy
+            # Claim the check so concurrent requests keep using the cached answer
+            self._status[key] = (now, healthy)
+
+        healthy = self._check(engine)
+        with self._lock:
+            self._status[key] = (now, healthy)
+        return healthy
+
+    def mark_unhealthy(self, key):
+        with self._lock:
+            self._status[key] = (time.monotonic(), False)
+
+    def _check(self, engine):
+        try:
+            with engine.connect() as connection:
+                return replica_lag(connection) <= REPLICA_MAX_LAG
+        except Exception:
+            return False
+
+
+replica_health = ReplicaHealth()
+
+
+def replica_lag(connection):
+    """Seconds the replica is behind the primary. Non-Postgres stand-ins never lag."""
+    if connection.dialect.name != "postgresql":
+        return 0.0
+    lag = connection.execute(text(
+        "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+        "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+    )).scalar()
+    return float(lag or 0)
+
+
+# user id -> time.time() deadline until which that user reads from the primary
+_sticky_users = {}
+_STICKY_USERS_SIZE = 10000
+
+
+def _is_sticky():
+    now = time.time()
+    try:
+        if float(request.cookies.get(STICKY_COOKIE, 0)) > now:
+            return True
+    except ValueError:
+        pass
+    user_id = g.get("user_id")
+    return user_id is not None and _sticky_users.get(user_id, 0) > now
+
+
+def use_primary():
+    """Force the rest of the current request to read from the primary"""
+    g.db_replica = None
+
+
+def _replica_for_request(engines):
+    """Replica bind key for the current request, or None for the primary"""
+    if not has_request_context() or request.method not in READ_METHODS or g.get("db_wrote"):
+        return None
+    if "db_replica" in g:
+        return g.db_replica
+
+    key = None
+    if not _is_sticky():
+        candidates = [k for k in engines if k and k.startswith(REPLICA_PREFIX)]
+        random.shuffle(candidates)
+        for candidate in candidates:
+            if replica_health.is_healthy(candidate, engines[candidate]):
+                key = candidate
+                break
+
+    # Keep one replica for the whole request so reads are consistent
+    g.db_replica = key
+    return key
+
+
+class RoutingSession(Session):
+    """Flask-SQLAlchemy session that sends read-only request traffic to replicas"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing:
+            engines = self._db.engines
+            if len(engines) > 1:
+                key = _replica_for_request(engines)
+                if key:
+                    return engines[key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _remember_write(session, flush_context):
+    if has_request_context():
+        g.db_wrote = True
+        g.db_replica = None
+
+
+def init_routing(app, db):
+    """Register the read-your-writes hook. Does nothing without replicas."""
+    if not app.config.get("SQLALCHEMY_BINDS"):
+        return
+
+    # Stop routing to a replica as soon as it drops connections
+    with app.app_context():
+        for key, engine in db.engines.items():
+            if key and key.startswith(REPLICA_PREFIX):
+                event.listen(engine, "handle_error", _replica_error_handler(key))
+
+    @app.after_request
+    def stick_to_primary_after_write(response):
+        if not g.get("db_wrote"):
+            return response
+
+        until = time.time() + STICKY_SECONDS
+        user_id = g.get("user_id")
+        if user_id is not None:
+            if len(_sticky_users) >= _STICKY_USERS_SIZE:
+                now = time.time()
+                for stale in [k for k, v in _sticky_users.items() if v <= now]:
+                    _sticky_users.pop(stale, None)
+            _sticky_users[user_id] = until
+
+        response.set_cookie(
+            STICKY_COOKIE, f"{until:.3f}", max_age=int(STICKY_SECONDS) + 1, httponly=True,
+            secure=request.is_secure, samesite="None" if request.is_secure else "Lax",
+        )
+        return response
+
+
+def _replica_error_handler(key):
+    def handle_error(context):
+        if context.is_disconnect:
+            replica_health.mark_unhealthy(key)
+    return handle_error
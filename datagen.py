@@ -0,0 +1,326 @@
+"""Synthetic data generator for benchmarks and staging databases.
+
+Rows are produced as plain dicts and written in batches, bypassing the ORM
+unit of work: ``COPY ... FROM STDIN`` on Postgres, executemany elsewhere.
+Primary keys are assigned up front (continuing after the current max id), so
+foreign keys can be filled in without reading anything back. The same seed
+always produces the same data.
+
+    with app.app_context():
+        generate(Volumes.preset("small"), seed=42)
+"""
+from dataclasses import dataclass, fields
+from datetime import datetime, timedelta
+from flask_bcrypt import generate_password_hash
+from io import StringIO
+from sqlalchemy import func, text
+from models import (
+    db, User, AgentProfile, UserProfile, Agency, Property_type, Property, Location, PropertyLocation,
+    Amenity, PropertyAmenity, PropertyImage, View, Inquiry, Favorite, Conversation, Message,
+)
+from locations import LOCATION_FIELDS, location_key, resolve_locations
+import random
+import time
+
+PROPERTY_TYPES = ["Apartment", "Villa", "Bungalow", "Mansion", "House", "Maisonette", "Commercial"]
+AMENITIES = ["WiFi", "Parking", "Swimming Pool", "Garden", "24/7 Security", "Gym", "Furnished"]
+NEIGHBORHOODS = [
+    ("Nairobi", "Westlands"), ("Nairobi", "Karen"), ("Nairobi", "Upper Hill"), ("Nairobi", "Runda"),
+    ("Nairobi", "Langata"), ("Nairobi", "Ngong Road"), ("Nairobi", "CBD"), ("Nairobi", "South C"),
+    ("Nairobi", "Kilimani"), ("Nairobi", "Lavington"), ("Nairobi", "Kileleshwa"), ("Nairobi", "Parklands"),
+    ("Mombasa", "Nyali"), ("Mombasa", "Bamburi"), ("Mombasa", "Diani"), ("Kisumu", "Milimani"),
+    ("Nakuru", "Milimani"), ("Kiambu", "Ruaka"), ("Kiambu", "Thika"), ("Kajiado", "Kitengela"),
+]
+STATUSES = [("onsale", "sale"), ("onrent", "rent"), ("lease", "lease")]
+
+# One bcrypt hash shared by every generated account ("password"), cheap cost on purpose
+PASSWORD = "password"
+
+
+@dataclass
+class Volumes:
+    agents: int = 20
+    users: int = 500
+    properties: int = 2000
+    images_per_property: int = 3
+    views: int = 20000
+    inquiries: int = 2000
+    favorites: int = 2000
+    conversations: int = 500
+    messages_per_conversation: int = 4
+
+    PRESETS = {
+        "tiny": dict(agents=3, users=20, properties=50, views=500, inquiries=50, favorites=50, conversations=20),
+        "small": {},
+        "production": dict(agents=1000, users=50000, properties=100000, views=1000000, inquiries=100000,
+                           favorites=200000, conversations=50000),
+    }
+
+    @classmethod
+    def preset(cls, name, **overrides):
+        values = dict(cls.PRESETS[name])
+        values.update({k: v for k, v in overrides.items() if v is not None})
+        return cls(**values)
+
+    def as_dict(self):
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+
+def next_id(model):
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def bulk_insert(model, rows, batch_size=5000, progress=None):
+    """executemany ``rows`` into the model's table in batches, committing each batch"""
+    table = model.__table__
+    batch = []
+    total = 0
+    started = time.perf_counter()
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            db.session.execute(table.insert(), batch)
+            db.session.commit()
+            total += len(batch)
+            batch = []
+            if progress:
+                progress(table.name, total, time.perf_counter() - started)
+    if batch:
+        db.session.execute(table.insert(), batch)
+        db.session.commit()
+        total += len(batch)
+    if progress:
+        progress(table.name, total, time.perf_counter() - started)
+    return total
+
+
+def _copy_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (int, float)):
+        return str(value)
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def copy_insert(model, rows, batch_size=50000, progress=None):
+    """Stream ``rows`` into the model's table with Postgres COPY, committing each batch"""
+    table = model.__table__
+    total = 0
+    started = time.perf_counter()
+    rows = iter(rows)
+    while True:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                break
+        if not batch:
+            break
+
+        columns = list(batch[0])
+        buffer = StringIO()
+        for row in batch:
+            buffer.write(",".join(_copy_value(row[c]) for c in columns))
+            buffer.write("\n")
+        buffer.seek(0)
+
+        cursor = db.session.connection().connection.dbapi_connection.cursor()
+        cursor.copy_expert(f'COPY {table.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)', buffer)
+        db.session.commit()
+        total += len(batch)
+        if progress:
+            progress(table.name, total, time.perf_counter() - started)
+    return total
+
+
+def default_inserter():
+    """COPY on Postgres, executemany everywhere else"""
+    return copy_insert if db.engine.dialect.name == "postgresql" else bulk_insert
+
+
+def reset_sequences(models):
+    """Move Postgres id sequences past the explicitly assigned ids"""
+    if db.engine.dialect.name != "postgresql":
+        return
+    for model in models:
+        table = model.__tablename__
+        db.session.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)"
+        ))
+    db.session.commit()
+
+
+def generate(volumes, seed=42, batch_size=5000, progress=None, inserter=None):
+    """Populate the current app's database. Returns {table name: rows inserted}."""
+    inserter = inserter or default_inserter()
+    rng = random.Random(seed)
+    now = datetime(2026, 1, 1)
+    password = generate_password_hash(PASSWORD, rounds=4).decode("utf-8")
+    inserted = {}
+
+    def insert(model, rows):
+        inserted[model.__tablename__] = inserter(model, rows, batch_size=batch_size, progress=progress)
+
+    def past(days):
+        return now - timedelta(seconds=rng.randint(0, days * 86400))
+
+    # Reference data
+    agency_id = next_id(Agency)
+    insert(Agency, [{"id": agency_id, "name": "Synthetic Realty", "address": "Nairobi", "phone": "0700000000",
+                     "founded_year": "2010"}])
+
+    type_start = next_id(Property_type)
+    type_ids = list(range(type_start, type_start + len(PROPERTY_TYPES)))
+    insert(Property_type, ({"id": i, "name": name} for i, name in zip(type_ids, PROPERTY_TYPES)))
+
+    amenity_start = next_id(Amenity)
+    amenity_ids = list(range(amenity_start, amenity_start + len(AMENITIES)))
+    insert(Amenity, ({"id": i, "name": name} for i, name in zip(amenity_ids, AMENITIES)))
+
+    # Few rows, and they are shared with existing data through the normalized key
+    locations = [
+        {"country": "Kenya", "state": city, "city": city, "neighborhood": neighborhood,
+         "latitude": f"{rng.uniform(-4.5, 0.5):.4f}", "longitude": f"{rng.uniform(34.0, 40.0):.4f}"}
+        for city, neighborhood in NEIGHBORHOODS
+    ]
+    resolved = resolve_locations(locations)
+    db.session.commit()
+    location_ids = [resolved[location_key(*(row[f] for f in LOCATION_FIELDS))] for row in locations]
+
+    # Accounts
+    user_start = next_id(User)
+    agent_user_ids = list(range(user_start, user_start + volumes.agents))
+    user_ids = list(range(user_start + volumes.agents, user_start + volumes.agents + volumes.users))
+
+    def accounts():
+        for i, user_id in enumerate(agent_user_ids + user_ids):
+            role = "agent" if i < volumes.agents else "user"
+            yield {"id": user_id, "first_name": f"{role.title()}{user_id}", "last_name": "Synthetic",
+                   "phone": f"07{user_id:09d}-{seed}", "email": f"{role}{user_id}.{seed}@synthetic.local",
+                   "password": password, "role": role, "is_verified": True, "created_at": past(730)}
+    insert(User, accounts())
+
+    agent_start = next_id(AgentProfile)
+    agent_ids = list(range(agent_start, agent_start + volumes.agents))
+    agent_user = dict(zip(agent_ids, agent_user_ids))
+    insert(AgentProfile, (
+        {"id": agent_id, "user_id": user_id, "license_number": f"SYN-{seed}-{agent_id}", "agency_id": agency_id,
+         "bio": "Synthetic agent", "rating": rng.randint(1, 5)}
+        for agent_id, user_id in zip(agent_ids, agent_user_ids)
+    ))
+
+    profile_start = next_id(UserProfile)
+    profile_ids = list(range(profile_start, profile_start + volumes.users))
+    insert(UserProfile, ({"id": p, "user_id": u} for p, u in zip(profile_ids, user_ids)))
+
+    # Listings
+    property_start = next_id(Property)
+    property_ids = list(range(property_start, property_start + volumes.properties))
+    property_agent = {}
+
+    def properties():
+        for property_id in property_ids:
+            status, listing_type = rng.choice(STATUSES)
+            bedrooms = rng.randint(0, 6)
+            area = rng.randint(30, 60) * (bedrooms + 1)
+            base = rng.randint(20, 120) * 1000 if listing_type != "sale" else rng.randint(30, 900) * 100000
+            agent_id = rng.choice(agent_ids)
+            property_agent[property_id] = agent_id
+            type_index = rng.randrange(len(type_ids))
+            listed = past(730)
+            yield {"id": property_id, "title": f"{bedrooms} Bedroom {PROPERTY_TYPES[type_index]} #{property_id}",
+                   "description": "Synthetic listing", "property_type_id": type_ids[type_index], "agent_id": agent_id,
+                   "price": base, "currency": "KES", "bedrooms": bedrooms, "bathrooms": max(1, bedrooms - rng.randint(0, 1)),
+                   "area_size": area, "area_unit": "sqm", "listing_type": listing_type, "status": status,
+                   "listing_date": listed, "created_at": listed, "updated_at": listed}
+    insert(Property, properties())
+
+    insert(PropertyLocation, (
+        {"property_id": p, "location_id": rng.choice(location_ids)} for p in property_ids
+    ))
+
+    def property_amenities():
+        for p in property_ids:
+            for amenity_id in rng.sample(amenity_ids, rng.randint(0, 4)):
+                yield {"property_id": p, "amenity_id": amenity_id}
+    insert(PropertyAmenity, property_amenities())
+
+    def images():
+        for p in property_ids:
+            for n in range(volumes.images_per_property):
+                yield {"property_id": p, "image_url": f"https://images.synthetic.local/{p}/{n}.jpg", "is_primary": n == 0}
+    insert(PropertyImage, images())
+
+    # Activity
+    def views():
+        slot = now
+        for _ in range(volumes.views):
+            property_id = rng.choice(property_ids)
+            if rng.random() < 0.9:
+                seen = past(365)
+                yield {"property_id": property_id, "user_id": rng.choice(user_ids), "agent_id": None,
+                       "sheduled_time": seen, "status": "viewed", "created_at": seen}
+            else:
+                # Visits get distinct times so they never collide on the pending-slot index
+                slot += timedelta(minutes=30)
+                yield {"property_id": property_id, "user_id": rng.choice(user_ids),
+                       "agent_id": property_agent[property_id], "sheduled_time": slot,
+                       "status": rng.choice(["pending", "completed", "canceled"]), "created_at": past(60)}
+    insert(View, views())
+
+    def inquiries():
+        for _ in range(volumes.inquiries):
+            property_id = rng.choice(property_ids)
+            yield {"user_id": rng.choice(user_ids), "agent_id": property_agent[property_id], "property_id": property_id,
+                   "message": "Is this still available?", "status": rng.choice(["new", "replied", "closed"]),
+                   "created_at": past(365)}
+    insert(Inquiry, inquiries())
+
+    def favorites():
+        seen = set()
+        for _ in range(volumes.favorites):
+            pair = (rng.choice(profile_ids), rng.choice(property_ids))
+            if pair not in seen:
+                seen.add(pair)
+                yield {"user_id": pair[0], "property_id": pair[1], "created_at": past(365)}
+    insert(Favorite, favorites())
+
+    conversation_start = next_id(Conversation)
+    conversation_ids = list(range(conversation_start, conversation_start + volumes.conversations))
+    conversation_user = {}
+
+    def conversations():
+        for conversation_id in conversation_ids:
+            property_id = rng.choice(property_ids)
+            user_id = rng.choice(user_ids)
+            conversation_user[conversation_id] = (user_id, agent_user[property_agent[property_id]])
+            started = past(180)
+            yield {"id": conversation_id, "user_id": user_id, "agent_id": property_agent[property_id],
+                   "property_id": property_id, "last_message": "Thanks", "last_message_at": started, "created_at": started}
+    insert(Conversation, conversations())
+
+    def messages():
+        for conversation_id in conversation_ids:
+            user_id, agent_user_id = conversation_user[conversation_id]
+            for n in range(volumes.messages_per_conversation):
+                from_user = n % 2 == 0
+                yield {"conversation_id": conversation_id, "sender_id": user_id if from_user else agent_user_id,
+                       "sender_type": "user" if from_user else "agent", "content": f"Message {n}",
+                       "is_read": rng.random() < 0.7, "created_at": past(180)}
+    insert(Message, messages())
+
+    reset_sequences([
+        Agency, Property_type, Amenity, Location, User, AgentProfile, UserProfile, Property, PropertyLocation,
+        PropertyAmenity, PropertyImage, View, Inquiry, Favorite, Conversation, Message,
+    ])
+    return inserted
+
+
+def print_progress():
+    """Progress callback printing one line per batch with the running insert rate"""
+    def progress(table, total, elapsed):
+        rate = f"{total / elapsed:,.0f} rows/s" if elapsed > 0 else ""
+        print(f"  {table:<20} {total:>10,} rows  {rate}", flush=True)
+    return progress
@@ -0,0 +1,220 @@
+"""Personalised property feed.
+
+A user's taste is the weighted mean of the feature rows (see
+recommendations.py) of listings they favorited (FEED_FAVORITE_WEIGHT),
+booked a visit for (FEED_VISIT_WEIGHT) or viewed (FEED_VIEW_WEIGHT). Weights
+halve every FEED_HALF_LIFE_DAYS. Canceled visits don't count. ``flask
+build-preferences`` computes these vectors in batches of users and stores
+them in ``user_preferences``. Favoriting, viewing or booking only marks the
+stored vector stale. The "refresh-preferences" job recomputes stale vectors
+in batches every few minutes, so requests never rebuild them. Users with no
+stored vector yet get one built from their history on the fly.
+
+Ranking scores every live listing at once: the distance of each feature row
+to the user's vector, from one matrix-vector product. The best FEED_DEPTH
+ids are cached per user for FEED_CACHE_TTL seconds and pages are sliced
+from them. The feature matrix itself is rebuilt every FEED_CATALOG_TTL
+seconds by one thread while the others keep ranking against the previous
+one. Users without history get the newest listings first.
+"""
+from datetime import datetime
+from flask.cli import with_appcontext
+from sqlalchemy import delete, insert, literal, select, union, update
+from models import db, Favorite, UserProfile, View, UserPreference
+from recommendations import load_listings, build_feature_matrix, property_cards
+import click
+import numpy as np
+import os
+import threading
+import time
+
+FEED_FAVORITE_WEIGHT = float(os.getenv("FEED_FAVORITE_WEIGHT", 3.0))
+FEED_VISIT_WEIGHT = float(os.getenv("FEED_VISIT_WEIGHT", 2.0))
+FEED_VIEW_WEIGHT = float(os.getenv("FEED_VIEW_WEIGHT", 1.0))
+FEED_HALF_LIFE_DAYS = float(os.getenv("FEED_HALF_LIFE_DAYS", 60))
+FEED_CACHE_TTL = float(os.getenv("FEED_CACHE_TTL", 120))
+FEED_CATALOG_TTL = float(os.getenv("FEED_CATALOG_TTL", 300))
+# Listings kept per cached feed; the feed ends there
+FEED_DEPTH = int(os.getenv("FEED_DEPTH", 500))
+FEED_BATCH_USERS = 500
+_FEED_CACHE_SIZE = 5000
+
+# (expires at, FeatureMatrix, {property id: row}, {column: index})
+_catalog = None
+# user id -> (expires at, ranked property ids, personalised)
+_feeds = {}
+_lock = threading.Lock()
+_catalog_lock = threading.Lock()
+
+
+def catalog():
+    """Feature matrix of the live listings, rebuilt by one thread when FEED_CATALOG_TTL runs out"""
+    global _catalog
+    current = _catalog
+    if current and current[0] > time.monotonic():
+        return current[1:]
+    # Only the first build makes callers wait; later ones keep serving the old matrix
+    if not _catalog_lock.acquire(blocking=current is None):
+        return current[1:]
+    try:
+        current = _catalog
+        if current and current[0] > time.monotonic():
+            return current[1:]
+        features = build_feature_matrix(load_listings())
+        rows = {property_id: i for i, property_id in enumerate(features.ids.tolist())}
+        columns = {name: i for i, name in enumerate(features.columns)}
+        _catalog = (time.monotonic() + FEED_CATALOG_TTL, features, rows, columns)
+        return _catalog[1:]
+    finally:
+        _catalog_lock.release()
+
+
+def forget_feed(user_id):
+    """Drop a user's cached feed and mark their stored vector stale; call inside the transaction that records the interaction"""
+    with _lock:
+        _feeds.pop(int(user_id), None)
+    db.session.execute(
+        update(UserPreference)
+        .where(UserPreference.user_id == user_id, UserPreference.stale.is_(False))
+        .values(stale=True)
+    )
+
+
+def interactions(user_ids, now=None):
+    """(user ids, property ids, weights) arrays for every favorite, visit and view of ``user_ids``"""
+    now = now or datetime.now()
+    favorites = (
+        select(UserProfile.user_id, Favorite.property_id, Favorite.created_at, literal("favorite").label("kind"))
+        .join(UserProfile, UserProfile.id == Favorite.user_id)
+        .where(UserProfile.user_id.in_(user_ids))
+    )
+    views = (
+        select(View.user_id, View.property_id, View.created_at, View.status)
+        .where(View.user_id.in_(user_ids), View.status != "canceled")
+    )
+    rows = db.session.execute(favorites.union_all(views)).all()
+
+    weights = {"favorite": FEED_FAVORITE_WEIGHT, "viewed": FEED_VIEW_WEIGHT}
+    users = np.array([row[0] for row in rows], dtype=np.int64)
+    properties = np.array([row[1] for row in rows], dtype=np.int64)
+    age_days = np.array([(now - (row[2] or now)).total_seconds() / 86400 for row in rows], dtype=np.float64)
+    kind = np.array([weights.get(row[3], FEED_VISIT_WEIGHT) for row in rows], dtype=np.float64)
+    return users, properties, kind * 0.5 ** (np.maximum(age_days, 0) / FEED_HALF_LIFE_DAYS)
+
+
+def preference_vectors(user_ids, now=None):
+    """{user id: (vector, interactions)} for the users in ``user_ids`` with history among live listings"""
+    features, rows, _ = catalog()
+    users, properties, weights = interactions(user_ids, now)
+    known = np.array([property_id in rows for property_id in properties.tolist()], dtype=bool)
+    if not known.any():
+        return {}
+    users, properties, weights = users[known], properties[known], weights[known]
+
+    user_index, user_pos = np.unique(users, return_inverse=True)
+    property_pos = np.array([rows[property_id] for property_id in properties.tolist()], dtype=np.int64)
+    sums = np.zeros((len(user_index), features.matrix.shape[1]), dtype=np.float64)
+    np.add.at(sums, user_pos, features.matrix[property_pos] * weights[:, None])
+    totals = np.bincount(user_pos, weights=weights)
+    counts = np.bincount(user_pos)
+    vectors = sums / totals[:, None]
+    return {int(u): (vectors[i], int(counts[i])) for i, u in enumerate(user_index.tolist())}
+
+
+def encode_vector(vector):
+    """Sparse {column name: value} form of a vector over the current catalog columns"""
+    features, _, _ = catalog()
+    return {name: round(float(v), 5) for name, v in zip(features.columns, vector.tolist()) if v}
+
+
+def decode_vector(stored):
+    """Vector over the current catalog columns; categories that disappeared are dropped"""
+    _, _, columns = catalog()
+    vector = np.zeros(len(columns), dtype=np.float32)
+    for name, value in stored.items():
+        if name in columns:
+            vector[columns[name]] = value
+    return vector
+
+
+def build_preferences(batch_size=FEED_BATCH_USERS, stale_only=False):
+    """Recompute stored vectors for every user with history, or only the stale ones. Returns how many were stored."""
+    if stale_only:
+        user_ids = sorted(db.session.scalars(select(UserPreference.user_id).where(UserPreference.stale.is_(True))))
+    else:
+        user_ids = sorted(db.session.scalars(union(
+            select(UserProfile.user_id).join(Favorite, Favorite.user_id == UserProfile.id),
+            select(View.user_id).where(View.status != "canceled"),
+        )))
+    stored = 0
+    for start in range(0, len(user_ids), batch_size):
+        batch = user_ids[start:start + batch_size]
+        vectors = preference_vectors(batch)
+        db.session.execute(delete(UserPreference).where(UserPreference.user_id.in_(batch)))
+        if vectors:
+            db.session.execute(insert(UserPreference), [
+                {"user_id": user_id, "vector": encode_vector(vector), "interactions": n,
+                 "updated_at": datetime.now()}
+                for user_id, (vector, n) in vectors.items()
+            ])
+        db.session.commit()
+        stored += len(vectors)
+    return stored
+
+
+def user_vector(user_id):
+    """A user's stored vector, or one built from their history; None for users without history"""
+    stored = db.session.scalar(select(UserPreference.vector).where(UserPreference.user_id == user_id))
+    if stored is not None:
+        return decode_vector(stored)
+    vector = preference_vectors([user_id]).get(user_id)
+    return vector[0] if vector else None
+
+
+def ranked_ids(user_id):
+    """(property ids best first, personalised) for a user, cached for FEED_CACHE_TTL"""
+    user_id = int(user_id)
+    now = time.monotonic()
+    with _lock:
+        cached = _feeds.get(user_id)
+    if cached and cached[0] > now:
+        return cached[1], cached[2]
+
+    features, _, _ = catalog()
+    vector = user_vector(user_id)
+    if vector is None or not len(features.ids):
+        # Newest first; listing ids grow with listing time
+        ranked, personalised = features.ids[::-1][:FEED_DEPTH].copy(), False
+    else:
+        matrix = features.matrix
+        distances = (matrix * matrix).sum(axis=1) - 2 * (matrix @ vector) + vector @ vector
+        # Only the first FEED_DEPTH are ever served, so only they are sorted and cached
+        top = np.argpartition(distances, FEED_DEPTH - 1)[:FEED_DEPTH] if len(distances) > FEED_DEPTH \
+            else np.arange(len(distances))
+        ids = features.ids[top]
+        ranked, personalised = ids[np.lexsort((-ids, distances[top]))], True
+
+    with _lock:
+        if len(_feeds) >= _FEED_CACHE_SIZE:
+            _feeds.clear()
+        _feeds[user_id] = (now + FEED_CACHE_TTL, ranked, personalised)
+    return ranked, personalised
+
+
+def feed_page(user_id, offset, limit):
+    """(cards, next offset or None, personalised) for one page of a user's feed"""
+    ranked, personalised = ranked_ids(user_id)
+    page = ranked[offset:offset + limit].tolist()
+    next_offset = offset + limit if offset + limit < len(ranked) else None
+    return property_cards(page), next_offset, personalised
+
+
+@click.command("build-preferences")
+@click.option("--batch-size", default=FEED_BATCH_USERS, help="users per batch")
+@click.option("--stale", is_flag=True, help="only recompute vectors marked stale by new interactions")
+@with_appcontext
+def build_preferences_command(batch_size, stale):
+    """Recompute every user's feed preference vector."""
+    started = time.perf_counter()
+    stored = build_preferences(batch_size, stale_only=stale)
+    click.echo(f"Stored {stored} preference vectors in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,140 @@
+"""Per-request SQL instrumentation.
+
+Every statement executed while serving a request is counted and timed, and
+grouped by its shape (the SQL text with IN-lists collapsed). A shape repeated
+QUERY_REPEAT_THRESHOLD times or more in one request is almost always an N+1
+loop and is logged as a warning. Each response gets a ``Server-Timing``
+header with the DB time, query count and total time.
+
+Tests can pin query budgets with ``assert_queries``::
+
+    with assert_queries(max_queries=3, max_repeats=1):
+        client.get("/user/scheduled-visits", headers=headers)
+
+Set QUERY_PROFILER=0 to disable the request hooks.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+QUERY_REPEAT_THRESHOLD = int(os.getenv("QUERY_REPEAT_THRESHOLD", 5))
+
+_IN_LIST = re.compile(r"\(\s*(?:\?|%\(\w+\)s|%s|:\w+)(?:\s*,\s*(?:\?|%\(\w+\)s|%s|:\w+))*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def statement_shape(statement):
+    """Normalise a statement so the same query with different parameters compares equal"""
+    return _IN_LIST.sub("(?)", _WHITESPACE.sub(" ", statement).strip())
+
+
+class QueryStats:
+    """Queries seen during one request or one ``count_queries`` block"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold=QUERY_REPEAT_THRESHOLD):
+        """Statement shapes executed at least ``threshold`` times, most repeated first"""
+        return [(shape, n) for shape, n in self.shapes.most_common() if n >= threshold]
+
+
+# Collectors opened with count_queries(), shared by all threads so queries run
+# by the Flask test client are seen by the test that opened them
+_collectors = []
+_collectors_lock = threading.Lock()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("query_start")
+    if not starts:
+        return
+    duration = time.perf_counter() - starts.pop()
+
+    if has_request_context():
+        stats = g.get("query_stats")
+        if stats is not None:
+            stats.record(statement, duration)
+    if _collectors:
+        with _collectors_lock:
+            for stats in _collectors:
+                stats.record(statement, duration)
+
+
+@contextmanager
+def count_queries():
+    """Collect every statement executed inside the block, in any thread"""
+    stats = QueryStats()
+    with _collectors_lock:
+        _collectors.append(stats)
+    try:
+        yield stats
+    finally:
+        with _collectors_lock:
+            _collectors.remove(stats)
+
+
+@contextmanager
+def assert_queries(max_queries=None, max_repeats=None):
+    """Fail when the block runs more than ``max_queries`` statements or repeats one shape more than ``max_repeats`` times"""
+    with count_queries() as stats:
+        yield stats
+
+    problems = []
+    if max_queries is not None and stats.count > max_queries:
+        problems.append(f"{stats.count} queries executed, expected at most {max_queries}")
+    if max_repeats is not None:
+        for shape, n in stats.repeated(max_repeats + 1):
+            problems.append(f"{n}x {shape}")
+    if problems:
+        raise AssertionError("Query budget exceeded:\n  " + "\n  ".join(problems))
+
+
+def init_query_profiler(app):
+    """Register the per-request hooks that fill g.query_stats and emit Server-Timing"""
+    if os.getenv("QUERY_PROFILER", "1").strip().lower() in ("0", "false", "no", "off"):
+        return
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def finish_query_stats(response):
+        stats = g.get("query_stats")
+        if stats is None:
+            return response
+
+        total = (time.perf_counter() - g.request_started) * 1000
+        response.headers.add(
+            "Server-Timing",
+            f'db;dur={stats.duration * 1000:.2f};desc="{stats.count} queries", total;dur={total:.2f}',
+        )
+
+        for shape, n in stats.repeated():
+            logger.warning("Possible N+1 on %s %s: %d executions of %s", request.method, request.path, n, shape)
+
+        return response
@@ -0,0 +1,253 @@
+"""Background jobs on a database queue.
+
+Work is queued with enqueue(), which adds a ``jobs`` row inside the
+caller's transaction. The job therefore exists exactly when the write it
+belongs to committed, and nothing has to happen "after commit". Handlers
+are registered with ``@task`` (see tasks.py). Each gets its payload as
+keyword arguments and runs in its own transaction.
+
+Workers claim runnable jobs in batches. A job is runnable when it is queued
+and due, or when it is running but its visibility timeout expired because
+the worker died. On Postgres the candidates are selected with SKIP LOCKED,
+so workers never wait on each other. Each claim is then a conditional UPDATE
+whose row count says who won, which is also what makes SQLite safe. A failed
+job is retried with exponential backoff and jitter until it runs out of
+attempts, after which it stays ``failed`` with its last error. Jobs enqueued
+with an idempotency key exist at most once.
+
+Run ``flask worker`` processes in production (with JOBS_IN_PROCESS=false).
+Locally, web processes start an embedded worker thread on the first commit
+that queues a job, so SQLite setups work without a separate process.
+
+    JOBS_IN_PROCESS       run jobs in a thread of the web process (default: true)
+    JOB_POLL_INTERVAL     seconds between polls of an idle queue (default: 1)
+    JOB_BACKOFF_BASE      first retry delay in seconds, doubled per attempt (default: 5)
+    JOB_BACKOFF_MAX       longest retry delay in seconds (default: 3600)
+    JOB_KEEP_DAYS         finished jobs are pruned after this many days (default: 7)
+"""
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from flask import current_app, has_app_context
+from sqlalchemy import and_, delete, event, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from database import RoutingSession
+from models import db, Job
+import logging
+import os
+import random
+import socket
+import threading
+import traceback
+
+logger = logging.getLogger(__name__)
+
+JOBS_IN_PROCESS = os.getenv("JOBS_IN_PROCESS", "true").lower() == "true"
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 1))
+JOB_BACKOFF_BASE = float(os.getenv("JOB_BACKOFF_BASE", 5))
+JOB_BACKOFF_MAX = float(os.getenv("JOB_BACKOFF_MAX", 3600))
+JOB_KEEP_DAYS = int(os.getenv("JOB_KEEP_DAYS", 7))
+JOB_CLAIM_BATCH = 10
+
+
+@dataclass
+class Task:
+    name: str
+    handler: object
+    max_attempts: int
+    timeout: int
+
+
+_tasks = {}
+
+
+def task(name, max_attempts=5, timeout=300):
+    """Register a job handler; ``timeout`` (seconds) is how long a claim lasts before another worker may retry"""
+    def register(handler):
+        _tasks[name] = Task(name, handler, max_attempts, timeout)
+        return handler
+    return register
+
+
+def enqueue(name, payload=None, key=None, delay=0, run_at=None):
+    """Queue a job in the current transaction. Returns the job, or None if ``key`` was already queued."""
+    job = Job(
+        name=name,
+        payload=payload or {},
+        idempotency_key=key,
+        status="queued",
+        attempts=0,
+        run_at=run_at or datetime.now() + timedelta(seconds=delay),
+    )
+    if key is None:
+        db.session.add(job)
+    else:
+        try:
+            with db.session.begin_nested():
+                db.session.add(job)
+        except IntegrityError:
+            return None
+    db.session.info["jobs_queued"] = True
+    return job
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _wake_embedded_worker(session):
+    if session.info.pop("jobs_queued", False) and JOBS_IN_PROCESS and has_app_context():
+        embedded_worker().wake(current_app._get_current_object())
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _discard_queued(session):
+    session.info.pop("jobs_queued", None)
+
+
+def _claimable(now):
+    return or_(
+        and_(Job.status == "queued", Job.run_at <= now),
+        and_(Job.status == "running", Job.locked_until < now),
+    )
+
+
+def claim(worker_id, limit=JOB_CLAIM_BATCH):
+    """Claim up to ``limit`` runnable jobs for ``worker_id``. Returns their ids."""
+    now = datetime.now()
+    candidates = db.session.execute(
+        select(Job.id, Job.name)
+        .where(_claimable(now))
+        .order_by(Job.run_at, Job.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    ).all()
+
+    claimed = []
+    for job_id, name in candidates:
+        timeout = _tasks[name].timeout if name in _tasks else 60
+        result = db.session.execute(
+            update(Job)
+            .where(Job.id == job_id, _claimable(now))
+            .values(status="running", locked_by=worker_id, locked_until=now + timedelta(seconds=timeout),
+                    attempts=Job.attempts + 1),
+            execution_options={"synchronize_session": False},
+        )
+        if result.rowcount:
+            claimed.append(job_id)
+    db.session.commit()
+    return claimed
+
+
+def backoff(attempts):
+    """Seconds before retry number ``attempts``, with +-20% jitter"""
+    delay = min(JOB_BACKOFF_BASE * 2 ** (attempts - 1), JOB_BACKOFF_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _finish(job_id, worker_id, **values):
+    # Only the current claimant may settle the job
+    db.session.execute(
+        update(Job).where(Job.id == job_id, Job.locked_by == worker_id, Job.status == "running")
+        .values(locked_by=None, locked_until=None, **values),
+        execution_options={"synchronize_session": False},
+    )
+    db.session.commit()
+
+
+def run_job(job_id, worker_id):
+    """Run a claimed job and record the outcome. Returns the final status."""
+    job = db.session.get(Job, job_id)
+    name, payload, attempts = job.name, dict(job.payload or {}), job.attempts
+    db.session.commit()
+
+    registered = _tasks.get(name)
+    if registered is None:
+        _finish(job_id, worker_id, status="failed", last_error=f"Unknown task {name!r}", finished_at=datetime.now())
+        return "failed"
+    if attempts > registered.max_attempts:
+        _finish(job_id, worker_id, status="failed", last_error="Timed out on every attempt", finished_at=datetime.now())
+        return "failed"
+
+    try:
+        registered.handler(**payload)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        error = traceback.format_exc(limit=5)
+        if attempts >= registered.max_attempts:
+            logger.error("Job %s (%s) failed for good after %d attempts", job_id, name, attempts)
+            _finish(job_id, worker_id, status="failed", last_error=error, finished_at=datetime.now())
+            return "failed"
+        logger.warning("Job %s (%s) failed, attempt %d of %d", job_id, name, attempts, registered.max_attempts)
+        _finish(job_id, worker_id, status="queued", last_error=error,
+                run_at=datetime.now() + timedelta(seconds=backoff(attempts)))
+        return "queued"
+
+    _finish(job_id, worker_id, status="done", last_error=None, finished_at=datetime.now())
+    return "done"
+
+
+def work(worker_id, limit=JOB_CLAIM_BATCH):
+    """Claim and run one batch. Returns how many jobs ran."""
+    claimed = claim(worker_id, limit)
+    for job_id in claimed:
+        run_job(job_id, worker_id)
+    return len(claimed)
+
+
+def prune_jobs(now=None):
+    """Delete finished jobs older than JOB_KEEP_DAYS. Returns how many were deleted."""
+    cutoff = (now or datetime.now()) - timedelta(days=JOB_KEEP_DAYS)
+    result = db.session.execute(
+        delete(Job).where(Job.status.in_(("done", "failed")), Job.finished_at < cutoff),
+        execution_options={"synchronize_session": False},
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def new_worker_id(suffix=""):
+    return f"{socket.gethostname()}:{os.getpid()}{suffix}"
+
+
+class EmbeddedWorker:
+    """Daemon thread that runs jobs inside a web process; woken by commits that queue jobs"""
+
+    def __init__(self):
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.worker_id = new_worker_id(":embedded")
+
+    def wake(self, app):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, args=(app,), name="job-worker", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _loop(self, app):
+        while True:
+            self._wakeup.wait(JOB_POLL_INTERVAL)
+            self._wakeup.clear()
+            with app.app_context():
+                try:
+                    while work(self.worker_id):
+                        pass
+                except Exception:
+                    logger.exception("Embedded job worker failed, retrying on the next poll")
+                finally:
+                    db.session.remove()
+
+
+_embedded = None
+_embedded_pid = None
+_embedded_lock = threading.Lock()
+
+
+def embedded_worker():
+    """Per-process worker thread, created lazily so gunicorn workers don't inherit dead threads"""
+    global _embedded, _embedded_pid
+    if _embedded is None or _embedded_pid != os.getpid():
+        with _embedded_lock:
+            if _embedded is None or _embedded_pid != os.getpid():
+                _embedded = EmbeddedWorker()
+                _embedded_pid = os.getpid()
+    return _embedded
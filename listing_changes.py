@@ -0,0 +1,37 @@
+"""The one hook every listing write calls.
+
+Creating, editing, importing, archiving and deleting listings call
+listings_changed() with the ids they touched, before committing. It queues
+everything that is derived from the properties table, in the same
+transaction:
+
+* a market stats refresh of the segments the listings were in before the
+  write (passed in by the caller) and are in now (see market_stats.py)
+* saved search matching for the listings that are still live
+  (see saved_searches.py)
+* a catalog change per listing, replayed by the catalog snapshots
+  (see catalog.py)
+
+A new derived view of the listings gets its hook added here rather than at
+every write path.
+"""
+from sqlalchemy import select
+from models import db, Property
+from market_stats import segments, queue_segment_refresh
+from saved_searches import queue_listing_matches
+from catalog import record_listing_changes
+
+LOOKUP_BATCH_SIZE = 500
+
+
+def listings_changed(property_ids, touched_segments=()):
+    """Queue the follow-up work for listings written in the current transaction; call after flushing the write"""
+    property_ids = list(property_ids)
+    touched, live = set(touched_segments), []
+    for start in range(0, len(property_ids), LOOKUP_BATCH_SIZE):
+        batch = property_ids[start:start + LOOKUP_BATCH_SIZE]
+        touched |= segments(Property.id.in_(batch))
+        live += db.session.scalars(select(Property.id).where(Property.id.in_(batch), Property.archived_at.is_(None)))
+    queue_segment_refresh(touched)
+    queue_listing_matches(live)
+    record_listing_changes(property_ids)
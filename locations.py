@@ -0,0 +1,156 @@
+"""Location normalisation and interning.
+
+Every location is identified by ``locations.normalized_key``, built from
+country/state/city/neighborhood after trimming, collapsing whitespace and
+lowercasing. A unique index on the key makes "Karen, Nairobi" one row no
+matter how many listings point at it. A missing country defaults to
+LOCATION_DEFAULT_COUNTRY and a missing state defaults to the city, matching
+how the seed data is laid out.
+
+``resolve_location`` returns the id for a location, creating the row if
+needed. Ids are interned per process, so repeat lookups do not touch the
+database. Ids created in a transaction are only cached once that
+transaction commits.
+
+Existing databases get the column from an Alembic revision (``flask db
+upgrade``), which also merges duplicate rows into the oldest one, repoints
+property_locations and then creates the unique index.
+"""
+from sqlalchemy import event, select
+from sqlalchemy.exc import IntegrityError
+from database import RoutingSession
+from models import db, Location
+import os
+import re
+
+LOCATION_DEFAULT_COUNTRY = os.getenv("LOCATION_DEFAULT_COUNTRY", "Kenya")
+LOCATION_FIELDS = ("country", "state", "city", "neighborhood")
+
+_WHITESPACE = re.compile(r"\s+")
+
+# normalized key -> location id, for committed rows only
+_location_ids = {}
+_LOCATION_CACHE_SIZE = int(os.getenv("LOCATION_CACHE_SIZE", 10000))
+
+
+def clean(value):
+    """Trim and collapse whitespace; empty strings become None"""
+    if value is None:
+        return None
+    value = _WHITESPACE.sub(" ", str(value)).strip()
+    return value or None
+
+
+def normalize(country=None, state=None, city=None, neighborhood=None):
+    """Cleaned (country, state, city, neighborhood) with defaults filled in"""
+    country, state, city, neighborhood = (clean(v) for v in (country, state, city, neighborhood))
+    return country or LOCATION_DEFAULT_COUNTRY, state or city, city, neighborhood
+
+
+def location_key(country=None, state=None, city=None, neighborhood=None):
+    """Unique key for a location, or None when there is no city or neighborhood"""
+    parts = normalize(country, state, city, neighborhood)
+    if not parts[2] and not parts[3]:
+        return None
+    return "|".join((part or "").lower() for part in parts)
+
+
+@event.listens_for(Location, "before_insert")
+@event.listens_for(Location, "before_update")
+def _set_normalized_key(mapper, connection, location):
+    location.normalized_key = location_key(location.country, location.state, location.city, location.neighborhood)
+
+
+def _remember(session, key, location_id):
+    session.info.setdefault("new_location_ids", {})[key] = location_id
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _cache_committed(session):
+    for key, location_id in session.info.pop("new_location_ids", {}).items():
+        cache_location_id(key, location_id)
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _discard_rolled_back(session):
+    session.info.pop("new_location_ids", None)
+
+
+def cache_location_id(key, location_id):
+    if len(_location_ids) >= _LOCATION_CACHE_SIZE:
+        _location_ids.clear()
+    _location_ids[key] = location_id
+
+
+def forget_locations():
+    """Drop the interning cache, e.g. after locations were merged or deleted"""
+    _location_ids.clear()
+
+
+def resolve_location(country=None, state=None, city=None, neighborhood=None, latitude=None, longitude=None):
+    """Id of the matching location, creating it if needed. None without a city or neighborhood."""
+    key = location_key(country, state, city, neighborhood)
+    if key is None:
+        return None
+
+    location_id = _location_ids.get(key) or db.session.info.get("new_location_ids", {}).get(key)
+    if location_id is not None:
+        return location_id
+
+    location_id = db.session.scalar(select(Location.id).where(Location.normalized_key == key))
+    if location_id is not None:
+        cache_location_id(key, location_id)
+        return location_id
+
+    country, state, city, neighborhood = normalize(country, state, city, neighborhood)
+    location = Location(country=country, state=state, city=city, neighborhood=neighborhood,
+                        latitude=clean(latitude), longitude=clean(longitude))
+    try:
+        # Savepoint so losing a race with another request only undoes this insert
+        with db.session.begin_nested():
+            db.session.add(location)
+    except IntegrityError:
+        location_id = db.session.scalar(select(Location.id).where(Location.normalized_key == key))
+        cache_location_id(key, location_id)
+        return location_id
+
+    _remember(db.session, key, location.id)
+    return location.id
+
+
+def resolve_locations(rows):
+    """Map location_key -> id for many location dicts with one SELECT and one INSERT"""
+    wanted = {}
+    ids = {}
+    for row in rows:
+        key = location_key(*(row.get(field) for field in LOCATION_FIELDS))
+        if key is None or key in wanted or key in ids:
+            continue
+        cached = _location_ids.get(key) or db.session.info.get("new_location_ids", {}).get(key)
+        if cached is not None:
+            ids[key] = cached
+        else:
+            wanted[key] = row
+    if not wanted:
+        return ids
+
+    for location_id, key in db.session.execute(
+        select(Location.id, Location.normalized_key).where(Location.normalized_key.in_(list(wanted)))
+    ):
+        ids[key] = location_id
+        cache_location_id(key, location_id)
+
+    new_locations = {}
+    for key, row in wanted.items():
+        if key in ids:
+            continue
+        country, state, city, neighborhood = normalize(*(row.get(field) for field in LOCATION_FIELDS))
+        new_locations[key] = Location(country=country, state=state, city=city, neighborhood=neighborhood,
+                                      latitude=clean(row.get("latitude")), longitude=clean(row.get("longitude")))
+    if new_locations:
+        db.session.add_all(new_locations.values())
+        db.session.flush()
+        for key, location in new_locations.items():
+            ids[key] = location.id
+            _remember(db.session, key, location.id)
+    return ids
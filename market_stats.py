@@ -0,0 +1,271 @@
+"""Market statistics served from a rollup.
+
+``market_stats`` has one row per cell. A cell is a listing type, property
+type, location and listing month. Each row covers the live listings in its
+cell and holds:
+
+* the count, price sum, area sum and the sum of listing days (used for
+  days on market)
+* sparse histograms of price and price per area over log-spaced buckets
+
+Histograms add up, so any grouping (city, neighborhood, property type,
+listing type, month) over any range of months is answered by summing cells.
+Percentiles for every group are then read off the cumulative histograms at
+once. Inside a bucket the value is interpolated on the log scale. With
+MARKET_BUCKETS_PER_DECADE buckets per factor of ten, a percentile is within
+about 3% of the exact value.
+
+Writes keep the rollup current. Creating, editing, deleting and importing
+listings, and archival, call listings_changed() (see listing_changes.py),
+which calls queue_segment_refresh() for each segment (listing type,
+property type, location) they touched. This queues a background job in the
+same transaction (see jobs.py), which recomputes every month cell of those
+segments from the properties table. When two refreshes of a segment collide
+the job fails and is retried with backoff. ``flask market-stats`` rebuilds
+everything, e.g. after bulk seeding or as a nightly safety net.
+"""
+from datetime import date, datetime
+from flask.cli import with_appcontext
+from sqlalchemy import delete, func, insert, select, true, tuple_
+from models import db, Property, PropertyLocation, Location, Property_type, MarketStat
+from jobs import enqueue
+import click
+import numpy as np
+
+MARKET_BUCKETS_PER_DECADE = 40
+# (lowest power of ten, decades) covered by each histogram; values outside are clamped
+PRICE_SCALE = (2, 9)
+PRICE_PER_AREA_SCALE = (-1, 9)
+SEGMENT_BATCH = 200
+INSERT_BATCH_SIZE = 5000
+
+GROUPINGS = {
+    "listing_type": MarketStat.listing_type,
+    "property_type": Property_type.name,
+    "city": Location.city,
+    "neighborhood": Location.neighborhood,
+    "month": MarketStat.month,
+}
+
+
+def _location_id():
+    """A property's first location id, 0 when it has none"""
+    return func.coalesce(
+        select(PropertyLocation.location_id)
+        .where(PropertyLocation.property_id == Property.id)
+        .order_by(PropertyLocation.id)
+        .limit(1)
+        .scalar_subquery(),
+        0,
+    )
+
+
+def segments(condition):
+    """{(listing type, property type id, location id)} of the properties matching ``condition``"""
+    return set(db.session.execute(
+        select(Property.listing_type, Property.property_type_id, _location_id()).where(condition)
+    ).all())
+
+
+def _buckets(values, scale):
+    low, decades = scale
+    positions = np.floor((np.log10(np.maximum(values, 1e-12)) - low) * MARKET_BUCKETS_PER_DECADE)
+    return np.clip(positions, 0, decades * MARKET_BUCKETS_PER_DECADE - 1).astype(np.int64)
+
+
+def _histograms(cells, values, scale, n_cells):
+    """One sparse {bucket: count} histogram per cell"""
+    histograms = [{} for _ in range(n_cells)]
+    width = scale[1] * MARKET_BUCKETS_PER_DECADE
+    codes, counts = np.unique(cells * width + _buckets(values, scale), return_counts=True)
+    for code, count in zip(codes.tolist(), counts.tolist()):
+        histograms[code // width][str(code % width)] = count
+    return histograms
+
+
+def compute_cells(condition):
+    """market_stats rows for the live listings matching ``condition``"""
+    rows = db.session.execute(
+        select(
+            Property.listing_type, Property.property_type_id, _location_id(), Property.listing_date,
+            Property.price, Property.area_size,
+        ).where(Property.archived_at.is_(None), condition)
+    ).all()
+    if not rows:
+        return []
+
+    keys = {}
+    cells = np.empty(len(rows), dtype=np.int64)
+    for i, row in enumerate(rows):
+        key = (row[0], row[1], row[2], date(row.listing_date.year, row.listing_date.month, 1))
+        cells[i] = keys.setdefault(key, len(keys))
+    n = len(keys)
+
+    price = np.array([row.price or 0 for row in rows], dtype=np.float64)
+    area = np.array([row.area_size or 0 for row in rows], dtype=np.float64)
+    listed_day = np.array([row.listing_date.toordinal() for row in rows], dtype=np.float64)
+    has_area = (area > 0) & (price > 0)
+
+    listings = np.bincount(cells, minlength=n)
+    price_sum = np.bincount(cells, weights=price, minlength=n)
+    listed_day_sum = np.bincount(cells, weights=listed_day, minlength=n)
+    area_listings = np.bincount(cells[has_area], minlength=n)
+    area_sum = np.bincount(cells[has_area], weights=area[has_area], minlength=n)
+    price_histograms = _histograms(cells, price, PRICE_SCALE, n)
+    price_per_area_histograms = _histograms(
+        cells[has_area], price[has_area] / area[has_area], PRICE_PER_AREA_SCALE, n
+    )
+
+    now = datetime.now()
+    return [
+        {
+            "listing_type": key[0], "property_type_id": key[1], "location_id": key[2], "month": key[3],
+            "listings": int(listings[i]), "price_sum": float(price_sum[i]),
+            "area_listings": int(area_listings[i]), "area_sum": float(area_sum[i]),
+            "listed_day_sum": float(listed_day_sum[i]),
+            "price_histogram": price_histograms[i], "price_per_area_histogram": price_per_area_histograms[i],
+            "updated_at": now,
+        }
+        for key, i in keys.items()
+    ]
+
+
+def refresh_segments(touched):
+    """Recompute every cell of the given segments in the current transaction"""
+    touched = list(touched)
+    for start in range(0, len(touched), SEGMENT_BATCH):
+        batch = touched[start:start + SEGMENT_BATCH]
+        cells = compute_cells(tuple_(Property.listing_type, Property.property_type_id, _location_id()).in_(batch))
+        # An IntegrityError from a concurrent refresh of the same cells propagates so the job is retried
+        db.session.execute(delete(MarketStat).where(
+            tuple_(MarketStat.listing_type, MarketStat.property_type_id, MarketStat.location_id).in_(batch)
+        ))
+        if cells:
+            db.session.execute(insert(MarketStat), cells)
+
+
+def queue_segment_refresh(touched):
+    """Refresh the given segments in a background job queued in the current transaction"""
+    if touched:
+        enqueue("refresh-market-segments", {"segments": [list(segment) for segment in touched]})
+
+
+def rebuild_market_stats():
+    """Recompute the whole rollup in one transaction. Returns the number of cells."""
+    cells = compute_cells(true())
+    db.session.execute(delete(MarketStat))
+    for start in range(0, len(cells), INSERT_BATCH_SIZE):
+        db.session.execute(insert(MarketStat), cells[start:start + INSERT_BATCH_SIZE])
+    db.session.commit()
+    return len(cells)
+
+
+def _merge(groups, histograms, scale, n_groups):
+    """Dense (groups x buckets) matrix of summed sparse histograms"""
+    merged = np.zeros((n_groups, scale[1] * MARKET_BUCKETS_PER_DECADE), dtype=np.float64)
+    group_index, bucket_index, counts = [], [], []
+    for group, histogram in zip(groups, histograms):
+        for bucket, count in (histogram or {}).items():
+            group_index.append(group)
+            bucket_index.append(int(bucket))
+            counts.append(count)
+    np.add.at(merged, (np.array(group_index, dtype=np.int64), np.array(bucket_index, dtype=np.int64)), counts)
+    return merged
+
+
+def percentiles(histograms, quantiles, scale):
+    """{quantile: array of values per row} from a (groups x buckets) histogram matrix; NaN for empty rows"""
+    cumulative = np.cumsum(histograms, axis=1)
+    totals = cumulative[:, -1]
+    rows = np.arange(len(histograms))
+    result = {}
+    for q in quantiles:
+        target = q * totals
+        bucket = np.minimum((cumulative < target[:, None]).sum(axis=1), histograms.shape[1] - 1)
+        before = np.where(bucket > 0, cumulative[rows, np.maximum(bucket - 1, 0)], 0)
+        inside = histograms[rows, bucket]
+        fraction = np.divide(target - before, inside, out=np.full(len(rows), 0.5), where=inside > 0)
+        values = 10 ** (scale[0] + (bucket + fraction) / MARKET_BUCKETS_PER_DECADE)
+        result[q] = np.where(totals > 0, values, np.nan)
+    return result
+
+
+def _number(value, digits=0):
+    if value is None or np.isnan(value):
+        return None
+    return round(float(value), digits) if digits else int(round(float(value)))
+
+
+def market_stats(group_by, first_month=None, last_month=None, listing_type=None, property_type=None, city=None,
+                 neighborhood=None):
+    """Stats per group for listings listed between two months (inclusive), largest groups first"""
+    columns = [GROUPINGS[name] for name in group_by]
+    query = (
+        select(MarketStat, *columns)
+        .outerjoin(Location, Location.id == MarketStat.location_id)
+        .outerjoin(Property_type, Property_type.id == MarketStat.property_type_id)
+    )
+    if first_month:
+        query = query.where(MarketStat.month >= first_month)
+    if last_month:
+        query = query.where(MarketStat.month <= last_month)
+    if listing_type:
+        query = query.where(func.lower(MarketStat.listing_type) == listing_type.lower())
+    if property_type:
+        query = query.where(func.lower(Property_type.name) == property_type.lower())
+    if city:
+        query = query.where(func.lower(Location.city) == city.lower())
+    if neighborhood:
+        query = query.where(func.lower(Location.neighborhood) == neighborhood.lower())
+    rows = db.session.execute(query).all()
+
+    keys = {}
+    groups = np.array([keys.setdefault(tuple(row[1:]), len(keys)) for row in rows], dtype=np.int64)
+    n = len(keys)
+    cells = [row[0] for row in rows]
+
+    listings = np.bincount(groups, weights=[c.listings for c in cells], minlength=n)
+    price_sum = np.bincount(groups, weights=[c.price_sum for c in cells], minlength=n)
+    area_listings = np.bincount(groups, weights=[c.area_listings for c in cells], minlength=n)
+    area_sum = np.bincount(groups, weights=[c.area_sum for c in cells], minlength=n)
+    listed_day_sum = np.bincount(groups, weights=[c.listed_day_sum for c in cells], minlength=n)
+
+    prices = percentiles(_merge(groups, [c.price_histogram for c in cells], PRICE_SCALE, n),
+                         (0.25, 0.5, 0.75), PRICE_SCALE)
+    prices_per_area = percentiles(
+        _merge(groups, [c.price_per_area_histogram for c in cells], PRICE_PER_AREA_SCALE, n),
+        (0.5,), PRICE_PER_AREA_SCALE,
+    )
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        average_price = price_sum / listings
+        average_area = area_sum / area_listings
+        days_on_market = date.today().toordinal() - listed_day_sum / listings
+
+    result = []
+    for key, i in keys.items():
+        group = {}
+        for name, value in zip(group_by, key):
+            group[name] = value.isoformat()[:7] if name == "month" and value else value
+        result.append({
+            **group,
+            "listings": int(listings[i]),
+            "median_price": _number(prices[0.5][i]),
+            "p25_price": _number(prices[0.25][i]),
+            "p75_price": _number(prices[0.75][i]),
+            "average_price": _number(average_price[i]),
+            "median_price_per_area": _number(prices_per_area[0.5][i], 2),
+            "average_area": _number(average_area[i], 1),
+            "average_days_on_market": _number(days_on_market[i], 1),
+        })
+    result.sort(key=lambda group: -group["listings"])
+    return result
+
+
+@click.command("market-stats")
+@with_appcontext
+def market_stats_command():
+    """Rebuild the market_stats rollup from the properties table."""
+    db.create_all()
+    cells = rebuild_market_stats()
+    click.echo(f"Rebuilt {cells} market stats cells")
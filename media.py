@@ -0,0 +1,118 @@
+"""Removal of uploaded files after their database rows are gone.
+
+Files cannot take part in a database transaction. Anything that deletes
+image or video rows therefore also records the files in
+``pending_file_deletions`` within the same transaction, together with a
+"purge-media" job (see jobs.py) that removes the files once the transaction
+has committed. Rows are only dropped once their file is gone. A file that
+cannot be removed yet stays for the scheduled "purge-media" sweep or
+``flask purge-media``. This way storage is reclaimed even though the HTTP
+request never waits for the disk.
+
+Upload URLs are derived from the listing id and the file name, so a
+re-uploaded ``front.jpg`` gets the same URL as the row it replaces. Files a
+remaining image or video row still points at are never queued, and are
+checked again right before removal.
+
+    MEDIA_PURGE_MAX_ATTEMPTS   give up on a file after this many failures (default: 10)
+"""
+from flask.cli import with_appcontext
+from sqlalchemy import select
+from jobs import enqueue
+from models import db, PendingFileDeletion, PropertyImage, PropertyVideo
+import click
+import os
+
+MEDIA_PURGE_MAX_ATTEMPTS = int(os.getenv("MEDIA_PURGE_MAX_ATTEMPTS", 10))
+UPLOAD_URL_PREFIX = "/uploads/"
+
+
+def upload_path(url, upload_folder):
+    """Absolute path of an /uploads/ URL inside ``upload_folder``, or None for anything else"""
+    if not url or not url.startswith(UPLOAD_URL_PREFIX):
+        return None
+    folder = os.path.realpath(upload_folder)
+    path = os.path.realpath(os.path.join(folder, url[len(UPLOAD_URL_PREFIX):]))
+    # Never follow a crafted URL out of the upload folder
+    if os.path.dirname(path) != folder:
+        return None
+    return path
+
+
+def referenced_urls(urls):
+    """The ones among ``urls`` that an image or video row still points at"""
+    urls = list(set(urls))
+    if not urls:
+        return set()
+    return set(db.session.scalars(select(PropertyImage.image_url).where(PropertyImage.image_url.in_(urls)))) \
+        | set(db.session.scalars(select(PropertyVideo.video_url).where(PropertyVideo.video_url.in_(urls))))
+
+
+def queue_file_deletions(urls, upload_folder):
+    """Record the files behind ``urls`` for deletion in the current transaction. Returns the new rows."""
+    # Flush first so rows added or deleted by the caller count
+    db.session.flush()
+    in_use = {upload_path(url, upload_folder) for url in referenced_urls(urls)}
+    paths = {upload_path(url, upload_folder) for url in urls} - in_use
+    pending = [PendingFileDeletion(path=path) for path in paths if path]
+    db.session.add_all(pending)
+    return pending
+
+
+def purge_files(ids=None, limit=500, after_id=0):
+    """Remove pending files (the given ids, or the next ``limit`` after ``after_id``). Returns (removed, failed, last id)."""
+    query = select(PendingFileDeletion).where(
+        PendingFileDeletion.attempts < MEDIA_PURGE_MAX_ATTEMPTS,
+        PendingFileDeletion.id > after_id,
+    )
+    if ids is not None:
+        query = query.where(PendingFileDeletion.id.in_(ids))
+    rows = db.session.scalars(query.order_by(PendingFileDeletion.id).limit(limit)).all()
+
+    removed = failed = 0
+    last_id = rows[-1].id if rows else None
+    # A file may have been uploaded again under the same URL since it was queued
+    in_use = referenced_urls(UPLOAD_URL_PREFIX + os.path.basename(row.path) for row in rows)
+    for row in rows:
+        if UPLOAD_URL_PREFIX + os.path.basename(row.path) in in_use:
+            db.session.delete(row)
+            continue
+        try:
+            os.remove(row.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            row.attempts += 1
+            row.last_error = str(e)
+            failed += 1
+            continue
+        db.session.delete(row)
+        removed += 1
+    db.session.commit()
+    return removed, failed, last_id
+
+
+def schedule_purge(ids):
+    """Queue a background purge of PendingFileDeletion ids in the current transaction"""
+    if ids:
+        enqueue("purge-media", {"ids": list(ids)})
+
+
+def purge_all(limit=500):
+    """Work through every pending file. Returns (removed, failed)."""
+    total_removed = total_failed = 0
+    last_id = 0
+    while last_id is not None:
+        removed, failed, last_id = purge_files(limit=limit, after_id=last_id)
+        total_removed += removed
+        total_failed += failed
+    return total_removed, total_failed
+
+
+@click.command("purge-media")
+@click.option("--limit", default=500, help="files to process per batch")
+@with_appcontext
+def purge_media_command(limit):
+    """Remove uploaded files whose rows were deleted."""
+    removed, failed = purge_all(limit)
+    click.echo(f"Removed {removed} files, {failed} failed")
@@ -0,0 +1,257 @@
+"""Request metrics in Prometheus text format.
+
+Per route template (``/user/properties/<int:property_id>``, not the raw path)
+we record request latency and DB query count histograms, status counts and
+upload bytes, plus in-flight requests and connection pool counters.
+
+Each gunicorn worker keeps its own numbers in memory. When METRICS_DIR is
+set, workers also write a snapshot there (at most every
+METRICS_FLUSH_INTERVAL seconds) and ``/metrics`` merges the snapshots of all
+live workers, so a scrape sees the whole server whichever worker answers.
+/metrics requires ``Authorization: Bearer <METRICS_TOKEN>`` and answers 403
+while METRICS_TOKEN is unset, since route names, latencies and pool stats
+are not for the public.
+"""
+from bisect import bisect_left
+from database import pool_stats
+from flask import Response, g, request
+import hmac
+import json
+import os
+import tempfile
+import threading
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 1))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+
+class MetricsRegistry:
+    """Counters, gauges and fixed-bucket histograms keyed by (name, labels)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_gauge(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, buckets, labels, value):
+        key = (name, labels)
+        index = bisect_left(buckets, value)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": list(buckets), "counts": [0] * (len(buckets) + 1), "sum": 0.0}
+            histogram["counts"][index] += 1
+            histogram["sum"] += value
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "counters": [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                "gauges": [[name, list(labels), value] for (name, labels), value in self.gauges.items()],
+                "histograms": [[name, list(labels), dict(h, counts=list(h["counts"]))] for (name, labels), h in self.histograms.items()],
+            }
+
+    def merge(self, data):
+        """Add another registry's ``to_dict`` output into this one"""
+        for name, labels, value in data["counters"]:
+            self.inc(name, _labels(labels), value)
+        for name, labels, value in data["gauges"]:
+            self.add_gauge(name, _labels(labels), value)
+        for name, labels, other in data["histograms"]:
+            key = (name, _labels(labels))
+            with self._lock:
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    self.histograms[key] = dict(other, counts=list(other["counts"]))
+                else:
+                    histogram["counts"] = [a + b for a, b in zip(histogram["counts"], other["counts"])]
+                    histogram["sum"] += other["sum"]
+
+
+def _labels(pairs):
+    return tuple(tuple(pair) for pair in pairs)
+
+
+registry = MetricsRegistry()
+
+HELP = {
+    "http_requests_total": ("counter", "Requests served, by route, method and status"),
+    "http_requests_in_flight": ("gauge", "Requests currently being served"),
+    "http_request_duration_seconds": ("histogram", "Request latency in seconds"),
+    "http_request_db_queries": ("histogram", "SQL statements executed per request"),
+    "http_upload_bytes_total": ("counter", "Bytes received in multipart uploads"),
+    "db_pool_events_total": ("counter", "Connection pool events"),
+    "db_pool_wait_seconds_total": ("counter", "Time spent waiting for a pooled connection"),
+}
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def render(reg):
+    """Prometheus text exposition format (version 0.0.4)"""
+    series = {}
+    for (name, labels), value in sorted(reg.counters.items()):
+        series.setdefault(name, []).append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), value in sorted(reg.gauges.items()):
+        series.setdefault(name, []).append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), histogram in sorted(reg.histograms.items(), key=lambda item: item[0]):
+        lines = series.setdefault(name, [])
+        cumulative = 0
+        for bound, count in zip(histogram["buckets"], histogram["counts"]):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+        cumulative += histogram["counts"][-1]
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+        lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+    out = []
+    for name in sorted(series):
+        kind, help_text = HELP.get(name, ("untyped", name))
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {kind}")
+        out.extend(series[name])
+    return "\n".join(out) + "\n"
+
+
+_last_flush = 0.0
+
+
+def flush(force=False):
+    """Write this worker's snapshot to METRICS_DIR"""
+    global _last_flush
+    if not METRICS_DIR:
+        return
+    now = time.monotonic()
+    if not force and now - _last_flush < METRICS_FLUSH_INTERVAL:
+        return
+    _last_flush = now
+
+    data = registry.to_dict()
+    data["pool"] = _pool_snapshot()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=METRICS_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, os.path.join(METRICS_DIR, f"{os.getpid()}.json"))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def collect():
+    """Registry covering every live worker (or just this one without METRICS_DIR)"""
+    if not METRICS_DIR:
+        merged = MetricsRegistry()
+        merged.merge(registry.to_dict())
+        _add_pool_metrics(merged, _pool_snapshot())
+        return merged
+
+    flush(force=True)
+    merged = MetricsRegistry()
+    for filename in os.listdir(METRICS_DIR):
+        if not filename.endswith(".json"):
+            continue
+        path = os.path.join(METRICS_DIR, filename)
+        pid = int(filename[:-5]) if filename[:-5].isdigit() else None
+        if pid is None or not _pid_alive(pid):
+            # Numbers from dead workers read as a counter reset, which rate() handles
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        merged.merge(data)
+        _add_pool_metrics(merged, data.get("pool", {}))
+    return merged
+
+
+def _pool_snapshot():
+    return pool_stats.snapshot()
+
+
+def _add_pool_metrics(reg, pool):
+    for event_name in ("connects", "checkouts", "checkins", "invalidations", "timeouts"):
+        if event_name in pool:
+            reg.inc("db_pool_events_total", (("event", event_name),), pool[event_name])
+    if "wait_seconds_total" in pool:
+        reg.inc("db_pool_wait_seconds_total", (), pool["wait_seconds_total"])
+
+
+def init_metrics(app):
+    """Register the request hooks and the /metrics endpoint"""
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        registry.add_gauge("http_requests_in_flight")
+
+    @app.after_request
+    def record_request_metrics(response):
+        started = g.pop("metrics_started", None)
+        if started is None:
+            return response
+        registry.add_gauge("http_requests_in_flight", value=-1)
+
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        labels = (("method", request.method), ("route", route))
+        registry.inc("http_requests_total", labels + (("status", str(response.status_code)),))
+        registry.observe("http_request_duration_seconds", LATENCY_BUCKETS, labels, time.perf_counter() - started)
+
+        stats = g.get("query_stats")
+        if stats is not None:
+            registry.observe("http_request_db_queries", QUERY_BUCKETS, labels, stats.count)
+
+        if request.mimetype == "multipart/form-data" and request.content_length:
+            registry.inc("http_upload_bytes_total", (("route", route),), request.content_length)
+
+        flush()
+        return response
+
+    @app.teardown_request
+    def end_request_metrics(exc):
+        # after_request is skipped when a request fails, keep the gauge balanced
+        if g.pop("metrics_started", None) is not None:
+            registry.add_gauge("http_requests_in_flight", value=-1)
+
+    @app.route("/metrics")
+    def metrics():
+        if not METRICS_TOKEN:
+            return {"message": "Metrics are disabled, set METRICS_TOKEN to enable them"}, 403
+        if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {METRICS_TOKEN}".encode()):
+            return {"message": "Unauthorized request"}, 401
+        return Response(render(collect()), mimetype="text/plain; version=0.0.4")
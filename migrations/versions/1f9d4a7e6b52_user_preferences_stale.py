@@ -0,0 +1,40 @@
+"""user_preferences, with the stale flag the refresh-preferences job reads
+
+Revision ID: 1f9d4a7e6b52
+Revises: e83b6f4c2a15
+Create Date: 2026-10-19 09:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from database import has_column
+
+
+# revision identifiers, used by Alembic.
+revision = '1f9d4a7e6b52'
+down_revision = 'e83b6f4c2a15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    if not sa.inspect(bind).has_table("user_preferences"):
+        op.create_table(
+            "user_preferences",
+            sa.Column("user_id", sa.Integer(), autoincrement=False, nullable=False),
+            sa.Column("vector", sa.JSON(), nullable=False),
+            sa.Column("interactions", sa.Integer(), nullable=False),
+            sa.Column("stale", sa.Boolean(), server_default=sa.false(), nullable=False),
+            sa.Column("updated_at", sa.DateTime(), server_default=sa.func.now(), nullable=True),
+            sa.ForeignKeyConstraint(["user_id"], ["users.id"], name="fk_user_preferences_user_id_users"),
+            sa.PrimaryKeyConstraint("user_id", name="pk_user_preferences"),
+        )
+    elif not has_column(bind, "user_preferences", "stale"):
+        op.add_column(
+            "user_preferences", sa.Column("stale", sa.Boolean(), server_default=sa.false(), nullable=False)
+        )
+
+
+def downgrade():
+    op.drop_table("user_preferences")
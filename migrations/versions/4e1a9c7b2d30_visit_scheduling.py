@@ -0,0 +1,58 @@
+"""views.agent_id and the visit listing and scheduling indexes
+
+Revision ID: 4e1a9c7b2d30
+Revises:
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from database import has_column, has_index
+
+
+# revision identifiers, used by Alembic.
+revision = '4e1a9c7b2d30'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+PENDING = sa.text("status = 'pending'")
+INDEXES = [
+    ("ix_views_user_id_sheduled_time", ["user_id", "sheduled_time", "id"], {}),
+    ("ix_views_agent_id_sheduled_time", ["agent_id", "sheduled_time"], {}),
+    ("ix_views_property_id_sheduled_time", ["property_id", "sheduled_time"], {}),
+    ("uq_views_agent_id_sheduled_time_pending", ["agent_id", "sheduled_time"],
+     {"unique": True, "sqlite_where": PENDING, "postgresql_where": PENDING}),
+]
+
+
+def upgrade():
+    bind = op.get_bind()
+    if not has_column(bind, "views", "agent_id"):
+        # SQLite can't add a foreign key in place, batch mode copies the table there
+        with op.batch_alter_table("views") as batch:
+            batch.add_column(sa.Column("agent_id", sa.Integer(), nullable=True))
+            batch.create_foreign_key("fk_views_agent_id_agent_profiles", "agent_profiles", ["agent_id"], ["id"])
+        # Visits record the listing's agent. A pending visit that double-books a slot an earlier
+        # one holds is left without it, so the unique index below can be created.
+        op.execute("""
+            UPDATE views SET agent_id = (SELECT agent_id FROM properties WHERE properties.id = views.property_id)
+            WHERE status IN ('pending', 'completed')
+              AND NOT (status = 'pending' AND EXISTS (
+                  SELECT 1 FROM views AS earlier JOIN properties ON properties.id = earlier.property_id
+                  WHERE earlier.status = 'pending' AND earlier.id < views.id
+                    AND earlier.sheduled_time = views.sheduled_time
+                    AND properties.agent_id = (SELECT agent_id FROM properties WHERE properties.id = views.property_id)
+              ))
+        """)
+    for name, columns, options in INDEXES:
+        if not has_index(bind, "views", name):
+            op.create_index(name, "views", columns, **options)
+
+
+def downgrade():
+    for name, _, _ in reversed(INDEXES):
+        op.drop_index(name, table_name="views")
+    with op.batch_alter_table("views") as batch:
+        batch.drop_constraint("fk_views_agent_id_agent_profiles", type_="foreignkey")
+        batch.drop_column("agent_id")
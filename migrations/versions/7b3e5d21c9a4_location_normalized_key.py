@@ -0,0 +1,79 @@
+"""locations.normalized_key: merge duplicate locations and index the key
+
+Revision ID: 7b3e5d21c9a4
+Revises: 4e1a9c7b2d30
+Create Date: 2026-10-19 09:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from database import has_column, has_index
+from locations import location_key
+
+
+# revision identifiers, used by Alembic.
+revision = '7b3e5d21c9a4'
+down_revision = '4e1a9c7b2d30'
+branch_labels = None
+depends_on = None
+
+KEY_INDEX = "uq_locations_normalized_key"
+
+locations = sa.table(
+    "locations", sa.column("id"), sa.column("country"), sa.column("state"), sa.column("city"),
+    sa.column("neighborhood"), sa.column("normalized_key"),
+)
+property_locations = sa.table(
+    "property_locations", sa.column("id"), sa.column("property_id"), sa.column("location_id"),
+)
+
+
+def upgrade():
+    bind = op.get_bind()
+    if not has_column(bind, "locations", "normalized_key"):
+        op.add_column("locations", sa.Column("normalized_key", sa.Text(), nullable=True))
+    if has_index(bind, "locations", KEY_INDEX):
+        return
+
+    # Merge rows with the same key into the oldest one
+    canonical, duplicates = {}, {}
+    for row in bind.execute(sa.select(locations).order_by(locations.c.id)):
+        key = location_key(row.country, row.state, row.city, row.neighborhood)
+        if key is None:
+            continue
+        if key in canonical:
+            duplicates[row.id] = canonical[key]
+        else:
+            canonical[key] = row.id
+
+    for duplicate_id, keep_id in duplicates.items():
+        bind.execute(
+            property_locations.update()
+            .where(property_locations.c.location_id == duplicate_id)
+            .values(location_id=keep_id)
+        )
+    if duplicates:
+        bind.execute(locations.delete().where(locations.c.id.in_(list(duplicates))))
+
+    # A property may now be linked to the same location twice
+    keep = sa.select(sa.func.min(property_locations.c.id)).group_by(
+        property_locations.c.property_id, property_locations.c.location_id
+    )
+    bind.execute(property_locations.delete().where(property_locations.c.id.not_in(keep)))
+
+    # Backfill keys only once the duplicates holding the same key are gone
+    if canonical:
+        bind.execute(
+            locations.update()
+            .where(locations.c.id == sa.bindparam("location_id"))
+            .values(normalized_key=sa.bindparam("key")),
+            [{"location_id": location_id, "key": key} for key, location_id in canonical.items()],
+        )
+    op.create_index(KEY_INDEX, "locations", ["normalized_key"], unique=True)
+
+
+def downgrade():
+    # Merged locations stay merged
+    op.drop_index(KEY_INDEX, table_name="locations")
+    with op.batch_alter_table("locations") as batch:
+        batch.drop_column("normalized_key")
@@ -0,0 +1,58 @@
+"""notifications.group_key, the notification indexes and the outbox
+
+Revision ID: 9a6c3e1b8d74
+Revises: 1f9d4a7e6b52
+Create Date: 2026-10-19 09:50:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from database import has_column, has_index
+
+
+# revision identifiers, used by Alembic.
+revision = '9a6c3e1b8d74'
+down_revision = '1f9d4a7e6b52'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ("ix_notifications_user_id_created_at", ["user_id", "created_at", "id"]),
+    ("ix_notifications_user_id_is_read", ["user_id", "is_read"]),
+]
+
+
+def upgrade():
+    bind = op.get_bind()
+    if not has_column(bind, "notifications", "group_key"):
+        op.add_column("notifications", sa.Column("group_key", sa.Text(), nullable=True))
+    for name, columns in INDEXES:
+        if not has_index(bind, "notifications", name):
+            op.create_index(name, "notifications", columns)
+    if bind.dialect.name == "postgresql":
+        # A new enum value can't be used in the transaction that adds it
+        with op.get_context().autocommit_block():
+            op.execute("ALTER TYPE notification_type ADD VALUE IF NOT EXISTS 'message'")
+
+    if not sa.inspect(bind).has_table("notification_outbox"):
+        op.create_table(
+            "notification_outbox",
+            sa.Column("id", sa.Integer(), nullable=False),
+            sa.Column("user_id", sa.Integer(), nullable=True),
+            sa.Column("agent_id", sa.Integer(), nullable=True),
+            sa.Column("title", sa.Text(), nullable=False),
+            sa.Column("message", sa.Text(), nullable=False),
+            sa.Column("notification_type", sa.Text(), nullable=False),
+            sa.Column("group_key", sa.Text(), nullable=True),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint("id", name="pk_notification_outbox"),
+        )
+
+
+def downgrade():
+    # Postgres can't drop an enum value; 'message' stays
+    op.drop_table("notification_outbox")
+    for name, _ in reversed(INDEXES):
+        op.drop_index(name, table_name="notifications")
+    with op.batch_alter_table("notifications") as batch:
+        batch.drop_column("group_key")
@@ -0,0 +1,69 @@
+"""properties.archived_at and the views and inquiries archive tables
+
+Revision ID: c52f8e0a1d67
+Revises: 7b3e5d21c9a4
+Create Date: 2026-10-19 09:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from database import has_column, has_index
+
+
+# revision identifiers, used by Alembic.
+revision = 'c52f8e0a1d67'
+down_revision = '7b3e5d21c9a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    if not has_column(bind, "properties", "archived_at"):
+        op.add_column("properties", sa.Column("archived_at", sa.DateTime(), nullable=True))
+    if not has_index(bind, "properties", "ix_properties_archived_at"):
+        op.create_index("ix_properties_archived_at", "properties", ["archived_at"])
+
+    # Same ids as the live rows and no foreign keys, see archival.py
+    if not sa.inspect(bind).has_table("views_archive"):
+        op.create_table(
+            "views_archive",
+            sa.Column("id", sa.Integer(), autoincrement=False, nullable=False),
+            sa.Column("property_id", sa.Integer(), nullable=False),
+            sa.Column("user_id", sa.Integer(), nullable=False),
+            sa.Column("agent_id", sa.Integer(), nullable=True),
+            sa.Column("sheduled_time", sa.DateTime(), nullable=False),
+            sa.Column("status", sa.Text(), nullable=True),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+            sa.Column("updated_at", sa.DateTime(), nullable=True),
+            sa.Column("archived_at", sa.DateTime(), server_default=sa.func.now(), nullable=True),
+            sa.PrimaryKeyConstraint("id", name="pk_views_archive"),
+        )
+        op.create_index("ix_views_archive_property_id", "views_archive", ["property_id"])
+        op.create_index("ix_views_archive_user_id_created_at", "views_archive", ["user_id", "created_at"])
+
+    if not sa.inspect(bind).has_table("inquiries_archive"):
+        op.create_table(
+            "inquiries_archive",
+            sa.Column("id", sa.Integer(), autoincrement=False, nullable=False),
+            sa.Column("user_id", sa.Integer(), nullable=False),
+            sa.Column("agent_id", sa.Integer(), nullable=False),
+            sa.Column("property_id", sa.Integer(), nullable=False),
+            sa.Column("message", sa.Text(), nullable=False),
+            sa.Column("status", sa.Text(), nullable=True),
+            sa.Column("reply", sa.Text(), nullable=True),
+            sa.Column("created_at", sa.DateTime(), nullable=True),
+            sa.Column("updated_at", sa.DateTime(), nullable=True),
+            sa.Column("archived_at", sa.DateTime(), server_default=sa.func.now(), nullable=True),
+            sa.PrimaryKeyConstraint("id", name="pk_inquiries_archive"),
+        )
+        op.create_index("ix_inquiries_archive_agent_id", "inquiries_archive", ["agent_id"])
+        op.create_index("ix_inquiries_archive_user_id", "inquiries_archive", ["user_id"])
+
+
+def downgrade():
+    op.drop_table("inquiries_archive")
+    op.drop_table("views_archive")
+    op.drop_index("ix_properties_archived_at", table_name="properties")
+    with op.batch_alter_table("properties") as batch:
+        batch.drop_column("archived_at")
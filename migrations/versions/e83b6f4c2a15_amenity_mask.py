@@ -0,0 +1,43 @@
+"""properties.amenity_mask, filled from property_amenities
+
+Revision ID: e83b6f4c2a15
+Revises: c52f8e0a1d67
+Create Date: 2026-10-19 09:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from database import has_column
+
+
+# revision identifiers, used by Alembic.
+revision = 'e83b6f4c2a15'
+down_revision = 'c52f8e0a1d67'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    if has_column(bind, "properties", "amenity_mask"):
+        return
+    op.add_column(
+        "properties", sa.Column("amenity_mask", sa.BigInteger(), server_default="0", nullable=False)
+    )
+    # Bit id - 1 per amenity, see amenities.py. Distinct bits add up to their OR;
+    # ids above 63 have no bit.
+    op.execute("""
+        UPDATE properties SET amenity_mask = (
+            SELECT SUM(DISTINCT CAST(1 AS BIGINT) << (amenity_id - 1)) FROM property_amenities
+            WHERE property_amenities.property_id = properties.id AND amenity_id BETWEEN 1 AND 63
+        )
+        WHERE EXISTS (
+            SELECT 1 FROM property_amenities
+            WHERE property_amenities.property_id = properties.id AND amenity_id BETWEEN 1 AND 63
+        )
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table("properties") as batch:
+        batch.drop_column("amenity_mask")
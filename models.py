@@ -3,7 +3,8 @@ from sqlalchemy import MetaData
 from sqlalchemy_serializer import SerializerMixin
 from sqlalchemy.orm import validates
 from datetime import datetime
-from flask_bcrypt import check_password_hash
+from passwords import verify_password, hash_password, needs_rehash
+from database import RoutingSession
 
 naming_convention = {
     "ix": "ix_%(column_0_label)s",
@@ -15,7 +16,7 @@ naming_convention = {
 
 metadata = MetaData(naming_convention=naming_convention)
 
-db = SQLAlchemy(metadata=metadata)
+db = SQLAlchemy(metadata=metadata, session_options={"class_": RoutingSession})
 
 
 class User(db.Model, SerializerMixin):
@@ -34,24 +35,14 @@ class User(db.Model, SerializerMixin):
 
     def check_password(self, plain_password):
         """Verify password - handles both bcrypt hashes and plain text (legacy)"""
-        if not self.password or not plain_password:
-            return False
-            
-        # Ensure both are strings for comparison
-        stored_password = self.password
-        if isinstance(stored_password, bytes):
-            stored_password = stored_password.decode('utf-8')
-        
-        try:
-            # First try bcrypt hash
-            return check_password_hash(stored_password, plain_password)
-        except (ValueError, TypeError):
-            # If bcrypt fails (invalid salt), try plain text comparison
-            # This handles legacy data or improperly hashed passwords
-            return stored_password == plain_password
-        except Exception:
-            # Catch any other unexpected errors
-            return False
+        return verify_password(self.password, plain_password)
+
+    def set_password(self, plain_password):
+        self.password = hash_password(plain_password)
+
+    def password_needs_rehash(self):
+        """True for plain text passwords and hashes made with a different cost"""
+        return needs_rehash(self.password)
     
     def to_json(self):
         return {'id':self.id, 'role':self.role}
@@ -109,6 +100,10 @@ class Property(db.Model, SerializerMixin):
     status = db.Column(db.Enum("onsale", "onrent", "lease", name="property_status"), nullable=False)
     year_built = db.Column(db.DateTime(), nullable=True)
     listing_date = db.Column(db.DateTime(), nullable=False)
+    # Set by archival.py for sold/expired listings, hidden from the catalog while set
+    archived_at = db.Column(db.DateTime(), nullable=True, index=True)
+    # Bit (amenity id - 1) per amenity, kept in step with property_amenities by amenities.py
+    amenity_mask = db.Column(db.BigInteger(), nullable=False, default=0, server_default="0")
     created_at = db.Column(db.DateTime(), server_default=db.func.now())
     updated_at = db.Column(db.DateTime(), onupdate=db.func.now(), default=datetime.now())
 
@@ -130,9 +125,15 @@ class Location(db.Model, SerializerMixin):
     neighborhood = db.Column(db.Text())
     latitude = db.Column(db.Text())
     longitude = db.Column(db.Text())
+    # lowercased "country|state|city|neighborhood", maintained by locations.py
+    normalized_key = db.Column(db.Text(), nullable=True)
     created_at = db.Column(db.DateTime(), server_default=db.func.now())
     created_at = db.Column(db.DateTime(), onupdate=db.func.now(), default=datetime.now())
 
+    __table_args__ = (
+        db.Index("uq_locations_normalized_key", "normalized_key", unique=True),
+    )
+
 class PropertyLocation(db.Model, SerializerMixin):
     __tablename__ = "property_locations"
 
@@ -171,6 +172,16 @@ class PropertyVideo(db.Model, SerializerMixin):
     created_at = db.Column(db.DateTime(), server_default=db.func.now())
     updated_at = db.Column(db.DateTime(), onupdate=db.func.now(), default=datetime.now())
 
+class PendingFileDeletion(db.Model, SerializerMixin):
+    """Uploaded file waiting to be removed from disk, written in the same transaction that dropped its row"""
+    __tablename__ = "pending_file_deletions"
+
+    id = db.Column(db.Integer(), primary_key=True)
+    path = db.Column(db.Text(), nullable=False)
+    attempts = db.Column(db.Integer(), default=0, nullable=False)
+    last_error = db.Column(db.Text(), nullable=True)
+    created_at = db.Column(db.DateTime(), server_default=db.func.now())
+
 class Amenity(db.Model, SerializerMixin):
     __tablename__ = "amenities"
 
@@ -188,15 +199,188 @@ class PropertyAmenity(db.Model, SerializerMixin):
 
 class View(db.Model, SerializerMixin):
     __tablename__ = "views"
+    __table_args__ = (
+        # Serves the per-user visit listing ordered by scheduled time
+        db.Index("ix_views_user_id_sheduled_time", "user_id", "sheduled_time", "id"),
+        # Interval lookups for visit conflict detection and free slot computation
+        db.Index("ix_views_agent_id_sheduled_time", "agent_id", "sheduled_time"),
+        db.Index("ix_views_property_id_sheduled_time", "property_id", "sheduled_time"),
+        # Last line of defence against two requests booking the same slot at once
+        db.Index(
+            "uq_views_agent_id_sheduled_time_pending", "agent_id", "sheduled_time",
+            unique=True,
+            sqlite_where=db.text("status = 'pending'"),
+            postgresql_where=db.text("status = 'pending'"),
+        ),
+    )
 
     id = db.Column(db.Integer(), primary_key=True)
     property_id = db.Column(db.Integer(), db.ForeignKey("properties.id"), nullable=False)
     user_id = db.Column(db.Integer(), db.ForeignKey("users.id"), nullable=False)
+    agent_id = db.Column(db.Integer(), db.ForeignKey("agent_profiles.id"), nullable=True)
     sheduled_time = db.Column(db.DateTime(), nullable=False)
     status = db.Column(db.Enum("completed", "canceled", "pending", "viewed", name="view_status"))
     created_at = db.Column(db.DateTime(), server_default=db.func.now())
     updated_at = db.Column(db.DateTime(), onupdate=db.func.now(), default=datetime.now())
 
+class ViewArchive(db.Model, SerializerMixin):
+    """Page view events moved out of ``views`` by archival.py; same ids, no foreign keys"""
+    __tablename__ = "views_archive"
+    __table_args__ = (
+        db.Index("ix_views_archive_property_id", "property_id"),
+        db.Index("ix_views_archive_user_id_created_at", "user_id", "created_at"),
+    )
+
+    id = db.Column(db.Integer(), primary_key=True, autoincrement=False)
+    property_id = db.Column(db.Integer(), nullable=False)
+    user_id = db.Column(db.Integer(), nullable=False)
+    agent_id = db.Column(db.Integer(), nullable=True)
+    sheduled_time = db.Column(db.DateTime(), nullable=False)
+    status = db.Column(db.Text())
+    created_at = db.Column(db.DateTime())
+    updated_at = db.Column(db.DateTime())
+    archived_at = db.Column(db.DateTime(), server_default=db.func.now())
+
+class AgentAvailability(db.Model, SerializerMixin):
+    """Weekly window during which an agent accepts visits, split into fixed-length slots"""
+    __tablename__ = "agent_availabilities"
+
+    id = db.Column(db.Integer(), primary_key=True)
+    agent_id = db.Column(db.Integer(), db.ForeignKey("agent_profiles.id"), nullable=False, index=True)
+    weekday = db.Column(db.Integer(), nullable=False)  # 0 = Monday ... 6 = Sunday
+    start_minute = db.Column(db.Integer(), nullable=False)  # minutes since midnight
+    end_minute = db.Column(db.Integer(), nullable=False)
+    slot_minutes = db.Column(db.Integer(), default=60, nullable=False)
+    created_at = db.Column(db.DateTime(), server_default=db.func.now())
+    updated_at = db.Column(db.DateTime(), onupdate=db.func.now(), default=datetime.now())
+
+class PropertySimilarity(db.Model, SerializerMixin):
+    """Precomputed nearest neighbours of a listing, rebuilt by recommendations.py"""
+    __tablename__ = "property_similarities"
+
+    property_id = db.Column(db.Integer(), primary_key=True, autoincrement=False)
+    rank = db.Column(db.SmallInteger(), primary_key=True, autoincrement=False)
+    similar_property_id = db.Column(db.Integer(), nullable=False)
+    score = db.Column(db.Float(), nullable=False)
+
+class UserPreference(db.Model, SerializerMixin):
+    """A user's taste as a sparse {feature column: value} vector, built by feed.py"""
+    __tablename__ = "user_preferences"
+
+    user_id = db.Column(db.Integer(), db.ForeignKey("users.id"), primary_key=True, autoincrement=False)
+    vector = db.Column(db.JSON(), nullable=False)
+    interactions = db.Column(db.Integer(), nullable=False)
+    # Set by new interactions until the refresh-preferences job recomputes the vector
+    stale = db.Column(db.Boolean(), nullable=False, default=False, server_default=db.false())
+    updated_at = db.Column(db.DateTime(), server_default=db.func.now())
+
+class MarketStat(db.Model, SerializerMixin):
+    """Rollup of live listings per listing type, property type, location and month, kept by market_stats.py"""
+    __tablename__ = "market_stats"
+
+    listing_type = db.Column(db.Text(), primary_key=True)
+    property_type_id = db.Column(db.Integer(), primary_key=True, autoincrement=False)
+    # 0 for listings without a location
+    location_id = db.Column(db.Integer(), primary_key=True, autoincrement=False)
+    month = db.Column(db.Date(), primary_key=True, index=True)
+    listings = db.Column(db.Integer(), nullable=False)
+    price_sum = db.Column(db.Float(), nullable=False)
+    area_listings = db.Column(db.Integer(), nullable=False)
+    area_sum = db.Column(db.Float(), nullable=False)
+    listed_day_sum = db.Column(db.Float(), nullable=False)
+    # Sparse {bucket: count}, see market_stats.py for the bucket scale
+    price_histogram = db.Column(db.JSON(), nullable=False)
+    price_per_area_histogram = db.Column(db.JSON(), nullable=False)
+    updated_at = db.Column(db.DateTime(), server_default=db.func.now())
+
+class AgentDailyFact(db.Model, SerializerMixin):
+    """Activity per agent, listing and day, aggregated by analytics.py"""
+    __tablename__ = "agent_daily_facts"
+
+    agent_id = db.Column(db.Integer(), primary_key=True, autoincrement=False)
+    day = db.Column(db.Date(), primary_key=True, index=True)
+    # 0 for agent-level facts such as revenue
+    property_id = db.Column(db.Integer(), primary_key=True, autoincrement=False)
+    views = db.Column(db.Integer(), nullable=False, default=0)
+    visits = db.Column(db.Integer(), nullable=False, default=0)
+    inquiries = db.Column(db.Integer(), nullable=False, default=0)
+    favorites = db.Column(db.Integer(), nullable=False, default=0)
+    revenue = db.Column(db.Integer(), nullable=False, default=0)
+    updated_at = db.Column(db.DateTime(), server_default=db.func.now())
+
+class Job(db.Model, SerializerMixin):
+    """Background work queued by jobs.enqueue and run by flask worker"""
+    __tablename__ = "jobs"
+    __table_args__ = (
+        # Claim order for runnable and expired jobs
+        db.Index("ix_jobs_status_run_at", "status", "run_at"),
+    )
+
+    id = db.Column(db.Integer(), primary_key=True)
+    name = db.Column(db.Text(), nullable=False)
+    payload = db.Column(db.JSON(), nullable=False)
+    # Enqueueing twice with the same key creates one job
+    idempotency_key = db.Column(db.Text(), nullable=True, unique=True)
+    status = db.Column(db.Text(), nullable=False, default="queued")
+    attempts = db.Column(db.Integer(), nullable=False, default=0)
+    run_at = db.Column(db.DateTime(), nullable=False)
+    locked_by = db.Column(db.Text(), nullable=True)
+    locked_until = db.Column(db.DateTime(), nullable=True)
+    last_error = db.Column(db.Text(), nullable=True)
+    created_at = db.Column(db.DateTime(), server_default=db.func.now())
+    finished_at = db.Column(db.DateTime(), nullable=True)
+
+class SavedSearch(db.Model, SerializerMixin):
+    """Browse filters saved by a user, matched against new listings by saved_searches.py"""
+    __tablename__ = "saved_searches"
+
+    id = db.Column(db.Integer(), primary_key=True)
+    user_id = db.Column(db.Integer(), db.ForeignKey("user_profiles.id"), nullable=False, index=True)
+    name = db.Column(db.Text(), nullable=False)
+    listing_type = db.Column(db.Text(), nullable=True)
+    property_type_id = db.Column(db.Integer(), db.ForeignKey("property_types.id"), nullable=True)
+    city = db.Column(db.Text(), nullable=True)
+    neighborhood = db.Column(db.Text(), nullable=True)
+    min_price = db.Column(db.Integer(), nullable=True)
+    max_price = db.Column(db.Integer(), nullable=True)
+    min_bedrooms = db.Column(db.Integer(), nullable=True)
+    min_bathrooms = db.Column(db.Integer(), nullable=True)
+    # Number of rows in saved_search_terms; a listing matches when it hits all of them
+    term_count = db.Column(db.Integer(), nullable=False)
+    # Matches found after this are "new"
+    seen_at = db.Column(db.DateTime(), nullable=False)
+    created_at = db.Column(db.DateTime(), server_default=db.func.now())
+    updated_at = db.Column(db.DateTime(), onupdate=db.func.now(), default=datetime.now())
+
+class SavedSearchTerm(db.Model, SerializerMixin):
+    """Inverted index of saved search criteria: one row per (term, search)"""
+    __tablename__ = "saved_search_terms"
+
+    term = db.Column(db.Text(), primary_key=True)
+    saved_search_id = db.Column(db.Integer(), db.ForeignKey("saved_searches.id"), primary_key=True,
+                                autoincrement=False, index=True)
+
+class SavedSearchMatch(db.Model, SerializerMixin):
+    """A listing that matched a saved search when it was created or edited"""
+    __tablename__ = "saved_search_matches"
+    __table_args__ = (
+        db.Index("ix_saved_search_matches_search_created_at", "saved_search_id", "created_at"),
+    )
+
+    saved_search_id = db.Column(db.Integer(), db.ForeignKey("saved_searches.id"), primary_key=True,
+                                autoincrement=False)
+    property_id = db.Column(db.Integer(), db.ForeignKey("properties.id"), primary_key=True, autoincrement=False,
+                            index=True)
+    created_at = db.Column(db.DateTime(), nullable=False)
+
+class CatalogChange(db.Model, SerializerMixin):
+    """A listing created, edited, archived or deleted; replayed by the catalog snapshots in catalog.py"""
+    __tablename__ = "catalog_changes"
+
+    id = db.Column(db.Integer(), primary_key=True)
+    property_id = db.Column(db.Integer(), nullable=False)
+    created_at = db.Column(db.DateTime(), default=datetime.now, index=True)
+
 class Transaction(db.Model, SerializerMixin):
     __tablename__ = "transactions"
 
@@ -255,6 +439,26 @@ class Inquiry(db.Model, SerializerMixin):
     updated_at = db.Column(db.DateTime(), onupdate=db.func.now(), default=datetime.now())
 
 
+class InquiryArchive(db.Model, SerializerMixin):
+    """Closed inquiries moved out of ``inquiries`` by archival.py; same ids, no foreign keys"""
+    __tablename__ = "inquiries_archive"
+    __table_args__ = (
+        db.Index("ix_inquiries_archive_agent_id", "agent_id"),
+        db.Index("ix_inquiries_archive_user_id", "user_id"),
+    )
+
+    id = db.Column(db.Integer(), primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer(), nullable=False)
+    agent_id = db.Column(db.Integer(), nullable=False)
+    property_id = db.Column(db.Integer(), nullable=False)
+    message = db.Column(db.Text(), nullable=False)
+    status = db.Column(db.Text())
+    reply = db.Column(db.Text(), nullable=True)
+    created_at = db.Column(db.DateTime())
+    updated_at = db.Column(db.DateTime())
+    archived_at = db.Column(db.DateTime(), server_default=db.func.now())
+
+
 class Conversation(db.Model, SerializerMixin):
     """Model for real-time messaging conversations"""
     __tablename__ = "conversations"
@@ -296,20 +500,44 @@ class Review(db.Model, SerializerMixin):
     updated_at = db.Column(db.DateTime(), onupdate=db.func.now(), default=datetime.now())
 
 
+NOTIFICATION_TYPES = ("inquiry", "viewing", "property", "system", "message")
+
+
 class Notification(db.Model, SerializerMixin):
     """Model for user notifications"""
     __tablename__ = "notifications"
+    __table_args__ = (
+        # Newest-first listing and the unread count
+        db.Index("ix_notifications_user_id_created_at", "user_id", "created_at", "id"),
+        db.Index("ix_notifications_user_id_is_read", "user_id", "is_read"),
+    )
 
     id = db.Column(db.Integer(), primary_key=True)
     user_id = db.Column(db.Integer(), db.ForeignKey("users.id"), nullable=False)
     title = db.Column(db.Text(), nullable=False)
     message = db.Column(db.Text(), nullable=False)
-    notification_type = db.Column(db.Enum("inquiry", "viewing", "property", "system", name="notification_type"), default="system")
+    notification_type = db.Column(db.Enum(*NOTIFICATION_TYPES, name="notification_type"), default="system")
+    # Unread notifications with the same key are updated instead of repeated
+    group_key = db.Column(db.Text(), nullable=True)
     is_read = db.Column(db.Boolean(), default=False, nullable=False)
     created_at = db.Column(db.DateTime(), server_default=db.func.now())
     updated_at = db.Column(db.DateTime(), onupdate=db.func.now(), default=datetime.now())
 
 
+class NotificationOutbox(db.Model, SerializerMixin):
+    """Notifications waiting for the dispatcher in notifications.py; the recipient is a user or an agent profile"""
+    __tablename__ = "notification_outbox"
+
+    id = db.Column(db.Integer(), primary_key=True)
+    user_id = db.Column(db.Integer(), nullable=True)
+    agent_id = db.Column(db.Integer(), nullable=True)
+    title = db.Column(db.Text(), nullable=False)
+    message = db.Column(db.Text(), nullable=False)
+    notification_type = db.Column(db.Text(), nullable=False)
+    group_key = db.Column(db.Text(), nullable=True)
+    created_at = db.Column(db.DateTime(), default=datetime.now)
+
+
 
     
     
@@ -0,0 +1,132 @@
+"""Notifications, written through an outbox.
+
+Write endpoints call notify(), which adds one ``notification_outbox`` row in
+the caller's transaction and does no other work. Recipients can be given as
+a user id or as an agent profile id, so callers never have to look up the
+agent's user. notify() also queues a "dispatch-notifications" job (see
+jobs.py) keyed by the NOTIFICATION_DISPATCH_DELAY-second window it falls in
+and due when that window ends, so a burst shares one job. The job drains
+the outbox in batches of NOTIFICATION_BATCH_SIZE. For each batch it:
+
+* resolves agent profiles to users with one query
+* coalesces rows with the same recipient and group key, keeping the latest
+* updates an unread notification with the same key instead of adding
+  another (ten chat messages make one "New message" notification)
+* bulk inserts the rest and deletes the outbox rows, all in one transaction
+
+On Postgres the batch is claimed with SKIP LOCKED, so jobs running in
+different workers never deliver the same row twice. Rows left behind by a
+failed job are delivered by its retry, by the next window's job, or by the
+scheduled sweep and ``flask dispatch-notifications``.
+"""
+from datetime import datetime
+from flask.cli import with_appcontext
+from sqlalchemy import delete, event, insert, select, tuple_
+from database import RoutingSession
+from jobs import enqueue
+from models import db, AgentProfile, Notification, NotificationOutbox, NOTIFICATION_TYPES
+import click
+import os
+import time
+
+NOTIFICATION_BATCH_SIZE = int(os.getenv("NOTIFICATION_BATCH_SIZE", 500))
+NOTIFICATION_DISPATCH_DELAY = float(os.getenv("NOTIFICATION_DISPATCH_DELAY", 1))
+
+
+def notify(title, message, notification_type="system", user_id=None, agent_id=None, group_key=None):
+    """Queue a notification for a user, or for the user behind an agent profile, in the current transaction"""
+    if user_id is None and agent_id is None:
+        raise ValueError("notify() needs a user_id or an agent_id")
+    db.session.add(NotificationOutbox(
+        user_id=user_id,
+        agent_id=agent_id,
+        title=title,
+        message=message,
+        notification_type=notification_type,
+        group_key=group_key,
+    ))
+    # One dispatch job per window, due when the window ends
+    slot = int(time.time() // NOTIFICATION_DISPATCH_DELAY) + 1
+    if db.session.info.get("notification_dispatch_slot") != slot:
+        enqueue("dispatch-notifications", key=f"dispatch-notifications:{slot}",
+                run_at=datetime.fromtimestamp(slot * NOTIFICATION_DISPATCH_DELAY))
+        db.session.info["notification_dispatch_slot"] = slot
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _discard_queued(session):
+    # The rolled back job has to be queued again
+    session.info.pop("notification_dispatch_slot", None)
+
+
+def dispatch_batch(limit=NOTIFICATION_BATCH_SIZE):
+    """Deliver up to ``limit`` outbox rows. Returns how many rows were consumed."""
+    rows = db.session.scalars(
+        select(NotificationOutbox).order_by(NotificationOutbox.id).limit(limit).with_for_update(skip_locked=True)
+    ).all()
+    if not rows:
+        db.session.commit()
+        return 0
+
+    agent_ids = {row.agent_id for row in rows if row.user_id is None}
+    agent_users = dict(db.session.execute(
+        select(AgentProfile.id, AgentProfile.user_id).where(AgentProfile.id.in_(agent_ids))
+    ).all()) if agent_ids else {}
+
+    # Latest row wins per (recipient, group key); rows without a key stay separate
+    latest = {}
+    for row in rows:
+        user_id = row.user_id if row.user_id is not None else agent_users.get(row.agent_id)
+        if user_id is None:
+            continue
+        key = (user_id, row.group_key) if row.group_key else (user_id, f"outbox:{row.id}")
+        latest[key] = row
+
+    grouped = [key for key, row in latest.items() if row.group_key]
+    unread = {}
+    if grouped:
+        unread = {
+            (n.user_id, n.group_key): n
+            for n in db.session.scalars(select(Notification).where(
+                tuple_(Notification.user_id, Notification.group_key).in_(grouped),
+                Notification.is_read.is_(False),
+            ))
+        }
+
+    new = []
+    for key, row in latest.items():
+        notification_type = row.notification_type if row.notification_type in NOTIFICATION_TYPES else "system"
+        existing = unread.get(key)
+        if existing:
+            existing.title = row.title
+            existing.message = row.message
+            existing.created_at = row.created_at
+        else:
+            new.append({
+                "user_id": key[0], "title": row.title, "message": row.message,
+                "notification_type": notification_type, "group_key": row.group_key,
+                "is_read": False, "created_at": row.created_at, "updated_at": row.created_at,
+            })
+    if new:
+        db.session.execute(insert(Notification), new)
+    db.session.execute(delete(NotificationOutbox).where(NotificationOutbox.id.in_([row.id for row in rows])))
+    db.session.commit()
+    return len(rows)
+
+
+def dispatch_all(limit=NOTIFICATION_BATCH_SIZE):
+    """Drain the outbox. Returns how many rows were consumed."""
+    total = 0
+    while True:
+        consumed = dispatch_batch(limit)
+        total += consumed
+        if consumed < limit:
+            return total
+
+
+@click.command("dispatch-notifications")
+@click.option("--batch-size", default=NOTIFICATION_BATCH_SIZE, help="outbox rows per batch")
+@with_appcontext
+def dispatch_notifications_command(batch_size):
+    """Deliver notifications left in the outbox."""
+    click.echo(f"Delivered {dispatch_all(batch_size)} outbox rows")
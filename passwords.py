@@ -0,0 +1,132 @@
+"""Password hashing with a configurable bcrypt work factor.
+
+The cost is read from ``BCRYPT_LOG_ROUNDS`` in the app config. Hashes made
+with a different cost (and legacy plain text passwords) are reported by
+``needs_rehash`` so Login can upgrade them transparently.
+
+Request handlers hash and verify through ``hash_offloaded`` and
+``verify_offloaded``, which run bcrypt on a small bounded thread pool. When
+the pool and its queue are full they raise ``HashingPoolSaturated`` straight
+away so auth bursts are turned away with a 429 instead of tying up the
+worker that also serves catalog traffic, and raise ``HashingTimedOut`` when
+a hash isn't done within PASSWORD_HASH_TIMEOUT seconds.
+
+This only helps when a worker serves several requests at once: under
+gunicorn's default sync workers the pool never holds more than one job and
+a login still blocks every other route on that worker. The Procfile runs
+gthread workers (GUNICORN_THREADS request threads each) for that reason.
+"""
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from flask import current_app
+from flask_bcrypt import check_password_hash, generate_password_hash
+import os
+import threading
+
+DEFAULT_LOG_ROUNDS = int(os.getenv("BCRYPT_LOG_ROUNDS", 12))
+
+# bcrypt releases the GIL, so threads give real parallelism here
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+HASH_QUEUE_SIZE = int(os.getenv("PASSWORD_HASH_QUEUE", 8))
+HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", 10))
+
+
+def log_rounds():
+    """The configured bcrypt cost for new hashes"""
+    return current_app.config.get("BCRYPT_LOG_ROUNDS", DEFAULT_LOG_ROUNDS)
+
+
+def hash_password(plain_password, rounds=None):
+    return generate_password_hash(plain_password, rounds=rounds or log_rounds()).decode("utf-8")
+
+
+def hash_rounds(stored_password):
+    """Cost of a stored bcrypt hash ("$2b$12$..."), or None for anything that is not one"""
+    if isinstance(stored_password, bytes):
+        stored_password = stored_password.decode("utf-8")
+    parts = (stored_password or "").split("$")
+    if len(parts) != 4 or parts[1] not in ("2a", "2b", "2y") or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+def needs_rehash(stored_password):
+    return hash_rounds(stored_password) != log_rounds()
+
+
+def verify_password(stored_password, plain_password):
+    """Verify password - handles both bcrypt hashes and plain text (legacy)"""
+    if not stored_password or not plain_password:
+        return False
+
+    # Ensure both are strings for comparison
+    if isinstance(stored_password, bytes):
+        stored_password = stored_password.decode('utf-8')
+
+    try:
+        # First try bcrypt hash
+        return check_password_hash(stored_password, plain_password)
+    except (ValueError, TypeError):
+        # If bcrypt fails (invalid salt), try plain text comparison
+        # This handles legacy data or improperly hashed passwords
+        return stored_password == plain_password
+    except Exception:
+        # Catch any other unexpected errors
+        return False
+
+
+class HashingPoolSaturated(Exception):
+    """Raised when every hashing worker is busy and the queue is full"""
+
+
+class HashingTimedOut(Exception):
+    """Raised when a queued hash isn't done within the timeout"""
+
+
+class HashingPool:
+    """Thread pool that accepts at most ``workers + queue_size`` jobs at once"""
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def run(self, fn, *args, timeout=None):
+        if not self._slots.acquire(blocking=False):
+            raise HashingPoolSaturated()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            raise HashingTimedOut() from None
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def hashing_pool():
+    """Per-process pool, created lazily so gunicorn workers don't inherit dead threads"""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = HashingPool(HASH_WORKERS, HASH_QUEUE_SIZE)
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def hash_offloaded(plain_password):
+    """hash_password on the hashing pool. Raises HashingPoolSaturated when it is full, HashingTimedOut when slow."""
+    return hashing_pool().run(hash_password, plain_password, log_rounds(), timeout=HASH_TIMEOUT)
+
+
+def verify_offloaded(stored_password, plain_password):
+    """verify_password on the hashing pool. Raises HashingPoolSaturated when it is full, HashingTimedOut when slow."""
+    return hashing_pool().run(verify_password, stored_password, plain_password, timeout=HASH_TIMEOUT)
@@ -0,0 +1,73 @@
+"""Deleting a property and everything that hangs off it in one transaction.
+
+Rows that only make sense with the property are deleted: images, videos,
+locations links, amenities, views, inquiries, favorites and saved search
+matches, archived views and inquiries included. Conversations and reviews
+are about the agent as much as the listing, so they are kept and detached
+(property_id set to NULL). Properties with transactions are financial
+records and are refused. Removing the image and video files, and
+recomputing the market stats of the listing's segment, are queued as
+background jobs in the same transaction, so the request never waits on
+either.
+"""
+from sqlalchemy import delete, exists, select, update
+from models import (
+    db, Property, PropertyImage, PropertyVideo, PropertyLocation, PropertyAmenity, View, Inquiry, Favorite,
+    Conversation, Review, Transaction, ViewArchive, InquiryArchive, PropertySimilarity, SavedSearchMatch,
+)
+from media import queue_file_deletions, schedule_purge
+from market_stats import segments
+from listing_changes import listings_changed
+
+
+class PropertyHasTransactions(Exception):
+    """Raised when a property is referenced by sales/rental transactions"""
+
+
+# Child tables deleted with the property, as (model, foreign key column)
+DEPENDENTS = [
+    (PropertyImage, PropertyImage.property_id),
+    (PropertyVideo, PropertyVideo.propert_id),
+    (PropertyLocation, PropertyLocation.property_id),
+    (PropertyAmenity, PropertyAmenity.property_id),
+    (View, View.property_id),
+    (Inquiry, Inquiry.property_id),
+    (Favorite, Favorite.property_id),
+    (ViewArchive, ViewArchive.property_id),
+    (InquiryArchive, InquiryArchive.property_id),
+    (PropertySimilarity, PropertySimilarity.property_id),
+    (PropertySimilarity, PropertySimilarity.similar_property_id),
+    (SavedSearchMatch, SavedSearchMatch.property_id),
+]
+
+# Rows kept but detached from the property
+DETACHED = [
+    (Conversation, Conversation.property_id),
+    (Review, Review.property_id),
+]
+
+
+def delete_property(property_id, upload_folder):
+    """Delete a property and its dependents in the current transaction.
+
+    Returns the ids of the queued file deletions.
+    """
+    if db.session.scalar(select(exists().where(Transaction.property_id == property_id))):
+        raise PropertyHasTransactions(property_id)
+
+    touched_segments = segments(Property.id == property_id)
+    urls = list(db.session.scalars(select(PropertyImage.image_url).where(PropertyImage.property_id == property_id)))
+    urls += db.session.scalars(select(PropertyVideo.video_url).where(PropertyVideo.propert_id == property_id))
+
+    for model, column in DEPENDENTS:
+        db.session.execute(delete(model).where(column == property_id))
+    for model, column in DETACHED:
+        db.session.execute(update(model).where(column == property_id).values(property_id=None))
+    db.session.execute(delete(Property).where(Property.id == property_id))
+    listings_changed([property_id], touched_segments)
+
+    pending = queue_file_deletions(urls, upload_folder)
+    db.session.flush()
+    pending_ids = [row.id for row in pending]
+    schedule_purge(pending_ids)
+    return pending_ids
@@ -0,0 +1,167 @@
+"""Everything the property detail page needs, in a fixed number of queries.
+
+The public part of a page (listing, type, location, agent, images, videos
+and amenities) takes two queries whatever the listing looks like. It is
+cached per process for PROPERTY_PAGE_CACHE_TTL seconds. The viewer's own
+state (favorite, latest inquiry, next visit) takes one more query and is
+merged in per request, so the cached part never contains per-user data.
+Edits and deletes in this process drop the cached page straight away;
+other workers pick changes up when the TTL expires.
+"""
+from sqlalchemy import and_, exists, false, literal, select, union_all
+from models import (
+    db, Property, Property_type, AgentProfile, User, Location, PropertyLocation, PropertyImage, PropertyVideo,
+    Amenity, PropertyAmenity, Favorite, Inquiry, View,
+)
+from datetime import datetime
+import os
+import threading
+import time
+
+PROPERTY_PAGE_CACHE_TTL = float(os.getenv("PROPERTY_PAGE_CACHE_TTL", 30))
+_PAGE_CACHE_SIZE = 2000
+
+# property id -> (expires at, page)
+_pages = {}
+_pages_lock = threading.Lock()
+
+
+def forget_property_page(property_id):
+    with _pages_lock:
+        _pages.pop(int(property_id), None)
+
+
+def load_property_page(property_id):
+    """Public page data for a property, or None if it does not exist"""
+    now = time.monotonic()
+    with _pages_lock:
+        cached = _pages.get(property_id)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    page = _query_property_page(property_id)
+    if page is not None and PROPERTY_PAGE_CACHE_TTL > 0:
+        with _pages_lock:
+            if len(_pages) >= _PAGE_CACHE_SIZE:
+                _pages.clear()
+            _pages[property_id] = (now + PROPERTY_PAGE_CACHE_TTL, page)
+    return page
+
+
+def _query_property_page(property_id):
+    first_location_id = (
+        select(PropertyLocation.location_id)
+        .where(PropertyLocation.property_id == Property.id)
+        .order_by(PropertyLocation.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    row = db.session.execute(
+        select(Property, Property_type.name, AgentProfile, User, Location)
+        .outerjoin(Property_type, Property_type.id == Property.property_type_id)
+        .outerjoin(AgentProfile, AgentProfile.id == Property.agent_id)
+        .outerjoin(User, User.id == AgentProfile.user_id)
+        .outerjoin(Location, Location.id == first_location_id)
+        .where(Property.id == property_id)
+    ).first()
+    if row is None:
+        return None
+    prop, type_name, agent_profile, agent_user, location = row
+
+    # Images, videos and amenity names in one round trip
+    media = db.session.execute(union_all(
+        select(literal("image").label("kind"), PropertyImage.id, PropertyImage.image_url.label("value"),
+               PropertyImage.is_primary).where(PropertyImage.property_id == property_id),
+        select(literal("video"), PropertyVideo.id, PropertyVideo.video_url, false())
+        .where(PropertyVideo.propert_id == property_id),
+        select(literal("amenity"), Amenity.id, Amenity.name, false())
+        .join(PropertyAmenity, PropertyAmenity.amenity_id == Amenity.id)
+        .where(PropertyAmenity.property_id == property_id),
+    )).all()
+    media.sort(key=lambda m: (m.kind, m.id))
+
+    page = prop.to_dict(rules=("-amenity_mask",))
+    images = [m for m in media if m.kind == "image"]
+    primary = next((m.value for m in images if m.is_primary), None)
+    page['primary_image'] = primary
+    page['images'] = [m.value for m in images]
+    page['videos'] = [m.value for m in media if m.kind == "video"]
+    page['amenities'] = [m.value for m in media if m.kind == "amenity"]
+
+    if location:
+        page['location'] = {
+            'neighborhood': location.neighborhood,
+            'city': location.city,
+            'state': location.state,
+            'country': location.country,
+            'latitude': location.latitude,
+            'longitude': location.longitude
+        }
+    if type_name:
+        page['property_type'] = type_name
+    if agent_profile and agent_user:
+        page['agent'] = {
+            'id': agent_user.id,
+            'name': f"{agent_user.first_name} {agent_user.last_name}",
+            'email': agent_user.email,
+            'phone': agent_user.phone,
+            'bio': agent_profile.bio,
+            'rating': agent_profile.rating,
+            'license_number': agent_profile.license_number
+        }
+    return page
+
+
+def viewer_state(page, user_id=None, role=None, user_profile_id=None, agent_profile_id=None):
+    """Per-viewer fields for a page; one query for signed-in users, none otherwise"""
+    state = {
+        'is_authenticated': user_id is not None,
+        'is_owner': role == "agent" and agent_profile_id is not None and agent_profile_id == page.get('agent_id'),
+        'is_favorited': False,
+        'inquiry': None,
+        'next_visit': None,
+    }
+    if role != "user":
+        return state
+
+    property_id = page['id']
+
+    def latest_inquiry(column):
+        return (
+            select(column)
+            .where(Inquiry.user_id == user_id, Inquiry.property_id == property_id)
+            .order_by(Inquiry.created_at.desc(), Inquiry.id.desc())
+            .limit(1)
+            .scalar_subquery()
+        )
+
+    next_visit = (
+        select(View.sheduled_time)
+        .where(View.user_id == user_id, View.property_id == property_id, View.status == "pending",
+               View.sheduled_time >= datetime.now())
+        .order_by(View.sheduled_time)
+        .limit(1)
+        .scalar_subquery()
+    )
+    is_favorited = exists().where(
+        and_(Favorite.user_id == user_profile_id, Favorite.property_id == property_id)
+    ) if user_profile_id else false()
+
+    row = db.session.execute(select(
+        is_favorited.label("is_favorited"),
+        next_visit.label("next_visit"),
+        latest_inquiry(Inquiry.id).label("inquiry_id"),
+        latest_inquiry(Inquiry.status).label("inquiry_status"),
+        latest_inquiry(Inquiry.created_at).label("inquiry_created_at"),
+    )).first()
+
+    state['is_favorited'] = bool(row.is_favorited)
+    if row.next_visit:
+        state['next_visit'] = row.next_visit.isoformat()
+    if row.inquiry_id is not None:
+        state['inquiry'] = {
+            'id': row.inquiry_id,
+            'status': row.inquiry_status,
+            'created_at': row.inquiry_created_at.isoformat() if row.inquiry_created_at else None
+        }
+    return state
@@ -0,0 +1,269 @@
+"""Similar listings, precomputed offline.
+
+Every live listing becomes one row of a feature matrix. The columns are
+log price, bedrooms, bathrooms, log area and coordinates, each imputed and
+standardised, plus one-hot listing type, property type, city and
+neighbourhood. Columns are weighted by FEATURE_WEIGHTS and named, so vectors
+built against one matrix (see feed.py) can be mapped onto the next. Neighbours are found only among listings
+with the same listing_type (sale prices and monthly rents are not
+comparable). Squared distances are computed a block of rows at a time,
+with one matrix product per block, and np.argpartition picks the top k. The
+block height is chosen so each block temporary stays within
+SIMILARITY_MEMORY_MB.
+
+``flask build-similar`` (run it from cron or the job runner) computes every
+neighbour first and only then replaces the ``property_similarities`` table
+in one short transaction. ``similar_properties`` then serves a listing's
+neighbours with a single primary-key range read.
+"""
+from dataclasses import dataclass
+from flask.cli import with_appcontext
+from sqlalchemy import delete, insert, select
+from models import db, Property, PropertyImage, PropertyLocation, Location, PropertySimilarity
+from amenities import decode_mask
+import click
+import numpy as np
+import os
+import time
+
+SIMILAR_NEIGHBORS = int(os.getenv("SIMILAR_NEIGHBORS", 12))
+# Rough cap on each (block rows x listings) temporary; several are alive at once
+SIMILARITY_MEMORY_MB = float(os.getenv("SIMILARITY_MEMORY_MB", 64))
+INSERT_BATCH_SIZE = 5000
+
+FEATURE_WEIGHTS = {
+    "price": 2.0,
+    "bedrooms": 1.0,
+    "bathrooms": 0.5,
+    "area": 1.0,
+    "geo": 1.0,
+    "listing_type": 2.0,
+    "property_type": 1.5,
+    "city": 1.0,
+    "neighborhood": 1.0,
+}
+
+
+NUMERIC_COLUMNS = ["price", "bedrooms", "bathrooms", "area", "latitude", "longitude"]
+
+
+@dataclass
+class FeatureMatrix:
+    ids: np.ndarray
+    matrix: np.ndarray
+    columns: list
+
+
+def load_listings():
+    """Live listings with the columns the feature matrix is built from"""
+    first_location_id = (
+        select(PropertyLocation.location_id)
+        .where(PropertyLocation.property_id == Property.id)
+        .order_by(PropertyLocation.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    return db.session.execute(
+        select(
+            Property.id, Property.listing_type, Property.price, Property.bedrooms, Property.bathrooms,
+            Property.area_size, Property.property_type_id, Location.id.label("location_id"), Location.city,
+            Location.latitude, Location.longitude,
+        )
+        .outerjoin(Location, Location.id == first_location_id)
+        .where(Property.archived_at.is_(None))
+        .order_by(Property.id)
+    ).all()
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _standardize(column):
+    """Impute missing values with the mean, then scale to zero mean and unit variance"""
+    column = np.asarray(column, dtype=np.float64)
+    if np.isnan(column).all():
+        return np.zeros_like(column)
+    mean = np.nanmean(column)
+    column = np.where(np.isnan(column), mean, column)
+    std = column.std()
+    return (column - mean) / std if std > 0 else column - mean
+
+
+def _one_hot(name, values):
+    """One-hot columns scaled so two different categories are FEATURE_WEIGHTS[name] apart, and their names"""
+    categories, codes = np.unique(np.array([str(v) for v in values]), return_inverse=True)
+    encoded = np.zeros((len(values), len(categories)), dtype=np.float64)
+    encoded[np.arange(len(values)), codes] = FEATURE_WEIGHTS[name] / np.sqrt(2)
+    return encoded, [f"{name}:{category}" for category in categories]
+
+
+def build_feature_matrix(rows):
+    """FeatureMatrix for rows shaped like load_listings() output"""
+    ids = np.array([row.id for row in rows], dtype=np.int64)
+    if not rows:
+        return FeatureMatrix(ids, np.zeros((0, 0), dtype=np.float32), [])
+
+    price = np.log1p(np.array([_float(row.price) for row in rows]).clip(min=0))
+    area = np.log1p(np.array([_float(row.area_size) for row in rows]).clip(min=0))
+    columns = [
+        FEATURE_WEIGHTS["price"] * _standardize(price),
+        FEATURE_WEIGHTS["bedrooms"] * _standardize([_float(row.bedrooms) for row in rows]),
+        FEATURE_WEIGHTS["bathrooms"] * _standardize([_float(row.bathrooms) for row in rows]),
+        FEATURE_WEIGHTS["area"] * _standardize(area),
+        FEATURE_WEIGHTS["geo"] * _standardize([_float(row.latitude) for row in rows]),
+        FEATURE_WEIGHTS["geo"] * _standardize([_float(row.longitude) for row in rows]),
+    ]
+    names = list(NUMERIC_COLUMNS)
+    for name, values in (
+        ("listing_type", [(row.listing_type or "").lower() for row in rows]),
+        ("property_type", [row.property_type_id for row in rows]),
+        ("city", [(row.city or "").lower() for row in rows]),
+        ("neighborhood", [row.location_id for row in rows]),
+    ):
+        encoded, encoded_names = _one_hot(name, values)
+        columns.append(encoded)
+        names += encoded_names
+    return FeatureMatrix(ids, np.column_stack(columns).astype(np.float32), names)
+
+
+def block_rows_for(n, budget_bytes=None):
+    """Rows per block so one block of 8-byte distances to ``n`` listings fits the memory budget"""
+    if budget_bytes is None:
+        budget_bytes = SIMILARITY_MEMORY_MB * 1024 * 1024
+    return max(1, int(budget_bytes // (8 * max(n, 1))))
+
+
+def nearest_neighbors(matrix, k, block_rows=None):
+    """(indices, distances) of the k nearest rows for every row, excluding itself, closest first"""
+    n = len(matrix)
+    k = min(k, n - 1)
+    if k <= 0:
+        return np.zeros((n, 0), dtype=np.int64), np.zeros((n, 0), dtype=np.float32)
+    block_rows = block_rows or block_rows_for(n)
+
+    squared = (matrix * matrix).sum(axis=1)
+    indices = np.empty((n, k), dtype=np.int64)
+    distances = np.empty((n, k), dtype=np.float32)
+    for start in range(0, n, block_rows):
+        stop = min(start + block_rows, n)
+        block = squared[start:stop, None] + squared[None, :] - 2 * (matrix[start:stop] @ matrix.T)
+        block[np.arange(stop - start), np.arange(start, stop)] = np.inf
+        top = np.argpartition(block, k - 1, axis=1)[:, :k]
+        top_distances = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(top_distances, axis=1, kind="stable")
+        indices[start:stop] = np.take_along_axis(top, order, axis=1)
+        distances[start:stop] = np.sqrt(np.maximum(np.take_along_axis(top_distances, order, axis=1), 0))
+    return indices, distances
+
+
+def neighbor_groups(rows, k=SIMILAR_NEIGHBORS):
+    """(ids, indices, distances) for each listing type among rows shaped like load_listings() output"""
+    groups = {}
+    for row in rows:
+        groups.setdefault((row.listing_type or "").lower(), []).append(row)
+
+    for group in groups.values():
+        features = build_feature_matrix(group)
+        yield (features.ids, *nearest_neighbors(features.matrix, k))
+
+
+def similarity_rows(groups):
+    """property_similarities rows for the output of neighbor_groups()"""
+    for ids, indices, distances in groups:
+        for i, property_id in enumerate(ids.tolist()):
+            for rank, (j, distance) in enumerate(zip(indices[i].tolist(), distances[i].tolist())):
+                yield {
+                    "property_id": property_id,
+                    "rank": rank,
+                    "similar_property_id": int(ids[j]),
+                    "score": round(1.0 / (1.0 + distance), 6),
+                }
+
+
+def compute_similarities(rows, k=SIMILAR_NEIGHBORS):
+    """Yield property_similarities rows for listings shaped like load_listings() output"""
+    return similarity_rows(neighbor_groups(rows, k))
+
+
+def rebuild_similarities(k=SIMILAR_NEIGHBORS):
+    """Recompute every listing's neighbours and swap them in atomically. Returns rows written."""
+    rows = load_listings()
+    # End the read transaction so nothing is locked during the NumPy pass
+    db.session.commit()
+    groups = list(neighbor_groups(rows, k))
+
+    written = 0
+    batch = []
+    # Readers keep seeing the previous neighbours until the commit
+    db.session.execute(delete(PropertySimilarity))
+    for similarity in similarity_rows(groups):
+        batch.append(similarity)
+        if len(batch) >= INSERT_BATCH_SIZE:
+            db.session.execute(insert(PropertySimilarity), batch)
+            written += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(PropertySimilarity), batch)
+        written += len(batch)
+    db.session.commit()
+    return written
+
+
+def card_columns():
+    """Columns of a listing card: the listing summary plus its primary image"""
+    primary_image = (
+        select(PropertyImage.image_url)
+        .where(PropertyImage.property_id == Property.id, PropertyImage.is_primary.is_(True))
+        .limit(1)
+        .scalar_subquery()
+    )
+    return [
+        Property.id, Property.title, Property.price, Property.currency, Property.listing_type, Property.status,
+        Property.bedrooms, Property.bathrooms, Property.area_size, Property.area_unit, Property.amenity_mask,
+        primary_image.label("image"),
+    ]
+
+
+def card(row):
+    """A listing card dict from a row selected with card_columns()"""
+    values = dict(row._mapping)
+    values["amenities"] = decode_mask(values.pop("amenity_mask"))
+    return values
+
+
+def property_cards(property_ids):
+    """Cards for the live listings among ``property_ids``, in the given order, in one query"""
+    if not property_ids:
+        return []
+    rows = db.session.execute(
+        select(*card_columns()).where(Property.id.in_(property_ids), Property.archived_at.is_(None))
+    )
+    cards = {row.id: card(row) for row in rows}
+    return [cards[property_id] for property_id in property_ids if property_id in cards]
+
+
+def similar_properties(property_id, limit=SIMILAR_NEIGHBORS):
+    """Live neighbours of a listing, best first, as listing cards"""
+    rows = db.session.execute(
+        select(*card_columns(), PropertySimilarity.score)
+        .join(Property, Property.id == PropertySimilarity.similar_property_id)
+        .where(PropertySimilarity.property_id == property_id, Property.archived_at.is_(None))
+        .order_by(PropertySimilarity.rank)
+        .limit(limit)
+    )
+    return [card(row) for row in rows]
+
+
+@click.command("build-similar")
+@click.option("--neighbors", default=SIMILAR_NEIGHBORS, help="neighbours stored per listing")
+@with_appcontext
+def build_similar_command(neighbors):
+    """Precompute similar listings into property_similarities."""
+    db.create_all()
+    started = time.perf_counter()
+    written = rebuild_similarities(neighbors)
+    click.echo(f"Stored {written} neighbours in {time.perf_counter() - started:.1f}s")
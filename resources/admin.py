@@ -2,6 +2,7 @@ from flask import request
 from flask_restful import Resource, reqparse
 from models import db, User, Property, Payment, PropertyImage, PropertyLocation, Location, Property_type, AgentProfile, PropertyAmenity, Amenity
 from utils import admin_required
+from database import pool_stats
 
 from flask import request
 from flask_restful import Resource, reqparse
@@ -91,11 +92,11 @@ class RecentUsers(Resource):
 
 class PropertyResource(Resource):
     def get(self):
-        properties = Property.query.all()
+        properties = Property.query.filter(Property.archived_at.is_(None)).all()
 
         result = []
         for property in properties:
-            prop_dict = property.to_dict()
+            prop_dict = property.to_dict(rules=("-amenity_mask",))
             # Get the primary image for this property
             primary_image = PropertyImage.query.filter_by(property_id = property.id, is_primary=True).first()
 
@@ -115,3 +116,10 @@ class PropertyResource(Resource):
         return result, 200
 
 
+
+
+class DatabasePoolResource(Resource):
+    @admin_required()
+    def get(self):
+        """Connection pool checkout/wait counters for this worker process"""
+        return pool_stats.snapshot(db.engine.pool), 200
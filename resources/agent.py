@@ -1,10 +1,22 @@
-from flask import request, send_from_directory
-from models import db, AgentProfile, Property, Inquiry, View, Payment, PropertyImage, PropertyVideo, User, Property_type, Location, PropertyLocation
+from flask import request, send_from_directory, g, Response, stream_with_context
+from models import db, AgentProfile, Property, Inquiry, View, Payment, PropertyImage, PropertyVideo, User, Property_type, Location, PropertyLocation, AgentAvailability, InquiryArchive
 from flask_restful import Resource
 from flask_jwt_extended import get_jwt_identity
-from utils import agent_required
-from datetime import datetime
-from sqlalchemy import func
+from utils import agent_required, parse_date
+from scheduling import DEFAULT_SLOT_MINUTES
+from locations import resolve_location
+from media import queue_file_deletions, schedule_purge
+from property_deletion import PropertyHasTransactions, delete_property
+from archival import view_counts
+from analytics import INTERVALS, agent_analytics
+from property_pages import forget_property_page
+from market_stats import segments
+from listing_changes import listings_changed
+from amenities import parse_amenity_ids, set_amenities, decode_mask, mask_ids
+from bulk_properties import FORMATS, PropertyImporter, detect_format, read_rows, export_stream
+from datetime import datetime, timedelta
+from sqlalchemy import func, select
+import csv
 import os
 
 # Configure upload folder - same as in app.py
@@ -15,38 +27,41 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 class AgentStatsResource(Resource):
     @agent_required()
     def get(self):
-        # Get current agent's ID from JWT
-        current_user_id = get_jwt_identity()
+        # Agent profile id is resolved from the token by agent_required
+        agent_profile_id = g.agent_profile_id
 
-        # Get the agents profile to get all listed properties
-        agent_profile = AgentProfile.query.filter_by(user_id=current_user_id).first()
+        # Archived listings, views and inquiries are only counted on request
+        include_archived = request.args.get('include_archived', 'false').lower() == 'true'
 
         # Count number of listings
         listings_count = 0
-        if agent_profile:
-            listings_count = Property.query.filter_by(agent_id=agent_profile.id).count()
+        if agent_profile_id:
+            listings = Property.query.filter_by(agent_id=agent_profile_id)
+            if not include_archived:
+                listings = listings.filter(Property.archived_at.is_(None))
+            listings_count = listings.count()
 
         # Count Inquiries
-        inquiries_count = Inquiry.query.filter_by(agent_id=agent_profile.id).count()
+        inquiries_count = Inquiry.query.filter_by(agent_id=agent_profile_id).count()
+        if include_archived:
+            inquiries_count += InquiryArchive.query.filter_by(agent_id=agent_profile_id).count()
 
         # Count viewings - get all properties owned by the agent, then count views for those properties
         property_ids = []
-        if agent_profile:
-            agent_properties = Property.query.filter_by(agent_id=agent_profile.id).all()
+        if agent_profile_id:
+            agent_properties = Property.query.with_entities(Property.id).filter_by(agent_id=agent_profile_id).all()
             property_ids = [p.id for p in agent_properties]
         
-        viewings_count = 0
-        if property_ids:
-            viewings_count = View.query.filter(View.property_id.in_(property_ids)).count()
+        viewings_count = sum(view_counts(property_ids, include_archived).values())
 
         # Count monthly revenue - filter by current agent and status "complete"
         now = datetime.now()
         start_of_month = datetime(now.year, now.month, 1)
         
         monthly_revenue = 0
-        if agent_profile:
+        if agent_profile_id:
             monthly_revenue = db.session.query(db.func.sum(Payment.amount)).filter(
-                Payment.agent_id == agent_profile.id,
+                Payment.agent_id == agent_profile_id,
                 Payment.status == "complete",
                 Payment.created_at >= start_of_month
             ).scalar() or 0
@@ -59,34 +74,76 @@ class AgentStatsResource(Resource):
         }, 200
 
 
+ANALYTICS_MAX_DAYS = 3 * 366
+
+
+class AgentAnalyticsResource(Resource):
+    @agent_required()
+    def get(self):
+        """Get the agent's views, visits, inquiries, favorites and revenue over time.
+
+        ``from``/``to`` (YYYY-MM-DD, default the last 30 days), ``interval``
+        (day, week or month) and an optional ``property_id`` to look at one
+        listing. Figures come from the fact table filled by
+        ``flask aggregate-analytics``.
+        """
+        agent_profile_id = g.agent_profile_id
+        
+        if not agent_profile_id:
+            return {"message": "Agent profile not found"}, 404
+        
+        end = (parse_date(request.args.get('to')) or datetime.now()).date()
+        start = (parse_date(request.args.get('from')) or datetime.combine(end - timedelta(days=29), datetime.min.time())).date()
+        
+        if end < start:
+            return {"message": "'to' must not be before 'from'"}, 400
+        if (end - start).days >= ANALYTICS_MAX_DAYS:
+            return {"message": f"Date range is limited to {ANALYTICS_MAX_DAYS} days"}, 400
+        
+        interval = request.args.get('interval', 'day')
+        if interval not in INTERVALS:
+            return {"message": f"interval must be one of: {', '.join(INTERVALS)}"}, 400
+        
+        analytics = agent_analytics(
+            agent_profile_id, start, end,
+            interval=interval,
+            property_id=request.args.get('property_id', type=int)
+        )
+        
+        return {"from": start.isoformat(), "to": end.isoformat(), "interval": interval, **analytics}, 200
+
+
 class AgentPropertiesResource(Resource):
     @agent_required()
     def get(self):
         """Get agent's recent properties with view counts"""
-        current_user_id = get_jwt_identity()
-        agent_profile = AgentProfile.query.filter_by(user_id=current_user_id).first()
+        agent_profile_id = g.agent_profile_id
         
-        if not agent_profile:
+        if not agent_profile_id:
             return {"properties": []}, 200
         
         # Get limit from query params (default 5)
         limit = request.args.get('limit', 5, type=int)
+        include_archived = request.args.get('include_archived', 'false').lower() == 'true'
         
         # Get properties with view counts
-        properties = Property.query.filter_by(agent_id=agent_profile.id).order_by(
-            Property.created_at.desc()
-        ).limit(limit).all()
+        properties = Property.query.filter_by(agent_id=agent_profile_id)
+        if not include_archived:
+            properties = properties.filter(Property.archived_at.is_(None))
+        properties = properties.order_by(Property.created_at.desc()).limit(limit).all()
+        
+        # Count views and load primary images for all listed properties at once
+        property_ids = [prop.id for prop in properties]
+        view_count_by_property = view_counts(property_ids, include_archived)
+        primary_images = dict(db.session.execute(
+            select(PropertyImage.property_id, PropertyImage.image_url)
+            .where(PropertyImage.property_id.in_(property_ids), PropertyImage.is_primary.is_(True))
+            .order_by(PropertyImage.id.desc())
+        ).all())
         
         properties_data = []
         for prop in properties:
-            # Get primary image
-            primary_image = PropertyImage.query.filter_by(
-                property_id=prop.id, 
-                is_primary=True
-            ).first()
-            
-            # Count views for this property
-            view_count = View.query.filter_by(property_id=prop.id).count()
+            view_count = view_count_by_property.get(prop.id, 0)
             
             properties_data.append({
                 "id": prop.id,
@@ -97,8 +154,10 @@ class AgentPropertiesResource(Resource):
                 "status": prop.status,
                 "bedrooms": prop.bedrooms,
                 "bathrooms": prop.bathrooms,
+                "amenities": decode_mask(prop.amenity_mask),
                 "views": view_count,
-                "image": primary_image.image_url if primary_image else None,
+                "image": primary_images.get(prop.id),
+                "archived": prop.archived_at is not None,
                 "created_at": prop.created_at.isoformat() if prop.created_at else None
             })
         
@@ -109,26 +168,28 @@ class AgentInquiriesResource(Resource):
     @agent_required()
     def get(self):
         """Get agent's recent inquiries"""
-        current_user_id = get_jwt_identity()
-        agent_profile = AgentProfile.query.filter_by(user_id=current_user_id).first()
+        agent_profile_id = g.agent_profile_id
         
-        if not agent_profile:
+        if not agent_profile_id:
             return {"inquiries": []}, 200
         
         # Get limit from query params (default 5)
         limit = request.args.get('limit', 5, type=int)
         
         # Get recent inquiries with user and property info
-        inquiries = Inquiry.query.filter_by(agent_id=agent_profile.id).order_by(
+        inquiries = Inquiry.query.filter_by(agent_id=agent_profile_id).order_by(
             Inquiry.created_at.desc()
         ).limit(limit).all()
         
+        # Load the senders and properties of the whole page at once
+        users = {user.id: user for user in User.query.filter(User.id.in_({i.user_id for i in inquiries}))}
+        titles = dict(db.session.execute(
+            select(Property.id, Property.title).where(Property.id.in_({i.property_id for i in inquiries}))
+        ).all())
+        
         inquiries_data = []
         for inquiry in inquiries:
-            # Get user info
-            user = User.query.get(inquiry.user_id)
-            # Get property info
-            property = Property.query.get(inquiry.property_id)
+            user = users.get(inquiry.user_id)
             
             # Calculate time ago
             time_ago = ""
@@ -146,7 +207,7 @@ class AgentInquiriesResource(Resource):
                 "user_id": inquiry.user_id,
                 "name": f"{user.first_name} {user.last_name}" if user else "Unknown",
                 "property_id": inquiry.property_id,
-                "property": property.title if property else "Unknown Property",
+                "property": titles.get(inquiry.property_id, "Unknown Property"),
                 "message": inquiry.message,
                 "status": inquiry.status,
                 "time": time_ago,
@@ -160,14 +221,13 @@ class AgentPropertyDetailResource(Resource):
     @agent_required()
     def get(self, property_id):
         """Get single property details for agent"""
-        current_user_id = get_jwt_identity()
-        agent_profile = AgentProfile.query.filter_by(user_id=current_user_id).first()
+        agent_profile_id = g.agent_profile_id
         
-        if not agent_profile:
+        if not agent_profile_id:
             return {"message": "Agent profile not found"}, 404
         
         # Get property that belongs to this agent
-        property = Property.query.filter_by(id=property_id, agent_id=agent_profile.id).first()
+        property = Property.query.filter_by(id=property_id, agent_id=agent_profile_id).first()
         
         if not property:
             return {"message": "Property not found"}, 404
@@ -223,6 +283,8 @@ class AgentPropertyDetailResource(Resource):
                 "listing_date": property.listing_date.isoformat() if property.listing_date else None,
                 "property_type_id": property.property_type_id,
                 "property_type": property_type.name if property_type else None,
+                "amenity_ids": mask_ids(property.amenity_mask),
+                "amenities": decode_mask(property.amenity_mask),
                 "views": view_count,
                 "created_at": property.created_at.isoformat() if property.created_at else None,
             },
@@ -244,10 +306,9 @@ class AgentPropertyCreateResource(Resource):
     @agent_required()
     def post(self):
         """Create a new property"""
-        current_user_id = get_jwt_identity()
-        agent_profile = AgentProfile.query.filter_by(user_id=current_user_id).first()
+        agent_profile_id = g.agent_profile_id
         
-        if not agent_profile:
+        if not agent_profile_id:
             return {"message": "Agent profile not found"}, 404
         
         # DEBUG: Log what's being received
@@ -285,6 +346,11 @@ class AgentPropertyCreateResource(Resource):
             print(f"=== DEBUG: Missing fields: {missing} ===")
             return {"message": "Title, price, listing type, and property type are required", "missing_fields": missing}, 400
         
+        # Amenity ids as "1,3" or a JSON list
+        amenity_ids = parse_amenity_ids(request.form.get('amenities'))
+        if amenity_ids is None:
+            return {"message": "Invalid or unknown amenities"}, 400
+        
         # Create property
         property = Property(
             title=title,
@@ -294,7 +360,7 @@ class AgentPropertyCreateResource(Resource):
             listing_type=listing_type,
             status=status,
             property_type_id=int(property_type_id),
-            agent_id=agent_profile.id,
+            agent_id=agent_profile_id,
             bedrooms=bedrooms,
             bathrooms=bathrooms,
             area_size=area_size,
@@ -304,6 +370,7 @@ class AgentPropertyCreateResource(Resource):
         
         db.session.add(property)
         db.session.flush()  # Get property ID
+        set_amenities(property.id, amenity_ids)
         
         # Handle images
         images = request.files.getlist('images')
@@ -346,20 +413,23 @@ class AgentPropertyCreateResource(Resource):
         # Handle location
         city = request.form.get('city')
         neighborhood = request.form.get('neighborhood')
-        if city or neighborhood:
-            location = Location(
-                city=city,
-                neighborhood=neighborhood
-            )
-            db.session.add(location)
-            db.session.flush()
-            
+        location_id = resolve_location(
+            country=request.form.get('country'),
+            state=request.form.get('state'),
+            city=city,
+            neighborhood=neighborhood,
+            latitude=request.form.get('latitude'),
+            longitude=request.form.get('longitude')
+        )
+        if location_id:
             prop_location = PropertyLocation(
                 property_id=property.id,
-                location_id=location.id
+                location_id=location_id
             )
             db.session.add(prop_location)
         
+        db.session.flush()
+        listings_changed([property.id])
         db.session.commit()
         
         return {
@@ -372,18 +442,23 @@ class AgentPropertyUpdateResource(Resource):
     @agent_required()
     def put(self, property_id):
         """Update an existing property"""
-        current_user_id = get_jwt_identity()
-        agent_profile = AgentProfile.query.filter_by(user_id=current_user_id).first()
+        agent_profile_id = g.agent_profile_id
         
-        if not agent_profile:
+        if not agent_profile_id:
             return {"message": "Agent profile not found"}, 404
         
         # Get property that belongs to this agent
-        property = Property.query.filter_by(id=property_id, agent_id=agent_profile.id).first()
+        property = Property.query.filter_by(id=property_id, agent_id=agent_profile_id).first()
         
         if not property:
             return {"message": "Property not found"}, 404
         
+        # Market stats segments the listing leaves, refreshed with the ones it joins
+        touched_segments = segments(Property.id == property.id)
+        
+        # Editing a listing brings it back from the archive
+        property.archived_at = None
+        
         # Update fields
         if request.form.get('title'):
             property.title = request.form.get('title')
@@ -408,6 +483,14 @@ class AgentPropertyUpdateResource(Resource):
         if request.form.get('area_unit'):
             property.area_unit = request.form.get('area_unit')
         
+        # Amenities are replaced when the field is sent, even empty
+        if 'amenities' in request.form:
+            amenity_ids = parse_amenity_ids(request.form.get('amenities'))
+            if amenity_ids is None:
+                db.session.rollback()
+                return {"message": "Invalid or unknown amenities"}, 400
+            set_amenities(property.id, amenity_ids)
+        
         # Handle new images
         images = request.files.getlist('images')
         for image in images:
@@ -426,16 +509,21 @@ class AgentPropertyUpdateResource(Resource):
                 )
                 db.session.add(prop_image)
         
+        # Files behind removed images/videos, deleted after commit
+        removed_urls = []
+        
         # Handle existing images to keep
         existing_images = request.form.get('existing_images')
         if existing_images:
             import json
             kept_images = json.loads(existing_images)
             # Keep only the specified images, delete others
-            PropertyImage.query.filter(
+            dropped_images = PropertyImage.query.filter(
                 PropertyImage.property_id == property.id,
                 ~PropertyImage.id.in_(kept_images)
-            ).delete(synchronize_session=False)
+            )
+            removed_urls += [image.image_url for image in dropped_images.with_entities(PropertyImage.image_url)]
+            dropped_images.delete(synchronize_session=False)
         
         # Handle new videos
         videos = request.files.getlist('videos')
@@ -455,12 +543,20 @@ class AgentPropertyUpdateResource(Resource):
         if existing_videos:
             import json
             kept_videos = json.loads(existing_videos)
-            PropertyVideo.query.filter(
+            dropped_videos = PropertyVideo.query.filter(
                 PropertyVideo.propert_id == property.id,
                 ~PropertyVideo.id.in_(kept_videos)
-            ).delete(synchronize_session=False)
-        
+            )
+            removed_urls += [video.video_url for video in dropped_videos.with_entities(PropertyVideo.video_url)]
+            dropped_videos.delete(synchronize_session=False)
+        
+        pending_files = queue_file_deletions(removed_urls, UPLOAD_FOLDER)
+        db.session.flush()
+        # Files are removed and market stats refreshed by background jobs after the commit
+        schedule_purge([row.id for row in pending_files])
+        listings_changed([property.id], touched_segments)
         db.session.commit()
+        forget_property_page(property.id)
         
         return {
             "message": "Property updated successfully",
@@ -472,28 +568,154 @@ class AgentPropertyDeleteResource(Resource):
     @agent_required()
     def delete(self, property_id):
         """Delete a property"""
-        current_user_id = get_jwt_identity()
-        agent_profile = AgentProfile.query.filter_by(user_id=current_user_id).first()
+        agent_profile_id = g.agent_profile_id
         
-        if not agent_profile:
+        if not agent_profile_id:
             return {"message": "Agent profile not found"}, 404
         
         # Get property that belongs to this agent
-        property = Property.query.filter_by(id=property_id, agent_id=agent_profile.id).first()
+        property = Property.query.filter_by(id=property_id, agent_id=agent_profile_id).first()
         
         if not property:
             return {"message": "Property not found"}, 404
         
-        # Delete related records first
-        PropertyImage.query.filter_by(property_id=property.id).delete(synchronize_session=False)
-        PropertyVideo.query.filter_by(propert_id=property.id).delete(synchronize_session=False)
-        PropertyLocation.query.filter_by(property_id=property.id).delete(synchronize_session=False)
-        View.query.filter_by(property_id=property.id).delete(synchronize_session=False)
-        Inquiry.query.filter_by(property_id=property.id).delete(synchronize_session=False)
-        
-        # Delete property
-        db.session.delete(property)
+        try:
+            # Files are removed in the background once the rows are gone
+            delete_property(property.id, UPLOAD_FOLDER)
+        except PropertyHasTransactions:
+            db.session.rollback()
+            return {"message": "Property has transactions and cannot be deleted"}, 409
         db.session.commit()
+        forget_property_page(property_id)
         
         return {"message": "Property deleted successfully"}, 200
 
+
+
+class AgentAvailabilityResource(Resource):
+    @agent_required()
+    def get(self):
+        """Get the agent's weekly visit availability"""
+        agent_profile_id = g.agent_profile_id
+        
+        if not agent_profile_id:
+            return {"message": "Agent profile not found"}, 404
+        
+        windows = AgentAvailability.query.filter_by(agent_id=agent_profile_id).order_by(
+            AgentAvailability.weekday, AgentAvailability.start_minute
+        ).all()
+        
+        return {
+            "is_default": not windows,
+            "windows": [
+                {
+                    "weekday": w.weekday,
+                    "start": f"{w.start_minute // 60:02d}:{w.start_minute % 60:02d}",
+                    "end": f"{w.end_minute // 60:02d}:{w.end_minute % 60:02d}",
+                    "slot_minutes": w.slot_minutes
+                }
+                for w in windows
+            ]
+        }, 200
+    
+    @agent_required()
+    def put(self):
+        """Replace the agent's weekly visit availability"""
+        agent_profile_id = g.agent_profile_id
+        
+        if not agent_profile_id:
+            return {"message": "Agent profile not found"}, 404
+        
+        data = request.get_json() or {}
+        windows = data.get('windows')
+        
+        if not isinstance(windows, list):
+            return {"message": "A list of windows is required"}, 400
+        
+        new_windows = []
+        for window in windows:
+            try:
+                weekday = int(window['weekday'])
+                start = datetime.strptime(window['start'], "%H:%M")
+                end = datetime.strptime(window['end'], "%H:%M")
+                slot_minutes = int(window.get('slot_minutes', DEFAULT_SLOT_MINUTES))
+            except (KeyError, TypeError, ValueError):
+                return {"message": "Each window needs weekday, start (HH:MM) and end (HH:MM)"}, 400
+            
+            start_minute = start.hour * 60 + start.minute
+            end_minute = end.hour * 60 + end.minute
+            if not 0 <= weekday <= 6 or slot_minutes <= 0 or start_minute + slot_minutes > end_minute:
+                return {"message": "Invalid availability window", "window": window}, 400
+            
+            new_windows.append(AgentAvailability(
+                agent_id=agent_profile_id,
+                weekday=weekday,
+                start_minute=start_minute,
+                end_minute=end_minute,
+                slot_minutes=slot_minutes
+            ))
+        
+        AgentAvailability.query.filter_by(agent_id=agent_profile_id).delete(synchronize_session=False)
+        db.session.add_all(new_windows)
+        db.session.commit()
+        
+        return {"message": "Availability updated successfully", "windows": len(new_windows)}, 200
+
+
+class AgentPropertyImportResource(Resource):
+    @agent_required()
+    def post(self):
+        """Bulk create properties from a CSV or NDJSON upload"""
+        agent_profile_id = g.agent_profile_id
+        
+        if not agent_profile_id:
+            return {"message": "Agent profile not found"}, 404
+        
+        # Either a multipart "file" field or the raw request body
+        upload = request.files.get('file') if request.mimetype == 'multipart/form-data' else None
+        if upload:
+            fmt = detect_format(upload.mimetype, upload.filename, request.args.get('format'))
+            stream = upload.stream
+        else:
+            fmt = detect_format(request.mimetype, requested=request.args.get('format'))
+            stream = request.stream
+        
+        if not fmt:
+            return {"message": "Upload a .csv or .ndjson file, or pass format=csv|ndjson"}, 400
+        
+        dry_run = request.args.get('dry_run', 'false').lower() == 'true'
+        importer = PropertyImporter(agent_profile_id, dry_run=dry_run)
+        try:
+            completed = importer.run(read_rows(stream, fmt))
+        except (UnicodeDecodeError, csv.Error) as e:
+            importer.flush()
+            return {"message": f"Could not read the file: {e}", **importer.report()}, 400
+        
+        report = importer.report()
+        if not completed:
+            report["message"] = f"Import stopped after {report['rows']} rows, split the file and upload the rest"
+            return report, 413
+        
+        report["message"] = "Import checked" if dry_run else "Import finished"
+        return report, 200 if importer.imported or not importer.failed else 422
+
+
+class AgentPropertyExportResource(Resource):
+    @agent_required()
+    def get(self):
+        """Stream the agent's listings as CSV or NDJSON"""
+        agent_profile_id = g.agent_profile_id
+        
+        if not agent_profile_id:
+            return {"message": "Agent profile not found"}, 404
+        
+        fmt = request.args.get('format', 'csv')
+        if fmt not in FORMATS:
+            return {"message": "format must be csv or ndjson"}, 400
+        
+        filename = f"properties-{datetime.now():%Y%m%d}.{fmt}"
+        return Response(
+            stream_with_context(export_stream(agent_profile_id, fmt)),
+            mimetype=FORMATS[fmt],
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+        )
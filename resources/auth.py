@@ -1,9 +1,20 @@
 from flask_restful import Resource, reqparse
 from flask_bcrypt import check_password_hash, generate_password_hash
 from models import User, Property, Payment, PropertyImage, PropertyLocation, Location, UserProfile, db
-from flask_jwt_extended import  create_access_token, jwt_required  
+from flask_jwt_extended import  create_access_token, jwt_required, get_jwt_identity
 from flask_jwt_extended import current_user 
-from utils import admin_required                                                  
+from utils import admin_required, build_claims, forget_profile_ids
+from passwords import hash_offloaded, verify_offloaded, HashingPoolSaturated, HashingTimedOut
+
+
+def too_many_auth_requests():
+    """Fast rejection while the password hashing pool is saturated"""
+    return {"message": "Too many authentication requests, please try again shortly", "status": "fail"}, 429, {"Retry-After": "1"}
+
+
+def auth_unavailable():
+    """Password hashing took longer than PASSWORD_HASH_TIMEOUT"""
+    return {"message": "Authentication is temporarily unavailable, please try again shortly", "status": "fail"}, 503, {"Retry-After": "5"}
 
 
 class Signup(Resource):
@@ -17,13 +28,8 @@ class Signup(Resource):
     
     def post(self):
         data = Signup.parser.parse_args()
-          # hash password
-        data['password'] = generate_password_hash(data['password']).decode('utf-8')
-        # data['role'] = 'user'
-
-        user = User(**data)
         
-        # verify the uniquness of the email and phone in the db
+        # verify the uniquness of the email and phone in the db before paying for a hash
         email = User.query.filter_by(email = data['email']).one_or_none()
 
         if email:
@@ -34,6 +40,17 @@ class Signup(Resource):
         if phone:
             return {"message": "Phone number already taken", "status": "fail"}, 400
 
+        # hash password off the request thread
+        try:
+            data['password'] = hash_offloaded(data['password'])
+        except HashingPoolSaturated:
+            return too_many_auth_requests()
+        except HashingTimedOut:
+            return auth_unavailable()
+        # data['role'] = 'user'
+
+        user = User(**data)
+
         try:
             # save user to the db
             db.session.add(user)
@@ -42,13 +59,15 @@ class Signup(Resource):
             # Create user profile automatically
             user_profile = UserProfile(user_id=user.id)
             db.session.add(user_profile)
+            db.session.flush()
+            user_profile_id = user_profile.id
             
             db.session.commit()
 
             user_json = user.to_dict()
 
 
-            access_token = create_access_token(identity=user_json['id'], additional_claims={'role':user_json['role']})
+            access_token = create_access_token(identity=user_json['id'], additional_claims=build_claims(user, user_profile_id=user_profile_id))
             
 
             return {"message": "Account created successfully", "status": "success", "user": user.to_dict(rules=('-password',)), "access_token":access_token}, 201
@@ -75,16 +94,37 @@ class Login(Resource):
                 return {"message" : "Invalid email/password", "status" : "fail"}, 403
 
             # Check if password provided is correct
-            is_password_correct = user.check_password(data['password'])
+            is_password_correct = verify_offloaded(user.password, data['password'])
 
             if is_password_correct:
+                # Upgrade plain text passwords and hashes made with an old cost
+                # Skipped while hashing is overloaded, the login itself already succeeded
+                if user.password_needs_rehash():
+                    try:
+                        user.password = hash_offloaded(data['password'])
+                        db.session.commit()
+                    except (HashingPoolSaturated, HashingTimedOut):
+                        pass
+
                 user_json = user.to_json()
-                access_token = create_access_token(identity=user_json['id'], additional_claims={'role':user_json['role']})
+                access_token = create_access_token(identity=user_json['id'], additional_claims=build_claims(user))
                 
                 return {"message" : "Login successful", "status" : "success", "user":user.to_dict(rules=("-password",)), "access_token":access_token}, 200
             else:
                 return {"message" : "Invalid email/password", "status": "fail"}, 403
 
+        except HashingPoolSaturated:
+            return too_many_auth_requests()
+        except HashingTimedOut:
+            return auth_unavailable()
         except Exception as e:
             return {"message" : "Login failed. Please try again.", "error": str(e)}, 500
 
+
+class Logout(Resource):
+    @jwt_required()
+    def post(self):
+        # Tokens are stateless, the client discards its copy. Drop any cached
+        # profile ids so a fresh login picks up profile changes.
+        forget_profile_ids(get_jwt_identity())
+        return {"message": "Logged out successfully", "status": "success"}, 200
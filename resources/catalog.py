@@ -0,0 +1,63 @@
+from flask import request
+from flask_restful import Resource
+from utils import encode_cursor, decode_cursor
+from catalog import CODED_FIELDS, SORTS, browse
+from amenities import amenity_mask, parse_amenity_ids
+from recommendations import property_cards
+
+MAX_PAGE_SIZE = 100
+
+
+def _sort_value(value):
+    """Sort key in a cursor; None stands for a listing without a price"""
+    return None if value is None else float(value)
+
+
+class PropertyFacetsResource(Resource):
+    def get(self):
+        """Get a page of filtered listings with facet counts, answered from the in-memory catalog snapshot.
+
+        Filters are ``listing_type``, ``property_type``, ``city`` and
+        ``neighborhood`` (case-insensitive), ``min_price``, ``max_price``,
+        ``min_bedrooms``, ``min_bathrooms`` and ``amenities=1,3``. ``sort`` is
+        newest (default), price_asc or price_desc. Pages through ``limit`` +
+        ``cursor``, which holds the sort key and id of the last listing
+        returned, so pages don't shift as listings change. Each facet counts
+        listings under every filter but its own.
+        """
+        limit = min(max(request.args.get('limit', type=int, default=20), 1), MAX_PAGE_SIZE)
+
+        sort = request.args.get('sort', 'newest')
+        if sort not in SORTS:
+            return {"message": f"sort must be one of: {', '.join(SORTS)}"}, 400
+
+        amenity_ids = parse_amenity_ids(request.args.get('amenities'))
+        if amenity_ids is None:
+            return {"message": "Invalid or unknown amenities"}, 400
+
+        after = None
+        cursor = request.args.get('cursor')
+        if cursor:
+            after = decode_cursor(cursor, _sort_value, int)
+            if after is None:
+                return {"message": "Invalid cursor"}, 400
+
+        filters = {field: request.args.get(field) for field in CODED_FIELDS}
+        for field in ('min_price', 'max_price', 'min_bedrooms', 'min_bathrooms'):
+            value = request.args.get(field, '').strip()
+            if not value:
+                filters[field] = None
+            elif value.isdecimal():
+                filters[field] = int(value)
+            else:
+                return {"message": f"{field} must be a non-negative integer"}, 400
+        filters['amenities'] = amenity_mask(amenity_ids)
+
+        page, total, facets, next_after = browse(filters, sort, after, limit)
+
+        return {
+            "total": total,
+            "properties": property_cards(page),
+            "facets": facets,
+            "next_cursor": encode_cursor(*next_after) if next_after else None
+        }, 200
@@ -0,0 +1,58 @@
+from flask import request
+from flask_restful import Resource
+from utils import agent_or_admin_required, parse_date
+from market_stats import GROUPINGS, market_stats
+from datetime import date
+
+MAX_WINDOW_MONTHS = 120
+
+
+class MarketStatsResource(Resource):
+    @agent_or_admin_required()
+    def get(self):
+        """Get price, inventory and days-on-market stats for live listings.
+
+        ``group_by`` is a comma separated list of listing_type, property_type,
+        city, neighborhood and month (default: city). The window covers the
+        months listings were listed in: ``from``/``to`` (YYYY-MM-DD, rounded to
+        whole months) or the last ``months`` months (default 12). Results can be
+        narrowed with ``listing_type``, ``property_type``, ``city`` and
+        ``neighborhood``.
+        """
+        group_by = [name.strip() for name in request.args.get('group_by', 'city').split(',') if name.strip()]
+        unknown = [name for name in group_by if name not in GROUPINGS]
+        if unknown or not group_by:
+            return {"message": f"group_by must use: {', '.join(GROUPINGS)}"}, 400
+
+        start = parse_date(request.args.get('from'))
+        end = parse_date(request.args.get('to'))
+        if start or end:
+            first_month = start.date().replace(day=1) if start else None
+            last_month = end.date().replace(day=1) if end else None
+            if first_month and last_month and last_month < first_month:
+                return {"message": "'to' must not be before 'from'"}, 400
+        else:
+            months = request.args.get('months', type=int, default=12)
+            if months < 1 or months > MAX_WINDOW_MONTHS:
+                return {"message": f"months must be between 1 and {MAX_WINDOW_MONTHS}"}, 400
+            last_month = date.today().replace(day=1)
+            # First day of the month ``months - 1`` months back
+            index = last_month.year * 12 + last_month.month - months
+            first_month = date(index // 12, index % 12 + 1, 1)
+
+        stats = market_stats(
+            group_by,
+            first_month=first_month,
+            last_month=last_month,
+            listing_type=request.args.get('listing_type'),
+            property_type=request.args.get('property_type'),
+            city=request.args.get('city'),
+            neighborhood=request.args.get('neighborhood')
+        )
+
+        return {
+            "group_by": group_by,
+            "from": first_month.isoformat() if first_month else None,
+            "to": last_month.isoformat() if last_month else None,
+            "groups": stats
+        }, 200
@@ -0,0 +1,107 @@
+from flask import request
+from flask_restful import Resource
+from flask_jwt_extended import get_jwt_identity
+from models import db, Notification
+from utils import auth_required, encode_cursor, decode_cursor
+from datetime import datetime
+from sqlalchemy import func, select, tuple_, update
+
+MAX_PAGE_SIZE = 100
+
+
+class NotificationsResource(Resource):
+    @auth_required()
+    def get(self):
+        """Get the current user's notifications, newest first.
+
+        Keyset pagination through ``limit`` + ``cursor``; ``unread=true`` only
+        returns unread notifications.
+        """
+        current_user_id = get_jwt_identity()
+
+        limit = min(max(request.args.get('limit', type=int, default=20), 1), MAX_PAGE_SIZE)
+
+        query = select(Notification).where(Notification.user_id == current_user_id)
+        if request.args.get('unread', 'false').lower() == 'true':
+            query = query.where(Notification.is_read.is_(False))
+
+        cursor = request.args.get('cursor')
+        if cursor:
+            before = decode_cursor(cursor, datetime, int)
+            if before is None:
+                return {"message": "Invalid cursor"}, 400
+            query = query.where(tuple_(Notification.created_at, Notification.id) < tuple_(*before))
+
+        # Fetch one extra row to know whether there is a next page
+        rows = db.session.scalars(
+            query.order_by(Notification.created_at.desc(), Notification.id.desc()).limit(limit + 1)
+        ).all()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+
+        return {
+            "notifications": [
+                {
+                    'id': n.id,
+                    'title': n.title,
+                    'message': n.message,
+                    'type': n.notification_type,
+                    'is_read': n.is_read,
+                    'created_at': n.created_at.isoformat() if n.created_at else None
+                }
+                for n in rows
+            ],
+            "next_cursor": next_cursor
+        }, 200
+
+
+class NotificationUnreadCountResource(Resource):
+    @auth_required()
+    def get(self):
+        """Get the number of unread notifications (served by the user_id, is_read index)"""
+        current_user_id = get_jwt_identity()
+
+        unread = db.session.scalar(
+            select(func.count()).select_from(Notification)
+            .where(Notification.user_id == current_user_id, Notification.is_read.is_(False))
+        )
+
+        return {"unread": unread}, 200
+
+
+class NotificationReadResource(Resource):
+    @auth_required()
+    def post(self, notification_id):
+        """Mark one notification as read"""
+        current_user_id = get_jwt_identity()
+
+        result = db.session.execute(
+            update(Notification)
+            .where(Notification.id == notification_id, Notification.user_id == current_user_id)
+            .values(is_read=True)
+        )
+        db.session.commit()
+
+        if not result.rowcount:
+            return {"message": "Notification not found"}, 404
+
+        return {"message": "Notification marked as read"}, 200
+
+
+class NotificationReadAllResource(Resource):
+    @auth_required()
+    def post(self):
+        """Mark all of the current user's notifications as read"""
+        current_user_id = get_jwt_identity()
+
+        result = db.session.execute(
+            update(Notification)
+            .where(Notification.user_id == current_user_id, Notification.is_read.is_(False))
+            .values(is_read=True)
+        )
+        db.session.commit()
+
+        return {"message": "Notifications marked as read", "updated": result.rowcount}, 200
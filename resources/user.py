@@ -1,9 +1,18 @@
-from flask import request
-from models import db, User, Property, Favorite, UserProfile, Inquiry, View, PropertyImage, PropertyLocation, Location, Property_type, AgentProfile, PropertyVideo, Conversation, Message
+from flask import request, g
+from models import db, User, Property, Favorite, UserProfile, Inquiry, View, PropertyImage, PropertyLocation, Location, Property_type, AgentProfile, PropertyVideo, Conversation, Message, SavedSearch, SavedSearchMatch
 from flask_restful import Resource, reqparse
 from flask_jwt_extended import get_jwt_identity
-from utils import user_required
-from datetime import datetime
+from utils import user_required, optional_auth, forget_profile_ids, encode_cursor, decode_cursor, parse_date
+from datetime import datetime, timedelta
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.exc import IntegrityError
+from scheduling import slot_error, free_slots, MAX_RANGE_DAYS
+from property_pages import load_property_page, viewer_state
+from recommendations import similar_properties, property_cards, SIMILAR_NEIGHBORS
+from feed import feed_page, forget_feed
+from notifications import notify
+from amenities import amenity_mask, amenity_names, decode_mask, has_amenities, parse_amenity_ids
+from saved_searches import clean_criteria, criteria_error, index_search, new_match_counts, delete_search, SAVED_SEARCH_LIMIT
 
 
 class UserProfileResource(Resource):
@@ -61,6 +70,7 @@ class UserProfileResource(Resource):
         if not user_profile:
             user_profile = UserProfile(user_id=current_user_id)
             db.session.add(user_profile)
+            forget_profile_ids(current_user_id)
         
         if 'profile_picture' in data:
             user_profile.profile_picture = data['profile_picture']
@@ -86,91 +96,226 @@ class UserProfileResource(Resource):
 
 class UserPropertiesResource(Resource):
     def get(self):
-        """Get all properties for user browsing with primary image and location"""
-        properties = Property.query.all()
+        """Get all properties for user browsing with primary image and location.
+
+        ``amenities=1,3`` only returns listings that have every one of them.
+        """
+        amenity_ids = parse_amenity_ids(request.args.get('amenities'))
+        if amenity_ids is None:
+            return {"message": "Invalid or unknown amenities"}, 400
+        
+        query = Property.query.filter(Property.archived_at.is_(None))
+        if amenity_ids:
+            # One bitwise test on the listing row instead of a join per amenity
+            query = query.filter(has_amenities(amenity_mask(amenity_ids)))
+        properties = query.all()
+
+        # Images, locations and type names for the whole result in three queries
+        listed = query.with_entities(Property.id)
+        primary_images = dict(db.session.execute(
+            select(PropertyImage.property_id, PropertyImage.image_url)
+            .where(PropertyImage.property_id.in_(listed), PropertyImage.is_primary.is_(True))
+            .order_by(PropertyImage.id.desc())
+        ).all())
+        locations = {
+            property_id: location
+            for property_id, location in db.session.execute(
+                select(PropertyLocation.property_id, Location)
+                .join(Location, Location.id == PropertyLocation.location_id)
+                .where(PropertyLocation.property_id.in_(listed))
+                .order_by(PropertyLocation.id.desc())
+            )
+        }
+        type_names = dict(db.session.execute(select(Property_type.id, Property_type.name)).all())
 
         result = []
         for prop in properties:
-            prop_dict = prop.to_dict()
-            
-            # Get primary image
-            primary_image = PropertyImage.query.filter_by(property_id=prop.id, is_primary=True).first()
-            prop_dict['primary_image'] = primary_image.image_url if primary_image else None
+            prop_dict = prop.to_dict(rules=("-amenity_mask",))
+            prop_dict['amenities'] = decode_mask(prop.amenity_mask)
+            prop_dict['primary_image'] = primary_images.get(prop.id)
             
-            # Get location
-            prop_location = PropertyLocation.query.filter_by(property_id=prop.id).first()
-            if prop_location:
-                location = Location.query.get(prop_location.location_id)
-                if location:
-                    prop_dict['location'] = location.neighborhood or location.city or f"{location.city}, {location.state}"
+            location = locations.get(prop.id)
+            if location:
+                prop_dict['location'] = location.neighborhood or location.city or f"{location.city}, {location.state}"
             
-            # Get property type name for category filtering
-            property_type = Property_type.query.get(prop.property_type_id)
-            if property_type:
-                prop_dict['property_type'] = property_type.name
+            # Property type name for category filtering
+            if prop.property_type_id in type_names:
+                prop_dict['property_type'] = type_names[prop.property_type_id]
             
             result.append(prop_dict)
 
         return result, 200
 
 
-class UserPropertyDetailResource(Resource):
-    def get(self, property_id):
-        """Get single property with full details including agent info"""
-        prop = Property.query.get(property_id)
+class AmenitiesResource(Resource):
+    def get(self):
+        """Get every amenity listings can be filtered by"""
+        return {"amenities": [{"id": amenity_id, "name": name} for amenity_id, name in amenity_names().items()]}, 200
+
+
+class UserFeedResource(Resource):
+    @user_required()
+    def get(self):
+        """Get the current user's ranked feed, paged with ``limit`` + ``cursor``"""
+        current_user_id = get_jwt_identity()
         
-        if not prop:
-            return {"message": "Property not found"}, 404
+        limit = min(max(request.args.get('limit', type=int, default=20), 1), 100)
         
-        prop_dict = prop.to_dict()
+        offset = 0
+        cursor = request.args.get('cursor')
+        if cursor:
+            after = decode_cursor(cursor, int)
+            if after is None or after[0] < 0:
+                return {"message": "Invalid cursor"}, 400
+            offset = after[0]
         
-        # Get primary image
-        primary_image = PropertyImage.query.filter_by(property_id=prop.id, is_primary=True).first()
-        prop_dict['primary_image'] = primary_image.image_url if primary_image else None
+        cards, next_offset, personalized = feed_page(current_user_id, offset, limit)
         
-        # Get all images
-        all_images = PropertyImage.query.filter_by(property_id=prop.id).all()
-        prop_dict['images'] = [img.image_url for img in all_images]
+        return {
+            "properties": cards,
+            "personalized": personalized,
+            "next_cursor": encode_cursor(next_offset) if next_offset is not None else None
+        }, 200
+
+
+class SavedSearchesResource(Resource):
+    @user_required()
+    def get(self):
+        """Get the current user's saved searches with how many new listings match each"""
+        user_profile_id = g.user_profile_id
         
-        # Get all videos
-        all_videos = PropertyVideo.query.filter_by(propert_id=prop.id).all()
-        prop_dict['videos'] = [video.video_url for video in all_videos]
+        if not user_profile_id:
+            return {"saved_searches": []}, 200
         
-        # Get location details
-        prop_location = PropertyLocation.query.filter_by(property_id=prop.id).first()
-        if prop_location:
-            location = Location.query.get(prop_location.location_id)
-            if location:
-                prop_dict['location'] = {
-                    'neighborhood': location.neighborhood,
-                    'city': location.city,
-                    'state': location.state,
-                    'country': location.country,
-                    'latitude': location.latitude,
-                    'longitude': location.longitude
-                }
+        searches = SavedSearch.query.filter_by(user_id=user_profile_id).order_by(SavedSearch.id.desc()).all()
+        new_matches = new_match_counts([search.id for search in searches])
         
-        # Get property type
-        property_type = Property_type.query.get(prop.property_type_id)
-        if property_type:
-            prop_dict['property_type'] = property_type.name
+        return {
+            "saved_searches": [serialize_saved_search(search, new_matches.get(search.id, 0)) for search in searches]
+        }, 200
+    
+    @user_required()
+    def post(self):
+        """Save a set of browse filters; new listings matching them are recorded from now on"""
+        user_profile_id = g.user_profile_id
         
-        # Get agent info
-        agent_profile = AgentProfile.query.get(prop.agent_id)
-        if agent_profile:
-            agent_user = User.query.get(agent_profile.user_id)
-            if agent_user:
-                prop_dict['agent'] = {
-                    'id': agent_user.id,
-                    'name': f"{agent_user.first_name} {agent_user.last_name}",
-                    'email': agent_user.email,
-                    'phone': agent_user.phone,
-                    'bio': agent_profile.bio,
-                    'rating': agent_profile.rating,
-                    'license_number': agent_profile.license_number
-                }
+        if not user_profile_id:
+            return {"message": "User profile not found"}, 404
+        
+        data = request.get_json() or {}
+        name = (data.get('name') or '').strip()
+        
+        if not name:
+            return {"message": "Name is required"}, 400
+        
+        criteria = clean_criteria(data)
+        error = criteria_error(criteria)
+        if error:
+            return {"message": error}, 400
+        
+        if SavedSearch.query.filter_by(user_id=user_profile_id).count() >= SAVED_SEARCH_LIMIT:
+            return {"message": f"You can save up to {SAVED_SEARCH_LIMIT} searches"}, 409
+        
+        search = SavedSearch(user_id=user_profile_id, name=name, term_count=0, seen_at=datetime.now(), **criteria)
+        db.session.add(search)
+        db.session.flush()
+        index_search(search)
+        db.session.commit()
+        
+        return {"message": "Search saved", "saved_search": serialize_saved_search(search, 0)}, 201
+
+
+class SavedSearchResource(Resource):
+    @user_required()
+    def delete(self, search_id):
+        """Delete one of the current user's saved searches"""
+        search = SavedSearch.query.filter_by(id=search_id, user_id=g.user_profile_id).first()
+        
+        if not search:
+            return {"message": "Saved search not found"}, 404
+        
+        delete_search(search.id)
+        db.session.commit()
         
-        return prop_dict, 200
+        return {"message": "Saved search deleted"}, 200
+
+
+class SavedSearchMatchesResource(Resource):
+    @user_required()
+    def get(self, search_id):
+        """Get the listings matched by a saved search, newest first.
+
+        Keyset pagination through ``limit`` + ``cursor``. Opening the first
+        page marks the matches as seen, which resets the new match count.
+        """
+        search = SavedSearch.query.filter_by(id=search_id, user_id=g.user_profile_id).first()
+        
+        if not search:
+            return {"message": "Saved search not found"}, 404
+        
+        limit = min(max(request.args.get('limit', type=int, default=20), 1), 100)
+        
+        query = (
+            select(SavedSearchMatch.property_id, SavedSearchMatch.created_at)
+            .join(Property, Property.id == SavedSearchMatch.property_id)
+            .where(SavedSearchMatch.saved_search_id == search.id, Property.archived_at.is_(None))
+        )
+        
+        cursor = request.args.get('cursor')
+        if cursor:
+            before = decode_cursor(cursor, datetime, int)
+            if before is None:
+                return {"message": "Invalid cursor"}, 400
+            query = query.where(tuple_(SavedSearchMatch.created_at, SavedSearchMatch.property_id) < tuple_(*before))
+        
+        # Fetch one extra row to know whether there is a next page
+        rows = db.session.execute(
+            query.order_by(SavedSearchMatch.created_at.desc(), SavedSearchMatch.property_id.desc()).limit(limit + 1)
+        ).all()
+        
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].created_at, rows[-1].property_id)
+        
+        matched_at = {row.property_id: row.created_at for row in rows}
+        matches = [
+            {**card, "matched_at": matched_at[card["id"]].isoformat(), "is_new": matched_at[card["id"]] > search.seen_at}
+            for card in property_cards(list(matched_at))
+        ]
+        
+        if not cursor:
+            search.seen_at = datetime.now()
+            db.session.commit()
+        
+        return {"saved_search": serialize_saved_search(search, 0), "matches": matches, "next_cursor": next_cursor}, 200
+
+
+class UserPropertyDetailResource(Resource):
+    def get(self, property_id):
+        """Get single property with full details including agent info"""
+        page = load_property_page(property_id)
+        
+        if not page:
+            return {"message": "Property not found"}, 404
+        
+        return page, 200
+
+
+class UserPropertyPageResource(Resource):
+    @optional_auth()
+    def get(self, property_id):
+        """Property details plus the signed-in viewer's favorite, inquiry and visit state"""
+        page = load_property_page(property_id)
+        
+        if not page:
+            return {"message": "Property not found"}, 404
+        
+        viewer = viewer_state(page, user_id=g.user_id, role=g.role,
+                              user_profile_id=g.user_profile_id, agent_profile_id=g.agent_profile_id)
+        
+        # Shared page data is cached server side; the merged response is per viewer
+        return {**page, "viewer": viewer}, 200, {"Cache-Control": "private, no-cache", "Vary": "Authorization"}
 
 class UserStatsResource(Resource):
     @user_required()
@@ -178,13 +323,13 @@ class UserStatsResource(Resource):
         # Get the current user's ID from JWT
         current_user_id = get_jwt_identity()
         
-        # Get the user's profile to find favorites
-        user_profile = UserProfile.query.filter_by(user_id=current_user_id).first()
+        # Profile id is resolved from the token by user_required
+        user_profile_id = g.user_profile_id
         
         # Count saved properties (favorites)
         saved_count = 0
-        if user_profile:
-            saved_count = Favorite.query.filter_by(user_id=user_profile.id).count()
+        if user_profile_id:
+            saved_count = Favorite.query.filter_by(user_id=user_profile_id).count()
         
         # Count inquiries sent by this user
         inquiries_count = Inquiry.query.filter_by(user_id=current_user_id).count()
@@ -207,13 +352,13 @@ class SavedPropertiesResource(Resource):
         limit = request.args.get('limit', type=int, default=0)
 
         # Get user's profile
-        user_profile = UserProfile.query.filter_by(user_id=current_user_id).first()
+        user_profile_id = g.user_profile_id
 
-        if not user_profile:
+        if not user_profile_id:
             return {"properties": []}, 200
 
         # Get all favorites for this user
-        favorites_query = Favorite.query.filter_by(user_id=user_profile.id)
+        favorites_query = Favorite.query.filter_by(user_id=user_profile_id)
         
         # Apply limit if specified
         if limit > 0:
@@ -221,11 +366,12 @@ class SavedPropertiesResource(Resource):
         else:
             favorites = favorites_query.all()
 
-        properties = []
-        for fav in favorites:
-            property = Property.query.get(fav.property_id)  
-            if property:
-                properties.append(property.to_dict())
+        # Every favorited property at once, listed in favorite order
+        found = {prop.id: prop for prop in Property.query.filter(Property.id.in_({fav.property_id for fav in favorites}))}
+        properties = [
+            found[fav.property_id].to_dict(rules=("-amenity_mask",))
+            for fav in favorites if fav.property_id in found
+        ]
 
         return {"properties": properties}, 200
 
@@ -237,9 +383,9 @@ class ToggleFavoriteResource(Resource):
         current_user_id = get_jwt_identity()
         
         # Get user's profile
-        user_profile = UserProfile.query.filter_by(user_id=current_user_id).first()
+        user_profile_id = g.user_profile_id
         
-        if not user_profile:
+        if not user_profile_id:
             return {"message": "User profile not found"}, 404
         
         # Get property_id from request
@@ -256,10 +402,13 @@ class ToggleFavoriteResource(Resource):
         
         # Check if already favorited
         existing_favorite = Favorite.query.filter_by(
-            user_id=user_profile.id,
+            user_id=user_profile_id,
             property_id=property_id
         ).first()
         
+        # Either way the user's taste changed
+        forget_feed(current_user_id)
+        
         if existing_favorite:
             # Remove from favorites
             db.session.delete(existing_favorite)
@@ -268,7 +417,7 @@ class ToggleFavoriteResource(Resource):
         else:
             # Add to favorites
             new_favorite = Favorite(
-                user_id=user_profile.id,
+                user_id=user_profile_id,
                 property_id=property_id
             )
             db.session.add(new_favorite)
@@ -284,8 +433,8 @@ class RecentActivitiesResource(Resource):
         limit = request.args.get('limit', type=int, default=0)
 
         #Get user profile
-        user_profile = UserProfile.query.filter_by(user_id=current_user).first()
-        if not user_profile:
+        user_profile_id = g.user_profile_id
+        if not user_profile_id:
             return {"activities": []}, 200
         
         activities = []
@@ -297,16 +446,29 @@ class RecentActivitiesResource(Resource):
         else:
             views = views_query.all()
             
+        # Get recent inquiries
+        inquiries_query = Inquiry.query.filter_by(user_id=current_user).order_by(Inquiry.created_at.desc())
+        if limit > 0:
+            inquiries = inquiries_query.limit(limit).all()
+        else:
+            inquiries = inquiries_query.all()
+            
+        # Titles of every property in the feed in one query
+        titles = dict(db.session.execute(
+            select(Property.id, Property.title)
+            .where(Property.id.in_({view.property_id for view in views} | {inquiry.property_id for inquiry in inquiries}))
+        ).all())
+
         for view in views:
-            property = Property.query.get(view.property_id)
-            if property:
+            title = titles.get(view.property_id)
+            if title:
                 # Check the status to determine the type of view
                 if view.status == "viewed":
                     # Pure property view - recorded when user visits property details
                     activities.append({
                         "type": "view",
-                        "description": f"Viewed {property.title}",
-                        "property": property.title,
+                        "description": f"Viewed {title}",
+                        "property": title,
                         "time": view.created_at.strftime("%Y-%m-%d %H:%M")
                     })
                 elif view.status == "pending" or view.status == "completed":
@@ -314,25 +476,18 @@ class RecentActivitiesResource(Resource):
                     activities.append({
                         "type": "viewing",
                         "description": f"Scheduled viewing for {view.sheduled_time.strftime('%Y-%m-%d %H:%M')}" if view.sheduled_time else "Property viewing",
-                        "property": property.title,
+                        "property": title,
                         "status": view.status,
                         "time": view.created_at.strftime("%Y-%m-%d %H:%M")
                     })
 
-        # Get recent inquiries
-        inquiries_query = Inquiry.query.filter_by(user_id=current_user).order_by(Inquiry.created_at.desc())
-        if limit > 0:
-            inquiries = inquiries_query.limit(limit).all()
-        else:
-            inquiries = inquiries_query.all()
-            
         for inquiry in inquiries:
-            property = Property.query.get(inquiry.property_id)
-            if property:
+            title = titles.get(inquiry.property_id)
+            if title:
                 activities.append({
                     "type": "inquiry",
                     "description": inquiry.message[:50] + "..." if len(inquiry.message) > 50 else inquiry.message,
-                    "property": property.title,
+                    "property": title,
                     "time": inquiry.created_at.strftime("%Y-%m-%d %H:%M")
                 })
 
@@ -375,6 +530,7 @@ class RecordPropertyViewResource(Resource):
         if recent_view:
             # Update the existing view timestamp instead of creating a new one
             recent_view.created_at = datetime.now()
+            forget_feed(current_user_id)
             db.session.commit()
             return {"message": "View timestamp updated"}, 200
         
@@ -386,6 +542,7 @@ class RecordPropertyViewResource(Resource):
             status="viewed"  # Custom status for property views
         )
         db.session.add(new_view)
+        forget_feed(current_user_id)
         db.session.commit()
         
         return {"message": "View recorded"}, 200
@@ -427,6 +584,7 @@ class CreateInquiryResource(Resource):
             status="new"
         )
         db.session.add(new_inquiry)
+        notify("New inquiry", f"{property.title}: {message[:120]}", "inquiry", agent_id=agent_profile.id)
         db.session.commit()
         
         return {
@@ -452,12 +610,29 @@ class UserInquiriesResource(Resource):
         else:
             inquiries = inquiries_query.all()
         
+        # Properties, images and agents for every inquiry at once
+        property_ids = {inquiry.property_id for inquiry in inquiries}
+        properties = {prop.id: prop for prop in Property.query.filter(Property.id.in_(property_ids))}
+        primary_images = dict(db.session.execute(
+            select(PropertyImage.property_id, PropertyImage.image_url)
+            .where(PropertyImage.property_id.in_(property_ids), PropertyImage.is_primary.is_(True))
+            .order_by(PropertyImage.id.desc())
+        ).all())
+        agents = {
+            agent_id: user
+            for agent_id, user in db.session.execute(
+                select(AgentProfile.id, User)
+                .join(User, User.id == AgentProfile.user_id)
+                .where(AgentProfile.id.in_({inquiry.agent_id for inquiry in inquiries}))
+            )
+        }
+        
         result = []
         for inquiry in inquiries:
             inquiry_dict = inquiry.to_dict()
             
             # Get property info
-            property = Property.query.get(inquiry.property_id)
+            property = properties.get(inquiry.property_id)
             if property:
                 inquiry_dict['property'] = {
                     'id': property.id,
@@ -465,22 +640,18 @@ class UserInquiriesResource(Resource):
                     'price': property.price,
                     'currency': property.currency
                 }
-                # Get primary image
-                primary_image = PropertyImage.query.filter_by(property_id=property.id, is_primary=True).first()
-                if primary_image:
-                    inquiry_dict['property']['image'] = primary_image.image_url
+                if property.id in primary_images:
+                    inquiry_dict['property']['image'] = primary_images[property.id]
             
             # Get agent info
-            agent_profile = AgentProfile.query.get(inquiry.agent_id)
-            if agent_profile:
-                agent_user = User.query.get(agent_profile.agent_id)
-                if agent_user:
-                    inquiry_dict['agent'] = {
-                        'id': agent_user.id,
-                        'name': f"{agent_user.first_name} {agent_user.last_name}",
-                        'email': agent_user.email,
-                        'phone': agent_user.phone
-                    }
+            agent_user = agents.get(inquiry.agent_id)
+            if agent_user:
+                inquiry_dict['agent'] = {
+                    'id': agent_user.id,
+                    'name': f"{agent_user.first_name} {agent_user.last_name}",
+                    'email': agent_user.email,
+                    'phone': agent_user.phone
+                }
             
             result.append(inquiry_dict)
         
@@ -499,6 +670,34 @@ class UserConversationsResource(Resource):
         conversations = Conversation.query.filter_by(
             user_id=current_user_id
         ).order_by(Conversation.last_message_at.desc()).all()
+        if not conversations:
+            return {"conversations": []}, 200
+        
+        # Agents, properties, images and unread counts for every conversation at once
+        agents = {
+            agent_id: user
+            for agent_id, user in db.session.execute(
+                select(AgentProfile.id, User)
+                .join(User, User.id == AgentProfile.user_id)
+                .where(AgentProfile.id.in_({conv.agent_id for conv in conversations}))
+            )
+        }
+        property_ids = {conv.property_id for conv in conversations if conv.property_id}
+        properties = {prop.id: prop for prop in Property.query.filter(Property.id.in_(property_ids))}
+        primary_images = dict(db.session.execute(
+            select(PropertyImage.property_id, PropertyImage.image_url)
+            .where(PropertyImage.property_id.in_(property_ids), PropertyImage.is_primary.is_(True))
+            .order_by(PropertyImage.id.desc())
+        ).all())
+        unread_counts = dict(db.session.execute(
+            select(Message.conversation_id, func.count())
+            .where(
+                Message.conversation_id.in_([conv.id for conv in conversations]),
+                Message.sender_type == "agent",
+                Message.is_read == False
+            )
+            .group_by(Message.conversation_id)
+        ).all())
         
         result = []
         for conv in conversations:
@@ -509,40 +708,29 @@ class UserConversationsResource(Resource):
                 'created_at': conv.created_at.strftime("%Y-%m-%d %H:%M")
             }
             
-            # Get agent info
-            agent_profile = AgentProfile.query.get(conv.agent_id)
-            if agent_profile:
-                agent_user = User.query.get(agent_profile.agent_id)
-                if agent_user:
-                    conv_dict['agent'] = {
-                        'id': agent_user.id,
-                        'name': f"{agent_user.first_name} {agent_user.last_name}",
-                        'email': agent_user.email,
-                        'phone': agent_user.phone
-                    }
+            # Agent info
+            agent_user = agents.get(conv.agent_id)
+            if agent_user:
+                conv_dict['agent'] = {
+                    'id': agent_user.id,
+                    'name': f"{agent_user.first_name} {agent_user.last_name}",
+                    'email': agent_user.email,
+                    'phone': agent_user.phone
+                }
             
-            # Get property info if exists
-            if conv.property_id:
-                property = Property.query.get(conv.property_id)
-                if property:
-                    conv_dict['property'] = {
-                        'id': property.id,
-                        'title': property.title,
-                        'price': property.price,
-                        'currency': property.currency
-                    }
-                    # Get primary image
-                    primary_image = PropertyImage.query.filter_by(property_id=property.id, is_primary=True).first()
-                    if primary_image:
-                        conv_dict['property']['image'] = primary_image.image_url
+            # Property info if exists
+            property = properties.get(conv.property_id)
+            if property:
+                conv_dict['property'] = {
+                    'id': property.id,
+                    'title': property.title,
+                    'price': property.price,
+                    'currency': property.currency
+                }
+                if property.id in primary_images:
+                    conv_dict['property']['image'] = primary_images[property.id]
             
-            # Get unread message count
-            unread_count = Message.query.filter(
-                Message.conversation_id == conv.id,
-                Message.sender_type == "agent",
-                Message.is_read == False
-            ).count()
-            conv_dict['unread_count'] = unread_count
+            conv_dict['unread_count'] = unread_counts.get(conv.id, 0)
             
             result.append(conv_dict)
         
@@ -631,6 +819,7 @@ class ConversationMessagesResource(Resource):
         conversation.last_message = content
         conversation.last_message_at = datetime.now()
         
+        notify_new_message(conversation, content)
         db.session.commit()
         
         return {
@@ -644,6 +833,12 @@ class ConversationMessagesResource(Resource):
         }, 201
 
 
+def notify_new_message(conversation, content):
+    """Tell the agent about a new message; one unread notification per conversation"""
+    notify("New message", content[:120], "message", agent_id=conversation.agent_id,
+           group_key=f"conversation:{conversation.id}")
+
+
 class StartConversationResource(Resource):
     @user_required()
     def post(self):
@@ -680,6 +875,7 @@ class StartConversationResource(Resource):
             db.session.add(new_message)
             existing_conv.last_message = initial_message
             existing_conv.last_message_at = datetime.now()
+            notify_new_message(existing_conv, initial_message)
             db.session.commit()
             
             return {
@@ -706,6 +902,7 @@ class StartConversationResource(Resource):
             is_read=False
         )
         db.session.add(new_message)
+        notify_new_message(new_conversation, initial_message)
         db.session.commit()
         
         return {
@@ -743,21 +940,39 @@ class ScheduleVisitResource(Resource):
             return {"message": "Property not found"}, 404
         
         # Combine date and time into a datetime
-        from datetime import datetime
         try:
             scheduled_datetime = datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M")
         except ValueError:
             return {"message": "Invalid date or time format"}, 400
         
+        if scheduled_datetime <= datetime.now():
+            return {"message": "Visits must be scheduled in the future"}, 400
+        
+        # Make sure the slot is inside the agent's availability and not already taken
+        error = slot_error(property.agent_id, property.id, scheduled_datetime)
+        if error:
+            return {"message": error}, 409
+        
         # Create the scheduled visit
         new_view = View(
             property_id=property_id,
             user_id=current_user_id,
+            agent_id=property.agent_id,
             sheduled_time=scheduled_datetime,
             status="pending"
         )
         db.session.add(new_view)
-        db.session.commit()
+        forget_feed(current_user_id)
+        
+        when = scheduled_datetime.strftime("%Y-%m-%d %H:%M")
+        notify("New visit request", f"{property.title} on {when}", "viewing", agent_id=property.agent_id)
+        notify("Visit scheduled", f"Your visit to {property.title} is booked for {when}", "viewing", user_id=current_user_id)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another request booked the same slot between our check and insert
+            db.session.rollback()
+            return {"message": "This time slot is already booked"}, 409
         
         return {
             "message": "Visit scheduled successfully",
@@ -770,59 +985,182 @@ class ScheduleVisitResource(Resource):
         }, 201
 
 
+class PropertyAvailableSlotsResource(Resource):
+    def get(self, property_id):
+        """Get free visit slots for a property between ``from`` and ``to`` (YYYY-MM-DD)"""
+        start = parse_date(request.args.get('from')) or datetime.now()
+        end = parse_date(request.args.get('to')) or start + timedelta(days=6)
+        
+        if end < start:
+            return {"message": "'to' must not be before 'from'"}, 400
+        if (end - start).days >= MAX_RANGE_DAYS:
+            return {"message": f"Date range is limited to {MAX_RANGE_DAYS} days"}, 400
+        
+        days = free_slots(property_id, start.date(), end.date())
+        if days is None:
+            return {"message": "Property not found"}, 404
+        
+        return {"property_id": property_id, "days": days}, 200
+
+
+class PropertySimilarResource(Resource):
+    def get(self, property_id):
+        """Get listings similar to a property, precomputed by ``flask build-similar``"""
+        limit = min(max(request.args.get('limit', type=int, default=SIMILAR_NEIGHBORS), 1), SIMILAR_NEIGHBORS)
+        
+        return {"property_id": property_id, "similar": similar_properties(property_id, limit)}, 200
+
+
 class UserScheduledVisitsResource(Resource):
     @user_required()
     def get(self):
-        """Get all scheduled visits for the current user"""
+        """Get scheduled visits for the current user.
+
+        Supports ``from``/``to`` (YYYY-MM-DD) date filtering, keyset pagination
+        through ``limit`` + ``cursor``, and ``view=calendar`` which groups the
+        next ``days`` days of visits by day.
+        """
         current_user_id = get_jwt_identity()
-        
+
+        if request.args.get('view') == 'calendar':
+            return self._calendar(current_user_id)
+
         # Get optional limit parameter
         limit = request.args.get('limit', type=int, default=0)
-        
-        # Get all scheduled visits (status = pending or completed) for this user
-        visits_query = View.query.filter(
-            View.user_id == current_user_id,
-            View.status.in_(['pending', 'completed'])
-        ).order_by(View.sheduled_time.asc())
-        
+
+        start = parse_date(request.args.get('from'))
+        end = parse_date(request.args.get('to'))
+
+        query = scheduled_visits_query(current_user_id)
+        if start:
+            query = query.filter(View.sheduled_time >= start)
+        if end:
+            query = query.filter(View.sheduled_time < end + timedelta(days=1))
+
+        # Seek past the last visit of the previous page
+        cursor = request.args.get('cursor')
+        if cursor:
+            after = decode_cursor(cursor, datetime, int)
+            if not after:
+                return {"message": "Invalid cursor"}, 400
+            query = query.filter(tuple_(View.sheduled_time, View.id) > tuple_(*after))
+
         if limit > 0:
-            visits = visits_query.limit(limit).all()
+            rows = query.limit(limit + 1).all()
         else:
-            visits = visits_query.all()
-        
-        result = []
-        for visit in visits:
-            visit_dict = {
-                'id': visit.id,
-                'scheduled_time': visit.sheduled_time.strftime("%Y-%m-%d %H:%M") if visit.sheduled_time else None,
-                'status': visit.status,
-                'created_at': visit.created_at.strftime("%Y-%m-%d %H:%M")
-            }
-            
-            # Get property info
-            property = Property.query.get(visit.property_id)
-            if property:
-                visit_dict['property'] = {
-                    'id': property.id,
-                    'title': property.title,
-                    'price': property.price,
-                    'currency': property.currency,
-                    'listing_type': property.listing_type
-                }
-                # Get primary image
-                primary_image = PropertyImage.query.filter_by(property_id=property.id, is_primary=True).first()
-                if primary_image:
-                    visit_dict['property']['image'] = primary_image.image_url
-                
-                # Get location
-                prop_location = PropertyLocation.query.filter_by(property_id=property.id).first()
-                if prop_location:
-                    location = Location.query.get(prop_location.location_id)
-                    if location:
-                        visit_dict['property']['location'] = location.neighborhood or location.city
-            
-            result.append(visit_dict)
-        
-        return {"visits": result}, 200
-            
+            rows = query.all()
+
+        next_cursor = None
+        if limit > 0 and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].View.sheduled_time, rows[-1].View.id)
+
+        return {"visits": [serialize_scheduled_visit(row) for row in rows], "next_cursor": next_cursor}, 200
+
+    def _calendar(self, current_user_id):
+        """Visits for the next N days, bucketed per day by the database"""
+        days = min(max(request.args.get('days', type=int, default=30), 1), 366)
+        start = parse_date(request.args.get('from')) or datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        end = start + timedelta(days=days)
+
+        day = func.date(View.sheduled_time)
+        window = (
+            View.user_id == current_user_id,
+            View.status.in_(['pending', 'completed']),
+            View.sheduled_time >= start,
+            View.sheduled_time < end,
+        )
+
+        # Per-day counts come straight from a GROUP BY
+        counts = db.session.query(day, func.count(View.id)).filter(*window).group_by(day).order_by(day).all()
+        calendar = {str(d): {"date": str(d), "count": count, "visits": []} for d, count in counts}
+
+        rows = scheduled_visits_query(current_user_id, day.label('day')).filter(*window[2:]).all()
+        for row in rows:
+            calendar[str(row.day)]["visits"].append(serialize_scheduled_visit(row))
+
+        return {
+            "from": start.strftime("%Y-%m-%d"),
+            "to": (end - timedelta(days=1)).strftime("%Y-%m-%d"),
+            "days": list(calendar.values())
+        }, 200
+
+
+def scheduled_visits_query(user_id, *extra_columns):
+    """Single statement returning visits with their property, primary image and location"""
+    primary_image = (
+        db.session.query(PropertyImage.image_url)
+        .filter(PropertyImage.property_id == View.property_id, PropertyImage.is_primary == True)
+        .order_by(PropertyImage.id)
+        .limit(1)
+        .correlate(View)
+        .scalar_subquery()
+    )
+    location_name = (
+        db.session.query(func.coalesce(Location.neighborhood, Location.city))
+        .join(PropertyLocation, PropertyLocation.location_id == Location.id)
+        .filter(PropertyLocation.property_id == View.property_id)
+        .order_by(PropertyLocation.id)
+        .limit(1)
+        .correlate(View)
+        .scalar_subquery()
+    )
+
+    return (
+        db.session.query(
+            View,
+            Property.id.label('property_id'),
+            Property.title,
+            Property.price,
+            Property.currency,
+            Property.listing_type,
+            primary_image.label('image'),
+            location_name.label('location'),
+            *extra_columns
+        )
+        .outerjoin(Property, Property.id == View.property_id)
+        .filter(View.user_id == user_id, View.status.in_(['pending', 'completed']))
+        .order_by(View.sheduled_time.asc(), View.id.asc())
+    )
+
+
+def serialize_scheduled_visit(row):
+    visit = row.View
+    visit_dict = {
+        'id': visit.id,
+        'scheduled_time': visit.sheduled_time.strftime("%Y-%m-%d %H:%M") if visit.sheduled_time else None,
+        'status': visit.status,
+        'created_at': visit.created_at.strftime("%Y-%m-%d %H:%M") if visit.created_at else None
+    }
+
+    if row.property_id:
+        visit_dict['property'] = {
+            'id': row.property_id,
+            'title': row.title,
+            'price': row.price,
+            'currency': row.currency,
+            'listing_type': row.listing_type
+        }
+        if row.image:
+            visit_dict['property']['image'] = row.image
+        if row.location:
+            visit_dict['property']['location'] = row.location
+
+    return visit_dict
+
 
+def serialize_saved_search(search, new_matches):
+    return {
+        'id': search.id,
+        'name': search.name,
+        'listing_type': search.listing_type,
+        'property_type_id': search.property_type_id,
+        'city': search.city,
+        'neighborhood': search.neighborhood,
+        'min_price': search.min_price,
+        'max_price': search.max_price,
+        'min_bedrooms': search.min_bedrooms,
+        'min_bathrooms': search.min_bathrooms,
+        'new_matches': new_matches,
+        'created_at': search.created_at.strftime("%Y-%m-%d %H:%M") if search.created_at else None
+    }
@@ -0,0 +1,238 @@
+"""Saved searches, matched incrementally against new and edited listings.
+
+A saved search holds the /user/properties filters a user keeps re-running.
+Its equality criteria (listing type, property type, city, neighborhood) go
+into ``saved_search_terms``, an inverted index from term to searches.
+Searches with no equality criteria at all are posted under the catch-all
+term ``*`` instead, which every listing carries. ``term_count`` records how
+many terms a search has.
+
+Creating, editing and importing listings queue a ``match-saved-searches``
+job with the listing ids through listings_changed() (see listing_changes.py
+and tasks.py). match_listings() turns each listing
+into its terms and reads the postings of all of them in one query. A search
+is a candidate for a listing when the listing hits every one of its terms.
+Only the candidates are loaded and have their price, bedroom and bathroom
+ranges checked. A search for another city is never read, so the cost
+depends on how many searches share a listing's terms (plus the searches
+without equality criteria), not on how many searches exist. New matches go
+into ``saved_search_matches`` and the owner gets a single coalesced
+notification per search.
+
+"N new matches" is then one grouped count of matches found since the
+search was last opened.
+"""
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from flask.cli import with_appcontext
+from sqlalchemy import delete, func, insert, or_, select
+from models import (db, Property, PropertyLocation, Location, Property_type, UserProfile, SavedSearch,
+                    SavedSearchTerm, SavedSearchMatch)
+from jobs import enqueue
+from notifications import notify
+import click
+
+EQUALITY_CRITERIA = ("listing_type", "property_type_id", "city", "neighborhood")
+RANGE_CRITERIA = ("min_price", "max_price", "min_bedrooms", "min_bathrooms")
+MATCH_BATCH_SIZE = 500
+SAVED_SEARCH_LIMIT = 20
+
+
+def _term(field, value):
+    return f"{field}:{str(value).strip().lower()}"
+
+
+def search_terms(search):
+    """Index terms of a saved search; ``*`` alone for searches without equality criteria, which match anything"""
+    terms = [
+        _term(field, getattr(search, field))
+        for field in EQUALITY_CRITERIA
+        if getattr(search, field) not in (None, "")
+    ]
+    return terms or ["*"]
+
+
+def index_search(search):
+    """(Re)write a flushed search's postings in the current transaction"""
+    terms = search_terms(search)
+    db.session.execute(delete(SavedSearchTerm).where(SavedSearchTerm.saved_search_id == search.id))
+    db.session.execute(insert(SavedSearchTerm), [{"term": term, "saved_search_id": search.id} for term in terms])
+    search.term_count = len(terms)
+
+
+def clean_criteria(data):
+    """The search criteria in a request body, blank strings as None"""
+    values = {}
+    for field in (*EQUALITY_CRITERIA, *RANGE_CRITERIA):
+        value = data.get(field)
+        values[field] = (value.strip() or None) if isinstance(value, str) else value
+    return values
+
+
+def criteria_error(values):
+    """Why the given criteria can't be saved, or None"""
+    for field in ("property_type_id", *RANGE_CRITERIA):
+        value = values.get(field)
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0):
+            return f"{field} must be a non-negative integer"
+    for field in ("listing_type", "city", "neighborhood"):
+        value = values.get(field)
+        if value is not None and not isinstance(value, str):
+            return f"{field} must be a string"
+    if values.get("min_price") is not None and values.get("max_price") is not None \
+            and values["min_price"] > values["max_price"]:
+        return "min_price can't be above max_price"
+    if values.get("property_type_id") is not None and not db.session.get(Property_type, values["property_type_id"]):
+        return "Property type not found"
+    return None
+
+
+def _listings(property_ids):
+    """{property id: (terms, price, bedrooms, bathrooms)} for the live listings among ``property_ids``"""
+    rows = db.session.execute(
+        select(
+            Property.id, Property.listing_type, Property.property_type_id, Property.price, Property.bedrooms,
+            Property.bathrooms, Location.city, Location.neighborhood,
+        )
+        .outerjoin(PropertyLocation, PropertyLocation.property_id == Property.id)
+        .outerjoin(Location, Location.id == PropertyLocation.location_id)
+        .where(Property.id.in_(property_ids), Property.archived_at.is_(None))
+    )
+    listings = {}
+    for row in rows:
+        terms, *_ = listings.setdefault(row.id, ({"*"}, row.price, row.bedrooms, row.bathrooms))
+        for field in EQUALITY_CRITERIA:
+            value = getattr(row, field)
+            if value not in (None, ""):
+                terms.add(_term(field, value))
+    return listings
+
+
+def _in_range(search, price, bedrooms, bathrooms):
+    if search.min_price is not None and (price is None or price < search.min_price):
+        return False
+    if search.max_price is not None and (price is None or price > search.max_price):
+        return False
+    if search.min_bedrooms is not None and (bedrooms or 0) < search.min_bedrooms:
+        return False
+    if search.min_bathrooms is not None and (bathrooms or 0) < search.min_bathrooms:
+        return False
+    return True
+
+
+def candidate_hits(listings):
+    """{property id: Counter(search id: terms hit)} from one read of the postings of the listings' terms"""
+    postings = defaultdict(list)
+    all_terms = set().union(*(terms for terms, *_ in listings.values()))
+    for term, search_id in db.session.execute(
+        select(SavedSearchTerm.term, SavedSearchTerm.saved_search_id).where(SavedSearchTerm.term.in_(all_terms))
+    ):
+        postings[term].append(search_id)
+
+    return {
+        property_id: Counter(search_id for term in terms for search_id in postings[term])
+        for property_id, (terms, *_) in listings.items()
+    }
+
+
+def match_listings(property_ids):
+    """Record and notify the saved searches matched by the given listings. Returns the number of new matches."""
+    listings = _listings(property_ids)
+    if not listings:
+        return 0
+
+    hits = candidate_hits(listings)
+    candidate_ids = set().union(*(counts.keys() for counts in hits.values()))
+    if not candidate_ids:
+        return 0
+    searches = {
+        search.id: (search, user_id)
+        for search, user_id in db.session.execute(
+            select(SavedSearch, UserProfile.user_id)
+            .join(UserProfile, UserProfile.id == SavedSearch.user_id)
+            .where(SavedSearch.id.in_(candidate_ids))
+        )
+    }
+
+    matches = set()
+    for property_id, counts in hits.items():
+        _, price, bedrooms, bathrooms = listings[property_id]
+        for search_id, count in counts.items():
+            search, _ = searches.get(search_id, (None, None))
+            if search and count == search.term_count and _in_range(search, price, bedrooms, bathrooms):
+                matches.add((search_id, property_id))
+
+    # Edits re-run the matcher; listings already matched stay as they were
+    matches -= set(db.session.execute(
+        select(SavedSearchMatch.saved_search_id, SavedSearchMatch.property_id)
+        .where(SavedSearchMatch.property_id.in_(listings))
+    ).all())
+    if not matches:
+        return 0
+    now = datetime.now()
+    db.session.execute(insert(SavedSearchMatch), [
+        {"saved_search_id": search_id, "property_id": property_id, "created_at": now}
+        for search_id, property_id in matches
+    ])
+
+    touched = {search_id for search_id, _ in matches}
+    for search_id, new_matches in new_match_counts(touched).items():
+        search, user_id = searches[search_id]
+        notify(
+            f"New matches for {search.name}",
+            f"{new_matches} new {'listing matches' if new_matches == 1 else 'listings match'} your saved search",
+            "property", user_id=user_id, group_key=f"saved-search:{search_id}",
+        )
+    return len(matches)
+
+
+def queue_listing_matches(property_ids):
+    """Match the given listings against saved searches in a background job queued in the current transaction"""
+    for start in range(0, len(property_ids), MATCH_BATCH_SIZE):
+        enqueue("match-saved-searches", {"property_ids": list(property_ids[start:start + MATCH_BATCH_SIZE])})
+
+
+def new_match_counts(search_ids):
+    """{search id: live listings matched since the search was last opened}"""
+    if not search_ids:
+        return {}
+    return dict(db.session.execute(
+        select(SavedSearchMatch.saved_search_id, func.count())
+        .join(SavedSearch, SavedSearch.id == SavedSearchMatch.saved_search_id)
+        .join(Property, Property.id == SavedSearchMatch.property_id)
+        .where(
+            SavedSearchMatch.saved_search_id.in_(search_ids),
+            SavedSearchMatch.created_at > SavedSearch.seen_at,
+            Property.archived_at.is_(None),
+        )
+        .group_by(SavedSearchMatch.saved_search_id)
+    ).all())
+
+
+def delete_search(search_id):
+    """Delete a saved search with its postings and matches in the current transaction"""
+    db.session.execute(delete(SavedSearchTerm).where(SavedSearchTerm.saved_search_id == search_id))
+    db.session.execute(delete(SavedSearchMatch).where(SavedSearchMatch.saved_search_id == search_id))
+    db.session.execute(delete(SavedSearch).where(SavedSearch.id == search_id))
+
+
+@click.command("match-saved-searches")
+@click.option("--days", default=1, help="match listings created or edited in the last N days")
+@click.option("--reindex", is_flag=True, help="rewrite every search's postings first")
+@with_appcontext
+def match_saved_searches_command(days, reindex):
+    """Match recent listings against saved searches, e.g. after downtime or bulk seeding."""
+    db.create_all()
+    if reindex:
+        for search in db.session.scalars(select(SavedSearch)):
+            index_search(search)
+        db.session.commit()
+    since = datetime.now() - timedelta(days=days)
+    property_ids = db.session.scalars(
+        select(Property.id).where(or_(Property.created_at >= since, Property.updated_at >= since))
+    ).all()
+    matched = 0
+    for start in range(0, len(property_ids), MATCH_BATCH_SIZE):
+        matched += match_listings(property_ids[start:start + MATCH_BATCH_SIZE])
+        db.session.commit()
+    click.echo(f"Recorded {matched} new matches for {len(property_ids)} listings")
@@ -0,0 +1,159 @@
+"""Visit scheduling: agent availability windows split into fixed-length slots.
+
+A visit booked at ``t`` occupies ``[t, t + slot_minutes)``. Bookings are
+looked up through the (agent_id, sheduled_time) and (property_id,
+sheduled_time) indexes on ``views`` so conflict checks and free slot
+computation are range scans rather than table scans.
+"""
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from sqlalchemy import select, union_all, cast, null, or_, exists, Integer, DateTime
+from models import db, AgentAvailability, Property, View
+import os
+
+# Statuses that hold a slot. "viewed" rows are page views, not visits.
+BOOKED_STATUSES = ("pending", "completed")
+
+DEFAULT_SLOT_MINUTES = int(os.getenv("VISIT_SLOT_MINUTES", 60))
+
+# Agents that have not configured availability get Mon-Sat, 09:00-17:00
+DEFAULT_WINDOWS = [(weekday, 9 * 60, 17 * 60, DEFAULT_SLOT_MINUTES) for weekday in range(6)]
+
+MAX_RANGE_DAYS = 31
+
+
+def agent_windows(agent_id):
+    """Availability windows for an agent as (weekday, start_minute, end_minute, slot_minutes)"""
+    rows = AgentAvailability.query.filter_by(agent_id=agent_id).all()
+    if not rows:
+        return list(DEFAULT_WINDOWS)
+    return [(w.weekday, w.start_minute, w.end_minute, w.slot_minutes) for w in rows]
+
+
+def window_for(windows, when):
+    """Return the window containing ``when``, or None"""
+    minute = when.hour * 60 + when.minute
+    for weekday, start_minute, end_minute, slot_minutes in windows:
+        if weekday == when.weekday() and start_minute <= minute and minute + slot_minutes <= end_minute:
+            return weekday, start_minute, end_minute, slot_minutes
+    return None
+
+
+def slot_error(agent_id, property_id, start):
+    """Validate a requested visit start. Returns an error message, or None if the slot is free."""
+    window = window_for(agent_windows(agent_id), start)
+    if not window:
+        return "The agent is not available at this time"
+
+    _, start_minute, _, slot_minutes = window
+    if start.second or start.microsecond or (start.hour * 60 + start.minute - start_minute) % slot_minutes:
+        return f"Visits start on {slot_minutes}-minute slot boundaries"
+
+    if has_conflict(agent_id, property_id, start, slot_minutes):
+        return "This time slot is already booked"
+
+    return None
+
+
+def has_conflict(agent_id, property_id, start, slot_minutes):
+    """Indexed overlap check against booked visits for the same agent or property"""
+    length = timedelta(minutes=slot_minutes)
+    return db.session.query(exists().where(
+        or_(View.agent_id == agent_id, View.property_id == property_id),
+        View.status.in_(BOOKED_STATUSES),
+        View.sheduled_time > start - length,
+        View.sheduled_time < start + length,
+    )).scalar()
+
+
+def free_slots(property_id, start_date, end_date, now=None):
+    """Free visit slots for a property between two dates (inclusive).
+
+    Returns None when the property does not exist, otherwise a list of
+    ``{"date": ..., "slots": [...]}`` with one entry per day that has free slots.
+    """
+    now = now or datetime.now()
+    range_start = datetime.combine(start_date, datetime.min.time())
+    range_end = datetime.combine(end_date, datetime.min.time()) + timedelta(days=1)
+
+    agent_id, windows, booked = _load_schedule(property_id, range_start, range_end)
+    if agent_id is None:
+        return None
+    windows = windows or list(DEFAULT_WINDOWS)
+
+    # A booking blocks the window slot length it was made with
+    intervals = []
+    for booked_at in booked:
+        window = window_for(windows, booked_at)
+        length = window[3] if window else DEFAULT_SLOT_MINUTES
+        intervals.append((booked_at, booked_at + timedelta(minutes=length)))
+    intervals.sort()
+    starts = [interval[0] for interval in intervals]
+    longest = max([end - start for start, end in intervals], default=timedelta(0))
+
+    days = []
+    day = range_start
+    while day < range_end:
+        slots = []
+        for weekday, start_minute, end_minute, slot_minutes in sorted(windows, key=lambda w: w[1]):
+            if weekday != day.weekday():
+                continue
+            length = timedelta(minutes=slot_minutes)
+            minute = start_minute
+            while minute + slot_minutes <= end_minute:
+                slot_start = day + timedelta(minutes=minute)
+                minute += slot_minutes
+                if slot_start <= now:
+                    continue
+                # Only bookings starting within the longest booking length can overlap
+                i = bisect_left(starts, slot_start - longest)
+                overlaps = False
+                while i < len(intervals) and intervals[i][0] < slot_start + length:
+                    if intervals[i][1] > slot_start:
+                        overlaps = True
+                        break
+                    i += 1
+                if not overlaps:
+                    slots.append(slot_start.strftime("%H:%M"))
+        if slots:
+            days.append({"date": day.strftime("%Y-%m-%d"), "slots": slots})
+        day += timedelta(days=1)
+
+    return days
+
+
+def _load_schedule(property_id, range_start, range_end):
+    """Fetch the property's agent, that agent's windows and bookings in the range in one round trip"""
+    agent_id = select(Property.agent_id).where(Property.id == property_id).scalar_subquery()
+    no_int = cast(null(), Integer)
+    no_time = cast(null(), DateTime)
+
+    property_row = select(
+        Property.agent_id.label("agent_id"), no_int.label("weekday"), no_int.label("start_minute"),
+        no_int.label("end_minute"), no_int.label("slot_minutes"), no_time.label("booked_at"),
+    ).where(Property.id == property_id)
+
+    window_rows = select(
+        AgentAvailability.agent_id, AgentAvailability.weekday, AgentAvailability.start_minute,
+        AgentAvailability.end_minute, AgentAvailability.slot_minutes, no_time,
+    ).where(AgentAvailability.agent_id == agent_id)
+
+    # Widen the lower bound so bookings that started the previous day still count
+    booking_rows = select(
+        View.agent_id, no_int, no_int, no_int, no_int, View.sheduled_time,
+    ).where(
+        or_(View.agent_id == agent_id, View.property_id == property_id),
+        View.status.in_(BOOKED_STATUSES),
+        View.sheduled_time >= range_start - timedelta(days=1),
+        View.sheduled_time < range_end,
+    )
+
+    found, windows, booked = None, [], []
+    for row in db.session.execute(union_all(property_row, window_rows, booking_rows)):
+        if row.booked_at is not None:
+            booked.append(row.booked_at)
+        elif row.weekday is not None:
+            windows.append((row.weekday, row.start_minute, row.end_minute, row.slot_minutes))
+        else:
+            found = row.agent_id
+    return found, windows, booked
@@ -19,6 +19,11 @@ from models import (
 )
 from flask_bcrypt import generate_password_hash
 from datetime import datetime, timedelta
+from datagen import Volumes, generate, print_progress
+from market_stats import rebuild_market_stats
+from amenities import refresh_amenity_masks
+import argparse
+import time
 
 
 def seed_data():
@@ -400,8 +405,53 @@ def seed_data():
         db.session.add(favorite)
 
         db.session.commit()
+
+        print("📊 Building market stats...")
+        rebuild_market_stats()
+        refresh_amenity_masks()
         print("✅ Database seeded successfully!")
 
 
+def seed_bulk(volumes, seed=42, batch_size=5000, append=False, quiet=False):
+    """Fill the database with generated data at bulk insert speed (see datagen.py)"""
+    with app.app_context():
+        if not append:
+            print("🌱 Clearing existing data...")
+            db.drop_all()
+            db.create_all()
+
+        print(f"📦 Bulk seeding: {volumes.as_dict()}")
+        started = time.perf_counter()
+        inserted = generate(volumes, seed=seed, batch_size=batch_size, progress=None if quiet else print_progress())
+        elapsed = time.perf_counter() - started
+        total = sum(inserted.values())
+        print(f"✅ Inserted {total:,} rows in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s)")
+
+        print("📊 Building market stats...")
+        rebuild_market_stats()
+        print("⭐ Setting amenity masks...")
+        refresh_amenity_masks()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Seed the database")
+    parser.add_argument("--bulk", action="store_true", help="generate a large synthetic dataset instead of the demo data")
+    parser.add_argument("--preset", choices=sorted(Volumes.PRESETS), default="small", help="bulk dataset size (default: small)")
+    parser.add_argument("--seed", type=int, default=42, help="random seed, the same seed gives the same data (default: 42)")
+    parser.add_argument("--batch-size", type=int, default=5000, help="rows per insert batch (default: 5000)")
+    parser.add_argument("--append", action="store_true", help="add to the existing data instead of recreating the schema")
+    parser.add_argument("--quiet", action="store_true", help="no per-batch progress output")
+    for field in ("agents", "users", "properties", "views", "inquiries", "favorites", "conversations"):
+        parser.add_argument(f"--{field}", type=int, help=f"override the preset's {field} count")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    seed_data()
\ No newline at end of file
+    args = parse_args()
+    if args.bulk:
+        volumes = Volumes.preset(args.preset, agents=args.agents, users=args.users, properties=args.properties,
+                                 views=args.views, inquiries=args.inquiries, favorites=args.favorites,
+                                 conversations=args.conversations)
+        seed_bulk(volumes, seed=args.seed, batch_size=args.batch_size, append=args.append, quiet=args.quiet)
+    else:
+        seed_data()
\ No newline at end of file
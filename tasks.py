@@ -0,0 +1,175 @@
+"""Job handlers and the ``flask worker`` command.
+
+Importing this module registers the handlers, so app.py imports it in web
+processes too (the embedded worker needs them). The worker also queues the
+periodic maintenance jobs in SCHEDULE. Each run is keyed by its time slot,
+so any number of workers queue it exactly once.
+"""
+from datetime import datetime
+from flask import current_app
+from flask.cli import with_appcontext
+from models import db
+from database import statement_timeout, JOB_STATEMENT_TIMEOUT_MS
+from jobs import task, enqueue, work, prune_jobs, new_worker_id, JOB_POLL_INTERVAL
+from media import purge_files, purge_all
+from market_stats import refresh_segments, rebuild_market_stats
+from archival import run_archival
+from recommendations import rebuild_similarities
+from feed import build_preferences
+from analytics import aggregate_facts
+from notifications import dispatch_all
+from saved_searches import match_listings
+from catalog import prune_catalog_changes
+import click
+import logging
+import signal
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Seconds between runs of each periodic job
+SCHEDULE = {
+    "purge-media": 3600,
+    "dispatch-notifications": 300,
+    "aggregate-analytics": 3600,
+    "build-preferences": 3600,
+    "refresh-preferences": 300,
+    "build-similar": 86400,
+    "market-stats": 86400,
+    "archive": 86400,
+    "prune-jobs": 86400,
+    "prune-catalog-changes": 3600,
+}
+
+
+@task("purge-media")
+def purge_media(ids=None):
+    if ids is None:
+        _, failed = purge_all()
+    else:
+        _, failed, _ = purge_files(ids)
+    if failed:
+        # The rows record their own attempts; the retry picks up the ones still pending
+        raise OSError(f"{failed} files could not be removed")
+
+
+@task("refresh-market-segments")
+def refresh_market_segments(segments):
+    refresh_segments([tuple(segment) for segment in segments])
+
+
+@task("match-saved-searches")
+def match_saved_searches(property_ids):
+    match_listings(property_ids)
+
+
+@task("archive", timeout=3600)
+def archive():
+    run_archival()
+
+
+@task("build-similar", timeout=3600)
+def build_similar():
+    with statement_timeout(db.session, JOB_STATEMENT_TIMEOUT_MS):
+        rebuild_similarities()
+
+
+@task("build-preferences", timeout=3600)
+def build_user_preferences():
+    build_preferences()
+
+
+@task("refresh-preferences", timeout=900)
+def refresh_user_preferences():
+    build_preferences(stale_only=True)
+
+
+@task("aggregate-analytics", timeout=3600)
+def aggregate_analytics():
+    with statement_timeout(db.session, JOB_STATEMENT_TIMEOUT_MS):
+        aggregate_facts()
+
+
+@task("market-stats", timeout=3600)
+def market_stats():
+    with statement_timeout(db.session, JOB_STATEMENT_TIMEOUT_MS):
+        rebuild_market_stats()
+
+
+@task("dispatch-notifications")
+def dispatch_notifications():
+    dispatch_all()
+
+
+@task("prune-jobs")
+def prune():
+    prune_jobs()
+
+
+@task("prune-catalog-changes")
+def prune_changes():
+    prune_catalog_changes()
+
+
+def enqueue_scheduled(now=None):
+    """Queue the current run of every periodic job that isn't queued yet. Returns the names queued."""
+    now = now or datetime.now()
+    queued = []
+    for name, interval in SCHEDULE.items():
+        slot = int(now.timestamp() // interval)
+        if enqueue(name, key=f"schedule:{name}:{slot}", run_at=datetime.fromtimestamp(slot * interval)):
+            queued.append(name)
+    db.session.commit()
+    return queued
+
+
+def _run_worker(app, worker_id, stop, once):
+    with app.app_context():
+        while not stop.is_set():
+            try:
+                ran = work(worker_id)
+            except Exception:
+                logger.exception("Worker %s failed, retrying on the next poll", worker_id)
+                db.session.rollback()
+                ran = 0
+            if once and not ran:
+                break
+            if not ran:
+                stop.wait(JOB_POLL_INTERVAL)
+        db.session.remove()
+
+
+@click.command("worker")
+@click.option("--threads", default=1, help="jobs run concurrently by this process")
+@click.option("--once", is_flag=True, help="exit once the queue is empty")
+@click.option("--no-schedule", is_flag=True, help="don't queue the periodic jobs")
+@with_appcontext
+def worker_command(threads, once, no_schedule):
+    """Run queued background jobs until stopped."""
+    db.create_all()
+    app = current_app._get_current_object()
+    stop = threading.Event()
+    # Finish the jobs in hand on SIGTERM/SIGINT, then exit
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+
+    threads = [
+        threading.Thread(target=_run_worker, args=(app, new_worker_id(f":{i}"), stop, once), daemon=True)
+        for i in range(max(threads, 1))
+    ]
+    click.echo(f"Worker started with {len(threads)} threads")
+    for thread in threads:
+        thread.start()
+
+    # The main thread queues the periodic jobs while the threads run them
+    while not once and not stop.is_set():
+        if not no_schedule:
+            try:
+                enqueue_scheduled()
+            except Exception:
+                logger.exception("Queueing the scheduled jobs failed")
+                db.session.rollback()
+        stop.wait(60)
+    for thread in threads:
+        thread.join()
+    click.echo("Worker stopped")
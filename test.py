@@ -0,0 +1,1233 @@
+"""API tests, run with ``python -m pytest -q test.py``.
+
+The app is imported against two throwaway SQLite files: a primary and a
+stand-in read replica with the same schema but its own rows, so a test can
+tell from the data which database answered. The endpoint tests pin query
+budgets with ``assert_queries`` so per-row lookups fail the suite.
+"""
+from datetime import datetime
+from http.cookies import SimpleCookie
+from sqlalchemy.exc import OperationalError
+import os
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="ags-test-")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_tmp, "primary.db")
+os.environ["DATABASE_REPLICA_URLS"] = "sqlite:///" + os.path.join(_tmp, "replica.db")
+os.environ["JOBS_IN_PROCESS"] = "false"
+os.environ["BCRYPT_LOG_ROUNDS"] = "4"
+
+from flask import g
+from app import app
+from models import db, Amenity
+import database
+import pytest
+
+REPLICA = "replica_0"
+
+
+@pytest.fixture(scope="module", autouse=True)
+def schema():
+    with app.app_context():
+        db.create_all()
+        db.metadata.create_all(db.engines[REPLICA])
+        with db.engines[REPLICA].begin() as connection:
+            connection.execute(Amenity.__table__.insert(), [{"name": "replica only"}])
+    yield
+
+
+@pytest.fixture(autouse=True)
+def routing_state():
+    database.replica_health._status.clear()
+    database._sticky_users.clear()
+    yield
+
+
+def answered_by():
+    """Which database the session read from, judged by whether it holds the replica-only row"""
+    found = Amenity.query.filter_by(name="replica only").count()
+    return "replica" if found else "primary"
+
+
+def test_get_reads_from_replica():
+    with app.test_request_context("/", method="GET"):
+        assert answered_by() == "replica"
+
+
+def test_writes_go_to_primary():
+    with app.test_request_context("/", method="POST"):
+        assert answered_by() == "primary"
+        db.session.add(Amenity(name="written on post"))
+        db.session.commit()
+    with app.app_context():
+        assert Amenity.query.filter_by(name="written on post").count() == 1
+        with db.engines[REPLICA].connect() as connection:
+            assert connection.execute(
+                Amenity.__table__.select().where(Amenity.name == "written on post")
+            ).first() is None
+
+
+def test_get_that_writes_switches_to_primary():
+    with app.test_request_context("/", method="GET"):
+        assert answered_by() == "replica"
+        db.session.add(Amenity(name="written on get"))
+        db.session.flush()
+        assert answered_by() == "primary"
+        db.session.commit()
+    with app.app_context():
+        assert Amenity.query.filter_by(name="written on get").count() == 1
+
+
+def write_and_respond(user_id=None):
+    """Serve a POST that writes and return its response"""
+    with app.test_request_context("/", method="POST"):
+        app.preprocess_request()
+        g.user_id = user_id
+        db.session.add(Amenity(name=f"sticky {user_id}"))
+        db.session.commit()
+        return app.process_response(app.response_class())
+
+
+def test_cookie_sticks_to_primary_after_write():
+    response = write_and_respond()
+    cookie = SimpleCookie(response.headers["Set-Cookie"])[database.STICKY_COOKIE].value
+
+    with app.test_request_context("/", method="GET", headers={"Cookie": f"{database.STICKY_COOKIE}={cookie}"}):
+        assert answered_by() == "primary"
+    with app.test_request_context("/", method="GET"):
+        assert answered_by() == "replica"
+
+
+def test_user_sticks_to_primary_after_write():
+    write_and_respond(user_id=7)
+
+    with app.test_request_context("/", method="GET"):
+        g.user_id = 7
+        assert answered_by() == "primary"
+    with app.test_request_context("/", method="GET"):
+        g.user_id = 8
+        assert answered_by() == "replica"
+
+
+def test_lagging_replica_falls_back_to_primary(monkeypatch):
+    monkeypatch.setattr(database, "replica_lag", lambda connection: database.REPLICA_MAX_LAG + 1)
+    with app.test_request_context("/", method="GET"):
+        assert answered_by() == "primary"
+
+
+def test_unreachable_replica_falls_back_to_primary(monkeypatch):
+    def unreachable(connection):
+        raise OperationalError("SELECT 1", {}, Exception("connection refused"))
+
+    monkeypatch.setattr(database, "replica_lag", unreachable)
+    with app.test_request_context("/", method="GET"):
+        assert answered_by() == "primary"
+
+
+@pytest.fixture(scope="module")
+def seeded():
+    """Synthetic data plus a token for a user and an agent who own some of it"""
+    from datagen import Volumes, generate
+    from flask_jwt_extended import create_access_token
+    from models import User, Property, AgentProfile
+    from utils import build_claims
+
+    with app.app_context():
+        generate(Volumes.preset("tiny"), seed=7)
+        tokens, users = {}, {}
+        for role in ("user", "agent"):
+            users[role] = User.query.filter_by(role=role).order_by(User.id).first()
+            tokens[role] = create_access_token(identity=users[role].id, additional_claims=build_claims(users[role]))
+        ids = {
+            "property": db.session.query(Property.id).order_by(Property.id).limit(1).scalar(),
+            "agent_property": db.session.query(Property.id)
+            .join(AgentProfile, AgentProfile.id == Property.agent_id)
+            .filter(AgentProfile.user_id == users["agent"].id)
+            .order_by(Property.id).limit(1).scalar(),
+        }
+        db.session.remove()
+    return tokens, ids
+
+
+@pytest.fixture
+def primary_only(monkeypatch):
+    """The seeded data only exists on the primary"""
+    monkeypatch.setattr(database.replica_health, "is_healthy", lambda key, engine: False)
+
+
+def make_account(role, name):
+    """A new user or agent with its profile. Returns (access token, user id, profile id)."""
+    from flask_jwt_extended import create_access_token
+    from models import AgentProfile, User, UserProfile
+    from utils import build_claims
+
+    with app.app_context():
+        user = User(first_name=name, last_name="Test", phone=f"test-{name}", email=f"{name}@test.local",
+                    password="not a hash", role=role)
+        db.session.add(user)
+        db.session.flush()
+        if role == "agent":
+            profile = AgentProfile(user_id=user.id, license_number=f"TEST-{name}")
+        else:
+            profile = UserProfile(user_id=user.id)
+        db.session.add(profile)
+        db.session.commit()
+        token = create_access_token(identity=user.id, additional_claims=build_claims(user))
+        return token, user.id, profile.id
+
+
+# Rows of each kind the budget user owns, more than assert_queries allows a statement to repeat
+BUSY_ROWS = 5
+
+
+@pytest.fixture(scope="module")
+def busy_user(seeded):
+    """Token of a user with BUSY_ROWS favorites, inquiries, conversations, visits, views, searches and notifications"""
+    from datetime import timedelta
+    from models import Conversation, Favorite, Inquiry, Message, Notification, Property, SavedSearch, View
+
+    token, user_id, profile_id = make_account("user", "busy")
+    with app.app_context():
+        listings = db.session.execute(
+            db.select(Property.id, Property.agent_id).order_by(Property.id.desc()).limit(BUSY_ROWS)
+        ).all()
+        now = datetime.now()
+        for i, (property_id, agent_id) in enumerate(listings):
+            conversation = Conversation(user_id=user_id, agent_id=agent_id, property_id=property_id,
+                                        last_message="Still available?")
+            db.session.add_all([
+                conversation,
+                Favorite(user_id=profile_id, property_id=property_id),
+                Inquiry(user_id=user_id, agent_id=agent_id, property_id=property_id, message="Is it available?"),
+                View(property_id=property_id, user_id=user_id, sheduled_time=now - timedelta(days=i + 1),
+                     status="viewed"),
+                View(property_id=property_id, user_id=user_id, agent_id=agent_id,
+                     sheduled_time=(now + timedelta(days=60 + i)).replace(hour=10, minute=0, second=0, microsecond=0),
+                     status="pending"),
+                SavedSearch(user_id=profile_id, name=f"Search {i}", listing_type="sale", term_count=0, seen_at=now),
+                Notification(user_id=user_id, title="Visit confirmed", message=f"Visit {i}", notification_type="viewing"),
+            ])
+            db.session.flush()
+            db.session.add(Message(conversation_id=conversation.id, sender_id=user_id, sender_type="agent",
+                                   content="Yes it is"))
+        db.session.commit()
+    return token
+
+
+@pytest.mark.parametrize("role, url, max_queries", [
+    ("user", "/user/profile", 4),
+    ("user", "/user/stats", 4),
+    ("user", "/user/saved-properties", 4),
+    ("user", "/user/recent-activity", 4),
+    ("user", "/user/properties", 6),
+    ("user", "/user/properties/{property}", 3),
+    ("user", "/user/properties/{property}/page", 3),
+    ("user", "/user/inquiries", 6),
+    ("user", "/user/conversations", 6),
+    ("user", "/user/scheduled-visits", 3),
+    ("user", "/user/feed", 6),
+    ("user", "/user/saved-searches", 3),
+    ("user", "/notifications", 3),
+    ("agent", "/agent/stats", 6),
+    ("agent", "/agent/properties?limit=20", 4),
+    ("agent", "/agent/inquiries?limit=20", 4),
+    ("agent", "/agent/properties/{agent_property}", 8),
+    ("agent", "/agent/analytics", 4),
+])
+def test_query_budget(seeded, busy_user, primary_only, role, url, max_queries):
+    from instrumentation import assert_queries
+
+    tokens, ids = seeded
+    tokens = dict(tokens, user=busy_user)
+    client = app.test_client()
+    with assert_queries(max_queries=max_queries, max_repeats=2):
+        response = client.get(url.format(**ids), headers={"Authorization": f"Bearer {tokens[role]}"})
+    assert response.status_code == 200, response.get_data(as_text=True)
+
+
+def test_metrics_require_token(monkeypatch):
+    import metrics
+
+    client = app.test_client()
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", None)
+    assert client.get("/metrics").status_code == 403
+    monkeypatch.setattr(metrics, "METRICS_TOKEN", "scrape-me")
+    assert client.get("/metrics").status_code == 401
+    response = client.get("/metrics", headers={"Authorization": "Bearer scrape-me"})
+    assert response.status_code == 200
+    assert "http_requests_total" in response.get_data(as_text=True)
+
+
+def test_reuploaded_file_is_not_purged(seeded, tmp_path):
+    from media import queue_file_deletions, purge_files
+    from models import PendingFileDeletion, PropertyImage
+
+    _, ids = seeded
+    kept = tmp_path / f"property_{ids['property']}_front.jpg"
+    dropped = tmp_path / f"property_{ids['property']}_back.jpg"
+    kept.write_bytes(b"jpg")
+    dropped.write_bytes(b"jpg")
+    with app.app_context():
+        # An edit drops both rows and uploads front.jpg again
+        old = [PropertyImage(property_id=ids["property"], image_url=f"/uploads/{path.name}") for path in (kept, dropped)]
+        db.session.add_all(old)
+        db.session.flush()
+        for row in old:
+            db.session.delete(row)
+        db.session.add(PropertyImage(property_id=ids["property"], image_url=f"/uploads/{kept.name}"))
+        pending = queue_file_deletions([f"/uploads/{kept.name}", f"/uploads/{dropped.name}"], tmp_path)
+        assert [row.path for row in pending] == [str(dropped)]
+
+        # front.jpg queued before the re-upload: the purge checks again and keeps it
+        pending.append(PendingFileDeletion(path=str(kept)))
+        db.session.add_all(pending)
+        db.session.commit()
+        assert purge_files([row.id for row in pending])[:2] == (1, 0)
+        assert kept.exists() and not dropped.exists()
+        assert db.session.query(PendingFileDeletion).count() == 0
+
+
+def test_similarity_blocks_fit_memory_budget():
+    import numpy as np
+    from recommendations import block_rows_for, nearest_neighbors
+
+    assert block_rows_for(100_000, budget_bytes=64 * 1024 * 1024) == 83
+    assert block_rows_for(10**12, budget_bytes=1) == 1
+    matrix = np.random.default_rng(0).random((300, 8)).astype(np.float32)
+    whole, _ = nearest_neighbors(matrix, 5, block_rows=300)
+    blocked, _ = nearest_neighbors(matrix, 5, block_rows=7)
+    assert (whole == blocked).all()
+
+
+def test_feed_interactions_mark_vector_stale(seeded, monkeypatch):
+    import feed
+    from models import Favorite, UserPreference, UserProfile, View
+
+    with app.app_context():
+        assert feed.build_preferences() > 0
+        user_id = db.session.scalar(db.select(UserPreference.user_id).order_by(UserPreference.user_id))
+        feed.forget_feed(user_id)
+        db.session.commit()
+        assert db.session.get(UserPreference, user_id).stale
+        assert feed.build_preferences(stale_only=True) == 1
+        assert not db.session.get(UserPreference, user_id).stale
+
+        canceled = db.session.scalars(db.select(View.user_id).where(View.status == "canceled")).all()
+        favorites = db.select(db.func.count()).select_from(Favorite).join(UserProfile, UserProfile.id == Favorite.user_id)
+        views = db.select(db.func.count()).select_from(View).where(View.status != "canceled")
+        users, _, _ = feed.interactions(canceled)
+        assert len(users) == db.session.scalar(favorites.where(UserProfile.user_id.in_(canceled))) \
+            + db.session.scalar(views.where(View.user_id.in_(canceled)))
+
+        monkeypatch.setattr(feed, "FEED_DEPTH", 10)
+        feed._feeds.clear()
+        ranked, _ = feed.ranked_ids(user_id)
+        assert len(ranked) == 10
+
+
+def test_late_payments_and_canceled_visits_in_analytics(seeded):
+    from datetime import datetime, timedelta
+    from analytics import aggregate_facts
+    from models import AgentDailyFact, AgentProfile, Payment, View
+
+    with app.app_context():
+        aggregate_facts(full=True)
+        agent_id = db.session.scalar(db.select(AgentProfile.id).order_by(AgentProfile.id))
+        now = datetime.now()
+        # Created two weeks ago, completed today: outside the lookback window by creation date
+        db.session.add(Payment(agent_id=agent_id, amount=12345, status="complete",
+                               created_at=now - timedelta(days=14), updated_at=now))
+        db.session.commit()
+        aggregate_facts()
+        revenue = db.select(db.func.sum(AgentDailyFact.revenue)).where(
+            AgentDailyFact.agent_id == agent_id, AgentDailyFact.day == now.date())
+        assert db.session.scalar(revenue) >= 12345
+
+        visits = db.session.scalar(db.select(db.func.sum(AgentDailyFact.visits)))
+        booked = db.session.scalar(db.select(db.func.count()).select_from(View).where(
+            View.status.in_(("pending", "completed")), View.property_id.is_not(None)))
+        assert visits <= booked
+
+
+def test_saved_search_in_another_city_is_never_loaded(seeded):
+    from saved_searches import _listings, candidate_hits, index_search
+    from models import Location, PropertyLocation, SavedSearch, UserProfile
+
+    _, ids = seeded
+    with app.app_context():
+        city = db.session.scalar(db.select(Location.city).join(PropertyLocation).where(
+            PropertyLocation.property_id == ids["property"]))
+        profile_id = db.session.scalar(db.select(UserProfile.id).order_by(UserProfile.id))
+        searches = [SavedSearch(user_id=profile_id, name=name, city=where, term_count=0,
+                                seen_at=datetime.now())
+                    for name, where in (("here", city), ("elsewhere", f"not {city}"), ("anywhere", None))]
+        db.session.add_all(searches)
+        db.session.flush()
+        for search in searches:
+            index_search(search)
+        here, elsewhere, anywhere = searches
+        assert (here.term_count, anywhere.term_count) == (1, 1)
+
+        hits = candidate_hits(_listings([ids["property"]]))[ids["property"]]
+        assert hits[here.id] == here.term_count and hits[anywhere.id] == anywhere.term_count
+        assert elsewhere.id not in hits
+        db.session.rollback()
+
+
+@pytest.mark.parametrize("url, key", [
+    ("/user/properties", None),
+    ("/user/saved-properties", "properties"),
+    ("/user/properties/{property}/page", None),
+])
+def test_listing_payloads_hide_amenity_mask(seeded, primary_only, url, key):
+    tokens, ids = seeded
+    response = app.test_client().get(url.format(**ids), headers={"Authorization": f"Bearer {tokens['user']}"})
+    assert response.status_code == 200
+    body = response.get_json()
+    listings = body[key] if key else body if isinstance(body, list) else [body]
+    assert listings and all("amenity_mask" not in listing for listing in listings)
+
+
+def test_catalog_rebuild_keeps_serving_old_snapshot(seeded, primary_only, monkeypatch):
+    import threading
+    import catalog
+
+    with app.app_context():
+        old = catalog.catalog_snapshot()
+    started, finish = threading.Event(), threading.Event()
+    build = catalog.build_snapshot
+
+    def slow_build():
+        started.set()
+        finish.wait(5)
+        return build()
+
+    def rebuild():
+        with app.app_context():
+            catalog.catalog_snapshot()
+
+    monkeypatch.setattr(catalog, "_snapshot", old)
+    monkeypatch.setattr(catalog, "_checked_at", 0.0)
+    monkeypatch.setattr(catalog, "CATALOG_REBUILD_SECONDS", -1)
+    monkeypatch.setattr(catalog, "build_snapshot", slow_build)
+    builder = threading.Thread(target=rebuild)
+    builder.start()
+    assert started.wait(5)
+    with app.app_context():
+        assert catalog.catalog_snapshot().built_at == old.built_at
+    finish.set()
+    builder.join(5)
+    assert catalog._snapshot.built_at > old.built_at
+
+
+def test_catalog_changes_use_local_time(seeded):
+    from datetime import timedelta
+    from catalog import prune_catalog_changes, record_listing_changes
+    from models import CatalogChange
+
+    _, ids = seeded
+    with app.app_context():
+        before = datetime.now()
+        record_listing_changes([ids["property"]])
+        db.session.commit()
+        created_at = db.session.scalar(db.select(db.func.max(CatalogChange.created_at)))
+        assert before - timedelta(seconds=1) <= created_at <= datetime.now()
+        assert prune_catalog_changes() == 0
+
+
+def test_listings_changed_queues_every_follow_up(seeded):
+    from listing_changes import listings_changed
+    from models import CatalogChange, Job
+
+    _, ids = seeded
+    gone = 10**9
+    with app.app_context():
+        first_job = db.session.scalar(db.select(db.func.max(Job.id))) or 0
+        listings_changed([ids["property"], gone], {("sale", -1, -1)})
+        db.session.flush()
+        jobs = {job.name: job.payload for job in db.session.scalars(db.select(Job).where(Job.id > first_job))}
+        assert jobs["match-saved-searches"] == {"property_ids": [ids["property"]]}
+        assert ["sale", -1, -1] in jobs["refresh-market-segments"]["segments"]
+        assert len(jobs["refresh-market-segments"]["segments"]) == 2
+        changed = db.session.scalars(db.select(CatalogChange.property_id).order_by(CatalogChange.id.desc()).limit(2))
+        assert set(changed) == {ids["property"], gone}
+        db.session.rollback()
+
+
+@pytest.mark.parametrize("sort", ["newest", "price_asc", "price_desc"])
+def test_catalog_pages_hold_when_listings_drop_out(seeded, primary_only, monkeypatch, sort):
+    import time
+    import catalog
+
+    client = app.test_client()
+    everything = client.get(f"/properties/facets?sort={sort}&limit=100").get_json()
+    listed = [card["id"] for card in everything["properties"]]
+    assert everything["total"] > 10
+
+    first = client.get(f"/properties/facets?sort={sort}&limit=5").get_json()
+    assert [card["id"] for card in first["properties"]] == listed[:5]
+    # A listing on the first page leaves the catalog before the second page is read
+    snapshot = catalog._snapshot
+    live = snapshot.columns["live"].copy()
+    live[snapshot.rows[listed[0]]] = False
+    columns = dict(snapshot.columns, live=live)
+    monkeypatch.setattr(catalog, "_snapshot", catalog.Snapshot(
+        snapshot.dictionaries, columns, snapshot.rows, snapshot.watermark, snapshot.gaps, snapshot.built_at))
+    monkeypatch.setattr(catalog, "_checked_at", time.monotonic() + 3600)
+    second = client.get(f"/properties/facets?sort={sort}&limit=5&cursor={first['next_cursor']}").get_json()
+    assert [card["id"] for card in second["properties"]] == listed[5:10]
+
+
+@pytest.mark.parametrize("query", ["min_price=abc", "max_price=-5", "min_bedrooms=2.5", "cursor=bm9wZQ"])
+def test_catalog_rejects_bad_numbers(primary_only, query):
+    assert app.test_client().get(f"/properties/facets?{query}").status_code == 400
+
+
+# Tables that predate the Alembic revisions, and the columns the revisions add to them
+PRE_MIGRATION_TABLES = (
+    "users", "admin_profiles", "agent_profiles", "user_profiles", "properties", "property_types", "locations",
+    "property_locations", "agencies", "property_images", "property_videos", "amenities", "property_amenities",
+    "views", "transactions", "subscriptions", "payments", "favorites", "inquiries", "conversations", "messages",
+    "reviews", "notifications", "user_preferences",
+)
+MIGRATED_COLUMNS = {
+    ("views", "agent_id"), ("locations", "normalized_key"), ("properties", "archived_at"),
+    ("properties", "amenity_mask"), ("user_preferences", "stale"),
+    ("notifications", "group_key"),
+}
+
+
+def pre_migration_database(path):
+    """A SQLite database with the tables as they were before the revisions, without indexes"""
+    import sqlalchemy as sa
+
+    engine = sa.create_engine(f"sqlite:///{path}")
+    old = sa.MetaData()
+    for table in db.metadata.sorted_tables:
+        if table.name in PRE_MIGRATION_TABLES:
+            sa.Table(table.name, old, *(
+                sa.Column(column.name, column.type, primary_key=column.primary_key)
+                for column in table.columns if (table.name, column.name) not in MIGRATED_COLUMNS
+            ))
+    old.create_all(engine)
+    return engine
+
+
+def upgrade_database(engine):
+    """Run ``flask db upgrade`` against ``engine``'s database"""
+    from flask import Flask
+    from flask_migrate import Migrate, upgrade
+
+    migrating = Flask(__name__)
+    migrating.config["SQLALCHEMY_DATABASE_URI"] = engine.url.render_as_string(hide_password=False)
+    db.init_app(migrating)
+    Migrate(migrating, db, directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations"))
+    with migrating.app_context():
+        upgrade()
+        db.engine.dispose()
+
+
+def test_migrations_upgrade_a_pre_migration_database(tmp_path):
+    import sqlalchemy as sa
+
+    engine = pre_migration_database(tmp_path / "old.db")
+    with engine.begin() as connection:
+        connection.execute(sa.text("INSERT INTO properties (id, agent_id) VALUES (1, 5), (2, 5)"))
+        connection.execute(sa.text(
+            "INSERT INTO views (id, property_id, user_id, sheduled_time, status) VALUES "
+            "(1, 1, 1, '2030-01-07 10:00:00', 'pending'), (2, 2, 1, '2030-01-07 10:00:00', 'pending'), "
+            "(3, 1, 1, '2030-01-07 11:00:00', 'completed'), (4, 1, 1, '2030-01-07 12:00:00', 'viewed')"
+        ))
+        connection.execute(sa.text(
+            "INSERT INTO locations (id, country, city, neighborhood) VALUES "
+            "(1, 'Kenya', 'Nairobi', 'Karen'), (2, NULL, ' nairobi ', 'KAREN'), (3, 'Kenya', 'Mombasa', NULL)"
+        ))
+        connection.execute(sa.text(
+            "INSERT INTO property_locations (id, property_id, location_id) VALUES (1, 1, 1), (2, 1, 2), (3, 2, 2)"
+        ))
+        connection.execute(sa.text(
+            "INSERT INTO property_amenities (id, property_id, amenity_id) VALUES (1, 1, 1), (2, 1, 3), (3, 1, 3), "
+            "(4, 1, 64), (5, 2, 63)"
+        ))
+    upgrade_database(engine)
+
+    inspector = sa.inspect(engine)
+    indexes = {index["name"] for index in inspector.get_indexes("views")}
+    assert {"ix_views_user_id_sheduled_time", "ix_views_agent_id_sheduled_time", "ix_views_property_id_sheduled_time",
+            "uq_views_agent_id_sheduled_time_pending"} <= indexes
+    with engine.connect() as connection:
+        agents = dict(connection.execute(sa.text("SELECT id, agent_id FROM views")).all())
+    # The second booking of the same slot keeps no agent so the unique index holds
+    assert agents == {1: 5, 2: None, 3: 5, 4: None}
+
+    assert "uq_locations_normalized_key" in {index["name"] for index in inspector.get_indexes("locations")}
+    with engine.connect() as connection:
+        keys = dict(connection.execute(sa.text("SELECT id, normalized_key FROM locations")).all())
+        links = connection.execute(sa.text("SELECT property_id, location_id FROM property_locations")).all()
+    assert keys == {1: "kenya|nairobi|nairobi|karen", 3: "kenya|mombasa|mombasa|"}
+    assert sorted(links) == [(1, 1), (2, 1)]
+
+    assert "ix_properties_archived_at" in {index["name"] for index in inspector.get_indexes("properties")}
+    assert {"views_archive", "inquiries_archive"} <= set(inspector.get_table_names())
+
+    with engine.connect() as connection:
+        masks = dict(connection.execute(sa.text("SELECT id, amenity_mask FROM properties")).all())
+    assert masks == {1: 0b101, 2: 1 << 62}
+
+    assert "stale" in {column["name"] for column in inspector.get_columns("user_preferences")}
+    assert {"ix_notifications_user_id_created_at", "ix_notifications_user_id_is_read"} <= {
+        index["name"] for index in inspector.get_indexes("notifications")}
+    assert "group_key" in {column["name"] for column in inspector.get_columns("notifications")}
+    assert "notification_outbox" in inspector.get_table_names()
+
+
+def test_migrations_skip_what_create_all_made(tmp_path):
+    import sqlalchemy as sa
+
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'new.db'}")
+    db.metadata.create_all(engine)
+    upgrade_database(engine)
+    with engine.connect() as connection:
+        assert connection.execute(sa.text("SELECT version_num FROM alembic_version")).scalar()
+
+
+def visit_slot(days_ahead=7, hour=10, minute=0):
+    """A Monday at the given time, a week or more from now"""
+    from datetime import timedelta
+
+    day = datetime.now().date() + timedelta(days=days_ahead)
+    day += timedelta(days=-day.weekday() % 7)
+    return datetime(day.year, day.month, day.day, hour, minute)
+
+
+def test_slot_error_checks_window_boundary_and_bookings(seeded):
+    from datetime import timedelta
+    from models import Property, View
+    from scheduling import slot_error
+
+    _, ids = seeded
+    with app.app_context():
+        prop = db.session.get(Property, ids["property"])
+        monday = visit_slot()
+        assert slot_error(prop.agent_id, prop.id, monday + timedelta(days=6)) == "The agent is not available at this time"
+        assert slot_error(prop.agent_id, prop.id, monday.replace(hour=7)) == "The agent is not available at this time"
+        assert slot_error(prop.agent_id, prop.id, monday.replace(minute=30)).endswith("slot boundaries")
+        assert slot_error(prop.agent_id, prop.id, monday) is None
+
+        db.session.add(View(property_id=prop.id, user_id=1, agent_id=prop.agent_id, sheduled_time=monday,
+                            status="pending"))
+        db.session.flush()
+        assert slot_error(prop.agent_id, prop.id, monday) == "This time slot is already booked"
+        assert slot_error(prop.agent_id, prop.id, monday + timedelta(hours=1)) is None
+        db.session.rollback()
+
+
+def test_has_conflict_by_agent_property_and_overlap(seeded):
+    from datetime import timedelta
+    from models import Property, View
+    from scheduling import has_conflict
+
+    _, ids = seeded
+    with app.app_context():
+        prop = db.session.get(Property, ids["property"])
+        monday = visit_slot()
+        db.session.add(View(property_id=prop.id, user_id=1, agent_id=prop.agent_id, sheduled_time=monday,
+                            status="pending"))
+        db.session.add(View(property_id=prop.id, user_id=1, agent_id=prop.agent_id,
+                            sheduled_time=monday + timedelta(hours=3), status="canceled"))
+        db.session.flush()
+        other_agent, other_property = -1, -1
+        # Same agent on another listing, same listing under another agent
+        assert has_conflict(prop.agent_id, other_property, monday, 60)
+        assert has_conflict(other_agent, prop.id, monday, 60)
+        # Starts inside the booked hour, or ends inside it
+        assert has_conflict(other_agent, prop.id, monday + timedelta(minutes=30), 60)
+        assert has_conflict(other_agent, prop.id, monday - timedelta(minutes=30), 60)
+        assert not has_conflict(other_agent, prop.id, monday + timedelta(hours=1), 60)
+        assert not has_conflict(other_agent, prop.id, monday - timedelta(hours=1), 60)
+        assert not has_conflict(prop.agent_id, other_property, monday + timedelta(hours=2), 60)
+        # Canceled visits free their slot
+        assert not has_conflict(prop.agent_id, prop.id, monday + timedelta(hours=3), 60)
+        db.session.rollback()
+
+
+def test_free_slots_skip_bookings_and_the_past(seeded):
+    from datetime import timedelta
+    from models import AgentAvailability, Property, View
+    from scheduling import free_slots
+
+    _, ids = seeded
+    with app.app_context():
+        prop = db.session.get(Property, ids["property"])
+        monday = visit_slot()
+        db.session.query(AgentAvailability).filter_by(agent_id=prop.agent_id).delete()
+        db.session.add(AgentAvailability(agent_id=prop.agent_id, weekday=0, start_minute=9 * 60,
+                                         end_minute=12 * 60, slot_minutes=60))
+        db.session.add(View(property_id=prop.id, user_id=1, agent_id=prop.agent_id,
+                            sheduled_time=monday.replace(hour=10), status="pending"))
+        db.session.flush()
+
+        days = free_slots(prop.id, monday.date(), (monday + timedelta(days=1)).date())
+        assert days == [{"date": monday.strftime("%Y-%m-%d"), "slots": ["09:00", "11:00"]}]
+        assert free_slots(prop.id, monday.date(), monday.date(), now=monday.replace(hour=9, minute=30)) == [
+            {"date": monday.strftime("%Y-%m-%d"), "slots": ["11:00"]}]
+        assert free_slots(10**9, monday.date(), monday.date()) is None
+        db.session.rollback()
+
+
+def import_listings(token, body, fmt, **params):
+    query = "&".join(f"{key}={value}" for key, value in {"format": fmt, **params}.items())
+    return app.test_client().post(f"/agent/properties/import?{query}", data=body,
+                                  headers={"Authorization": f"Bearer {token}"})
+
+
+def agent_listing_count(profile_id):
+    from models import Property
+
+    with app.app_context():
+        return db.session.scalar(db.select(db.func.count()).select_from(Property).where(Property.agent_id == profile_id))
+
+
+IMPORT_CSV = (
+    "title,price,listing_type,property_type,bedrooms,city\n"
+    "Garden flat,25000,rent,Apartment,2,Nairobi\n"
+    "Too dear,99999999999999999999999,sale,House,3,Nairobi\n"
+    "Too many rooms,5000000,sale,House,3000000000,Nairobi\n"
+    ",100,rent,Apartment,1,Nairobi\n"
+    "Bungalow,9000000,sale,House,4,Mombasa\n"
+)
+
+
+def test_import_reports_bad_rows_and_keeps_good_ones(seeded, primary_only):
+    token, _, profile_id = make_account("agent", "importer-csv")
+    response = import_listings(token, IMPORT_CSV, "csv")
+    assert response.status_code == 200
+    report = response.get_json()
+    assert (report["rows"], report["imported"], report["failed"]) == (5, 2, 3)
+    assert report["errors"] == [
+        {"row": 3, "errors": ["price must be at most 2147483647"]},
+        {"row": 4, "errors": ["bedrooms must be at most 2147483647"]},
+        {"row": 5, "errors": ["title is required"]},
+    ]
+    assert agent_listing_count(profile_id) == 2
+
+    ndjson = "\n".join([
+        '{"title": "Loft", "price": 30000, "listing_type": "rent", "property_type": "Apartment"}',
+        "{not json",
+        '{"title": "Huge type", "price": 1, "listing_type": "rent", "property_type_id": 1e12}',
+        '["a list"]',
+        '{"title": "Plot", "price": "2e6", "listing_type": "sale", "property_type": "Land", "area_size": -1}',
+    ])
+    report = import_listings(token, ndjson, "ndjson").get_json()
+    assert (report["rows"], report["imported"], report["failed"]) == (5, 1, 4)
+    assert [error["errors"] for error in report["errors"]] == [
+        ["Invalid JSON"], ["property_type_id must be at most 2147483647"], ["Each line must be a JSON object"],
+        ["area_size must be at least 0"],
+    ]
+    assert agent_listing_count(profile_id) == 3
+
+
+def test_import_dry_run_writes_nothing(seeded, primary_only):
+    token, _, profile_id = make_account("agent", "importer-dry")
+    response = import_listings(token, IMPORT_CSV, "csv", dry_run="true")
+    assert response.status_code == 200
+    report = response.get_json()
+    assert report["dry_run"] and report["message"] == "Import checked"
+    assert (report["imported"], report["failed"]) == (2, 3)
+    assert agent_listing_count(profile_id) == 0
+
+
+def test_import_stops_at_max_rows(seeded, primary_only, monkeypatch):
+    import bulk_properties
+
+    monkeypatch.setattr(bulk_properties, "IMPORT_MAX_ROWS", 2)
+    token, _, profile_id = make_account("agent", "importer-max")
+    response = import_listings(token, IMPORT_CSV, "csv")
+    assert response.status_code == 413
+    assert response.get_json()["rows"] == 2
+    assert agent_listing_count(profile_id) == 1
+
+
+def test_export_imports_back_unchanged(seeded, primary_only):
+    import csv
+    import io
+
+    token, _, profile_id = make_account("agent", "importer-round-trip")
+    import_listings(token, IMPORT_CSV, "csv")
+    headers = {"Authorization": f"Bearer {token}"}
+
+    def exported():
+        body = app.test_client().get("/agent/properties/export?format=csv", headers=headers).get_data(as_text=True)
+        return body, list(csv.DictReader(io.StringIO(body)))
+
+    body, first = exported()
+    report = import_listings(token, body, "csv").get_json()
+    assert (report["imported"], report["failed"]) == (len(first), 0)
+
+    _, both = exported()
+    compared = [column for column in first[0] if column not in ("id", "listing_date")]
+    copies = both[len(first):]
+    assert [[row[column] for column in compared] for row in copies] == \
+        [[row[column] for column in compared] for row in first]
+
+
+def add_listing(agent_id, **fields):
+    """A flushed listing for ``agent_id`` with placeholder values for the required columns"""
+    from models import Property, Property_type
+
+    values = {"title": "Test listing", "price": 1_000_000, "currency": "Ksh", "listing_type": "sale",
+              "status": "onsale", "listing_date": datetime.now(),
+              "property_type_id": db.session.scalar(db.select(Property_type.id).order_by(Property_type.id))}
+    listing = Property(agent_id=agent_id, **{**values, **fields})
+    db.session.add(listing)
+    db.session.flush()
+    return listing
+
+
+@pytest.fixture
+def uncommitted(monkeypatch):
+    """Code under test commits into a transaction the test rolls back; yields a list counting the commits"""
+    commits = []
+
+    def commit():
+        commits.append(1)
+        db.session.flush()
+
+    with app.app_context():
+        monkeypatch.setattr(db.session, "commit", commit)
+        yield commits
+        db.session.rollback()
+
+
+def test_archive_listings_sold_expired_and_edited(seeded, uncommitted):
+    from datetime import timedelta
+    from archival import ARCHIVE_LISTINGS_AFTER_DAYS, ARCHIVE_SOLD_AFTER_DAYS, archive_listings
+    from models import Property, Transaction
+
+    _, ids = seeded
+    agent_id = db.session.get(Property, ids["property"]).agent_id
+    now = datetime.now()
+    old = now - timedelta(days=ARCHIVE_LISTINGS_AFTER_DAYS + 1)
+    sold, recently_sold, expired, edited, fresh = (
+        add_listing(agent_id, title=title, listing_date=listed, updated_at=edited_at)
+        for title, listed, edited_at in (
+            ("sold", now, now), ("recently sold", now, now), ("expired", old, old),
+            ("edited", old, now - timedelta(days=1)), ("fresh", now, now),
+        )
+    )
+    db.session.add_all([
+        Transaction(property_id=sold.id, user_id=1, closing_date=now - timedelta(days=ARCHIVE_SOLD_AFTER_DAYS + 1)),
+        Transaction(property_id=recently_sold.id, user_id=1, closing_date=now - timedelta(days=1)),
+    ])
+    db.session.flush()
+
+    assert archive_listings(now) >= 2
+    db.session.expire_all()
+    listings = (sold, recently_sold, expired, edited, fresh)
+    assert {listing.title for listing in listings if listing.archived_at} == {"sold", "expired"}
+
+
+def test_move_rows_in_batches_keeps_ids(seeded, uncommitted):
+    from datetime import timedelta
+    from archival import VIEW_COLUMNS, move_rows
+    from models import View, ViewArchive
+
+    _, ids = seeded
+    old = datetime.now() - timedelta(days=400)
+    views = [View(property_id=ids["property"], user_id=1, sheduled_time=old, status="viewed", created_at=old)
+             for _ in range(5)]
+    db.session.add_all(views)
+    db.session.flush()
+    view_ids = sorted(view.id for view in views)
+    del uncommitted[:]
+
+    assert move_rows(View, ViewArchive, VIEW_COLUMNS, View.id.in_(view_ids), batch_size=2) == 5
+    assert len(uncommitted) == 3
+    assert db.session.scalar(db.select(db.func.count()).select_from(View).where(View.id.in_(view_ids))) == 0
+    archived = db.session.execute(
+        db.select(ViewArchive.id, ViewArchive.property_id).where(ViewArchive.id.in_(view_ids))
+    ).all()
+    assert sorted(archived) == [(view_id, ids["property"]) for view_id in view_ids]
+
+
+def test_agent_endpoints_count_archived_rows_on_request(seeded, primary_only):
+    from models import InquiryArchive, View, ViewArchive
+
+    token, _, agent_id = make_account("agent", "archived-stats")
+    with app.app_context():
+        live = add_listing(agent_id, title="live")
+        archived = add_listing(agent_id, title="archived", archived_at=datetime.now())
+        db.session.add_all([
+            View(property_id=live.id, user_id=1, sheduled_time=datetime.now(), status="viewed"),
+            ViewArchive(id=10**9, property_id=archived.id, user_id=1, sheduled_time=datetime.now(), status="viewed"),
+            InquiryArchive(id=10**9, user_id=1, agent_id=agent_id, property_id=archived.id, message="Closed"),
+        ])
+        db.session.commit()
+
+    def get(url):
+        return app.test_client().get(url, headers={"Authorization": f"Bearer {token}"}).get_json()
+
+    assert get("/agent/stats") == {"listings": 1, "inquiries": 0, "viewings": 1, "revenue": 0}
+    assert get("/agent/stats?include_archived=true") == {"listings": 2, "inquiries": 1, "viewings": 2, "revenue": 0}
+    assert [(p["title"], p["archived"]) for p in get("/agent/properties")["properties"]] == [("live", False)]
+    everything = get("/agent/properties?include_archived=true")["properties"]
+    assert sorted((p["title"], p["archived"], p["views"]) for p in everything) == [
+        ("archived", True, 1), ("live", False, 1)]
+
+
+@pytest.fixture
+def job_queue(monkeypatch):
+    """An empty jobs table and test handlers: "test-ok" records its payload, "test-fail" always raises"""
+    import jobs
+    from models import Job
+
+    calls = []
+
+    def fail(**payload):
+        calls.append(payload)
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(jobs, "_tasks", dict(jobs._tasks))
+    jobs.task("test-ok")(lambda **payload: calls.append(payload))
+    jobs.task("test-fail", max_attempts=2)(fail)
+    monkeypatch.setattr(jobs.random, "uniform", lambda low, high: 1.0)
+    with app.app_context():
+        db.session.execute(db.delete(Job))
+        db.session.commit()
+        yield calls
+        db.session.rollback()
+
+
+def job_row(job_id):
+    from models import Job
+
+    db.session.expire_all()
+    return db.session.get(Job, job_id)
+
+
+def test_enqueue_keeps_one_job_per_idempotency_key(job_queue):
+    from jobs import enqueue
+    from models import Job
+
+    first = enqueue("test-ok", {"n": 1}, key="once")
+    assert first is not None
+    assert enqueue("test-ok", {"n": 2}, key="once") is None
+    db.session.commit()
+    assert enqueue("test-ok", {"n": 3}, key="once") is None
+    enqueue("test-ok", {"n": 4})
+    enqueue("test-ok", {"n": 5})
+    db.session.commit()
+    payloads = db.session.scalars(db.select(Job.payload).order_by(Job.id)).all()
+    assert payloads == [{"n": 1}, {"n": 4}, {"n": 5}]
+
+
+def test_claim_reclaims_jobs_whose_visibility_timeout_expired(job_queue):
+    from datetime import timedelta
+    from jobs import claim, enqueue
+
+    later = enqueue("test-ok", delay=60)
+    job = enqueue("test-ok")
+    db.session.commit()
+    assert claim("worker-a") == [job.id]
+    assert claim("worker-b") == []
+
+    job_row(job.id).locked_until = datetime.now() - timedelta(seconds=1)
+    db.session.commit()
+    assert claim("worker-b") == [job.id]
+    reclaimed = job_row(job.id)
+    assert (reclaimed.status, reclaimed.locked_by, reclaimed.attempts) == ("running", "worker-b", 2)
+    assert job_row(later.id).status == "queued"
+
+
+def test_failed_job_is_retried_with_backoff(job_queue):
+    from jobs import JOB_BACKOFF_BASE, JOB_BACKOFF_MAX, backoff, enqueue, work
+
+    assert [backoff(attempt) for attempt in (1, 2, 3)] == [JOB_BACKOFF_BASE, 2 * JOB_BACKOFF_BASE, 4 * JOB_BACKOFF_BASE]
+    assert backoff(100) == JOB_BACKOFF_MAX
+
+    job = enqueue("test-fail", {"n": 1})
+    db.session.commit()
+    started = datetime.now()
+    assert work("worker-a") == 1
+    retry = job_row(job.id)
+    assert (retry.status, retry.attempts, retry.locked_by) == ("queued", 1, None)
+    assert "RuntimeError: boom" in retry.last_error
+    assert (retry.run_at - started).total_seconds() >= JOB_BACKOFF_BASE
+    # Not due yet
+    assert work("worker-a") == 0
+    assert job_queue == [{"n": 1}]
+
+
+def test_job_fails_for_good_after_max_attempts(job_queue):
+    from jobs import enqueue, work
+
+    job = enqueue("test-fail")
+    db.session.commit()
+    for _ in range(2):
+        job_row(job.id).run_at = datetime.now()
+        db.session.commit()
+        assert work("worker-a") == 1
+    failed = job_row(job.id)
+    assert (failed.status, failed.attempts) == ("failed", 2)
+    assert failed.finished_at is not None and "boom" in failed.last_error
+    assert work("worker-a") == 0
+    assert len(job_queue) == 2
+
+
+def test_only_the_current_claimant_settles_a_job(job_queue):
+    from datetime import timedelta
+    from jobs import _finish, claim, enqueue, run_job
+
+    job = enqueue("test-ok")
+    db.session.commit()
+    assert claim("worker-a") == [job.id]
+    job_row(job.id).locked_until = datetime.now() - timedelta(seconds=1)
+    db.session.commit()
+    assert claim("worker-b") == [job.id]
+
+    # worker-a comes back after its claim expired; its outcome is dropped
+    run_job(job.id, "worker-a")
+    stolen = job_row(job.id)
+    assert (stolen.status, stolen.locked_by) == ("running", "worker-b")
+
+    _finish(job.id, "worker-b", status="done", finished_at=datetime.now())
+    done = job_row(job.id)
+    assert (done.status, done.locked_by, done.locked_until) == ("done", None, None)
+
+
+def user_notifications(user_id):
+    """(group key, message, is read) of a user's notifications, oldest first"""
+    from models import Notification
+
+    with app.app_context():
+        return db.session.execute(
+            db.select(Notification.group_key, Notification.message, Notification.is_read)
+            .where(Notification.user_id == user_id).order_by(Notification.id)
+        ).all()
+
+
+def test_dispatch_coalesces_unread_notifications_per_group_key():
+    from notifications import dispatch_all, notify
+
+    _, agent_user_id, agent_id = make_account("agent", "notified-agent")
+    with app.app_context():
+        notify("New message", "first", "message", user_id=agent_user_id, group_key="conversation:1")
+        notify("New message", "second", "message", agent_id=agent_id, group_key="conversation:1")
+        notify("Visit booked", "a visit", "system", agent_id=agent_id)
+        notify("Visit booked", "another visit", "system", agent_id=agent_id)
+        db.session.commit()
+        dispatch_all(limit=2)
+    assert user_notifications(agent_user_id) == [
+        ("conversation:1", "second", False), (None, "a visit", False), (None, "another visit", False)]
+
+    with app.app_context():
+        notify("New message", "third", "message", agent_id=agent_id, group_key="conversation:1")
+        db.session.commit()
+        dispatch_all()
+    assert user_notifications(agent_user_id)[0] == ("conversation:1", "third", False)
+    assert len(user_notifications(agent_user_id)) == 3
+
+
+def test_read_notification_starts_a_new_group(primary_only):
+    from notifications import dispatch_all, notify
+
+    token, user_id, _ = make_account("user", "notified-reader")
+    client, headers = app.test_client(), {"Authorization": f"Bearer {token}"}
+    with app.app_context():
+        notify("New message", "first", "message", user_id=user_id, group_key="conversation:2")
+        db.session.commit()
+        dispatch_all()
+    [notification] = client.get("/notifications", headers=headers).get_json()["notifications"]
+    assert client.post(f"/notifications/{notification['id']}/read", headers=headers).status_code == 200
+
+    with app.app_context():
+        notify("New message", "second", "message", user_id=user_id, group_key="conversation:2")
+        db.session.commit()
+        dispatch_all()
+    assert user_notifications(user_id) == [("conversation:2", "first", True), ("conversation:2", "second", False)]
+
+
+def test_unread_count_and_read_all(primary_only):
+    from notifications import dispatch_all, notify
+
+    token, user_id, _ = make_account("user", "notified-counter")
+    client, headers = app.test_client(), {"Authorization": f"Bearer {token}"}
+    with app.app_context():
+        for group_key in ("a", "b", None):
+            notify("Update", "news", user_id=user_id, group_key=group_key)
+        db.session.commit()
+        dispatch_all()
+
+    assert client.get("/notifications/unread-count", headers=headers).get_json() == {"unread": 3}
+    response = client.post("/notifications/read-all", headers=headers)
+    assert response.get_json()["updated"] == 3
+    assert client.get("/notifications/unread-count", headers=headers).get_json() == {"unread": 0}
+    assert client.get("/notifications?unread=true", headers=headers).get_json()["notifications"] == []
+    assert client.post("/notifications/read-all", headers=headers).get_json()["updated"] == 0
+
+
+def test_market_percentiles_match_exact_values(seeded, uncommitted):
+    import numpy as np
+    from market_stats import market_stats, refresh_segments, segments
+    from models import Property
+
+    _, ids = seeded
+    agent_id = db.session.get(Property, ids["property"]).agent_id
+    prices = np.random.default_rng(7).lognormal(np.log(5_000_000), 0.6, 401).round()
+    listings = [add_listing(agent_id, listing_type="test-percentiles", price=float(price)) for price in prices]
+    refresh_segments(segments(Property.id.in_([listing.id for listing in listings])))
+
+    [stats] = market_stats(["listing_type"], listing_type="test-percentiles")
+    assert stats["listings"] == len(prices)
+    assert stats["average_price"] == round(prices.mean())
+    for key, quantile in (("p25_price", 25), ("median_price", 50), ("p75_price", 75)):
+        assert stats[key] == pytest.approx(np.percentile(prices, quantile), rel=0.03)
+
+
+def test_market_segments_refresh_after_create_update_and_delete(seeded, uncommitted, tmp_path):
+    from listing_changes import listings_changed
+    from market_stats import market_stats, refresh_segments, segments
+    from models import Job, Property
+    from property_deletion import delete_property
+
+    _, ids = seeded
+    agent_id = db.session.get(Property, ids["property"]).agent_id
+    first_job = db.session.scalar(db.select(db.func.max(Job.id))) or 0
+
+    def refresh():
+        nonlocal first_job
+        for job in db.session.scalars(db.select(Job).where(Job.id > first_job, Job.name == "refresh-market-segments")):
+            refresh_segments([tuple(segment) for segment in job.payload["segments"]])
+            first_job = job.id
+
+    def stats():
+        return sorted((group["listing_type"], group["listings"], group["median_price"])
+                      for group in market_stats(["listing_type"]) if group["listing_type"].startswith("test-segment"))
+
+    listing = add_listing(agent_id, listing_type="test-segment", price=2_000_000)
+    add_listing(agent_id, listing_type="test-segment", price=2_000_000)
+    listings_changed([listing.id])
+    refresh()
+    assert stats() == [("test-segment", 2, pytest.approx(2_000_000, rel=0.03))]
+
+    touched = segments(Property.id == listing.id)
+    listing.listing_type, listing.price = "test-segment-moved", 8_000_000
+    db.session.flush()
+    listings_changed([listing.id], touched)
+    refresh()
+    assert stats() == [("test-segment", 1, pytest.approx(2_000_000, rel=0.03)),
+                       ("test-segment-moved", 1, pytest.approx(8_000_000, rel=0.03))]
+
+    delete_property(listing.id, str(tmp_path))
+    refresh()
+    assert stats() == [("test-segment", 1, pytest.approx(2_000_000, rel=0.03))]
+
+
+@pytest.mark.parametrize("query, message", [
+    ("group_by=street", "group_by must use"),
+    ("group_by=,", "group_by must use"),
+    ("months=0", "months must be between"),
+    ("months=121", "months must be between"),
+    ("from=2025-05-10&to=2025-04-30", "'to' must not be before 'from'"),
+])
+def test_market_stats_rejects_bad_parameters(seeded, primary_only, query, message):
+    tokens, _ = seeded
+    response = app.test_client().get(f"/market/stats?{query}", headers={"Authorization": f"Bearer {tokens['agent']}"})
+    assert response.status_code == 400
+    assert response.get_json()["message"].startswith(message)
+
+
+def test_market_stats_window(seeded, primary_only):
+    tokens, _ = seeded
+    client, headers = app.test_client(), {"Authorization": f"Bearer {tokens['agent']}"}
+
+    window = client.get("/market/stats?from=2025-04-10&to=2025-04-30&group_by=month,city", headers=headers).get_json()
+    assert (window["from"], window["to"], window["group_by"]) == ("2025-04-01", "2025-04-01", ["month", "city"])
+    assert all(group["month"] == "2025-04" for group in window["groups"])
+
+    today = datetime.now().date().replace(day=1)
+    months = client.get("/market/stats?months=1", headers=headers).get_json()
+    assert (months["from"], months["to"]) == (today.isoformat(), today.isoformat())
+    assert client.get("/market/stats?months=120", headers=headers).status_code == 200
+
+
+def stored_password(user_id):
+    from models import User
+
+    with app.app_context():
+        return db.session.get(User, user_id).password
+
+
+def login(name, password="secret-password"):
+    return app.test_client().post("/login", json={"email": f"{name}@test.local", "password": password})
+
+
+@pytest.mark.parametrize("name, rounds", [("rehash-cost", 5), ("rehash-plain", None)])
+def test_login_rehashes_old_passwords(primary_only, name, rounds):
+    """Hashes with another cost and plain text passwords are replaced by a hash with the configured cost"""
+    from models import User
+    from passwords import hash_password, hash_rounds, log_rounds
+
+    _, user_id, _ = make_account("user", name)
+    with app.app_context():
+        current = log_rounds()
+        db.session.get(User, user_id).password = hash_password("secret-password", rounds) if rounds else "secret-password"
+        db.session.commit()
+
+    assert login(name).status_code == 200
+    assert hash_rounds(stored_password(user_id)) == current != rounds
+    assert login(name).status_code == 200
+    assert login(name, "wrong-password").status_code == 403
+
+
+def test_login_keeps_the_old_hash_while_hashing_is_overloaded(primary_only, monkeypatch):
+    import resources.auth
+    from models import User
+    from passwords import HashingPoolSaturated
+
+    _, user_id, _ = make_account("user", "rehash-busy")
+    with app.app_context():
+        db.session.get(User, user_id).password = "secret-password"
+        db.session.commit()
+
+    def saturated(password):
+        raise HashingPoolSaturated()
+
+    monkeypatch.setattr(resources.auth, "hash_offloaded", saturated)
+    assert login("rehash-busy").status_code == 200
+    assert stored_password(user_id) == "secret-password"
+
+
+@pytest.mark.parametrize("error, status, retry_after", [("HashingPoolSaturated", 429, "1"), ("HashingTimedOut", 503, "5")])
+def test_auth_turns_requests_away_while_hashing_is_overloaded(primary_only, monkeypatch, error, status, retry_after):
+    import passwords
+    import resources.auth
+
+    def overloaded(*args):
+        raise getattr(passwords, error)()
+
+    make_account("user", f"overloaded-{status}")
+    monkeypatch.setattr(resources.auth, "verify_offloaded", overloaded)
+    monkeypatch.setattr(resources.auth, "hash_offloaded", overloaded)
+
+    response = login(f"overloaded-{status}")
+    assert (response.status_code, response.headers["Retry-After"]) == (status, retry_after)
+    response = app.test_client().post("/signup", json={
+        "first_name": "New", "last_name": "User", "phone": f"new-{status}", "email": f"new-{status}@test.local",
+        "password": "secret-password", "role": "user",
+    })
+    assert (response.status_code, response.headers["Retry-After"]) == (status, retry_after)
+
+
+def test_signup_rejects_a_taken_email_before_hashing(primary_only, monkeypatch):
+    import resources.auth
+
+    hashed = []
+    monkeypatch.setattr(resources.auth, "hash_offloaded", lambda password: hashed.append(password))
+    make_account("user", "taken")
+    response = app.test_client().post("/signup", json={
+        "first_name": "Other", "last_name": "User", "phone": "other-phone", "email": "taken@test.local",
+        "password": "secret-password", "role": "user",
+    })
+    assert (response.status_code, response.get_json()["message"]) == (400, "Email already taken")
+    assert hashed == []
@@ -1,6 +1,10 @@
 from functools import wraps
 from flask_jwt_extended import verify_jwt_in_request, get_jwt
-from flask import jsonify
+from flask import jsonify, g
+from models import AgentProfile, UserProfile
+from datetime import datetime
+import base64
+import json
 
 
 # Here is a custom decorator that verifies the JWT is present in the request,
@@ -17,6 +21,7 @@ def admin_required():
                 if claims is None:
                     return {"message": "Unauthorized request"}, 403
                 if claims.get("role") == "admin":
+                    set_auth_context(claims)
                     return fn(*args, **kwargs)
                 else:
                     return {"message": "Unauthorized request - Admin access required"}, 403
@@ -38,6 +43,7 @@ def agent_required():
                 if claims is None:
                     return {"message": "Unauthorized request"}, 403
                 if claims.get("role") == "agent":
+                    set_auth_context(claims)
                     return fn(*args, **kwargs)
                 else:
                     return {"message": "Unauthorized request - Agent access required"}, 403
@@ -57,6 +63,7 @@ def user_required():
                 if claims is None:
                     return {"message": "Unauthorized request"}, 403
                 if claims.get("role") == "user":
+                    set_auth_context(claims)
                     return fn(*args, **kwargs)
                 else:
                     return {"message": "Unauthorized request - User access required"}, 403
@@ -64,3 +71,139 @@ def user_required():
                 return {"message": "Invalid or missing token", "error": str(e)}, 401
         return decorator    
     return wrapper
+
+def auth_required():
+    """Any signed-in role"""
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            try:
+                verify_jwt_in_request()
+                claims = get_jwt()
+
+                if claims is None:
+                    return {"message": "Unauthorized request"}, 403
+                set_auth_context(claims)
+                return fn(*args, **kwargs)
+            except Exception as e:
+                return {"message": "Invalid or missing token", "error": str(e)}, 401
+        return decorator
+    return wrapper
+
+def agent_or_admin_required():
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            try:
+                verify_jwt_in_request()
+                claims = get_jwt()
+
+                if claims is None:
+                    return {"message": "Unauthorized request"}, 403
+                if claims.get("role") in ("agent", "admin"):
+                    set_auth_context(claims)
+                    return fn(*args, **kwargs)
+                else:
+                    return {"message": "Unauthorized request - Agent or admin access required"}, 403
+            except Exception as e:
+                return {"message": "Invalid or missing token", "error": str(e)}, 401
+        return decorator
+    return wrapper
+
+def optional_auth():
+    """Set the auth context when a valid token is sent; anonymous requests (or stale tokens) pass through"""
+    def wrapper(fn):
+        @wraps(fn)
+        def decorator(*args, **kwargs):
+            g.user_id = g.role = g.agent_profile_id = g.user_profile_id = None
+            try:
+                verify_jwt_in_request(optional=True)
+                claims = get_jwt()
+            except Exception:
+                claims = None
+            if claims:
+                set_auth_context(claims)
+            return fn(*args, **kwargs)
+        return decorator
+    return wrapper
+
+
+# Auth context. Profile ids are embedded in the token at Login/Signup so
+# role-protected endpoints can read them from flask.g instead of querying the
+# profile tables on every request. Tokens issued before the claims existed
+# (or before the profile was created) fall back to a per-process cache.
+_profile_ids = {}
+_PROFILE_CACHE_SIZE = 10000
+
+def build_claims(user, agent_profile_id=None, user_profile_id=None):
+    """Additional JWT claims for a user; looks up whichever profile ids are not supplied"""
+    if user.role == "agent" and agent_profile_id is None:
+        agent_profile_id = lookup_profile_id("agent", user.id)
+    if user.role == "user" and user_profile_id is None:
+        user_profile_id = lookup_profile_id("user", user.id)
+    return {
+        "role": user.role,
+        "agent_profile_id": agent_profile_id,
+        "user_profile_id": user_profile_id,
+    }
+
+def lookup_profile_id(role, user_id):
+    """Profile id for a user, cached per process. Missing profiles are not cached."""
+    key = (role, int(user_id))
+    profile_id = _profile_ids.get(key)
+    if profile_id is not None:
+        return profile_id
+
+    model = AgentProfile if role == "agent" else UserProfile
+    profile = model.query.with_entities(model.id).filter_by(user_id=user_id).first()
+    if not profile:
+        return None
+
+    if len(_profile_ids) >= _PROFILE_CACHE_SIZE:
+        _profile_ids.clear()
+    _profile_ids[key] = profile.id
+    return profile.id
+
+def forget_profile_ids(user_id):
+    """Invalidate cached profile ids, e.g. after a profile is created or deleted"""
+    _profile_ids.pop(("agent", int(user_id)), None)
+    _profile_ids.pop(("user", int(user_id)), None)
+
+def set_auth_context(claims):
+    """Expose the authenticated user's id, role and profile ids on flask.g"""
+    g.user_id = claims.get("sub")
+    g.role = claims.get("role")
+    g.agent_profile_id = claims.get("agent_profile_id")
+    g.user_profile_id = claims.get("user_profile_id")
+
+    if g.role == "agent" and g.agent_profile_id is None:
+        g.agent_profile_id = lookup_profile_id("agent", g.user_id)
+    if g.role == "user" and g.user_profile_id is None:
+        g.user_profile_id = lookup_profile_id("user", g.user_id)
+
+
+# Keyset pagination cursors. The cursor is an opaque, url-safe token that
+# carries the sort key of the last row returned so the next page can seek
+# straight past it instead of using OFFSET.
+def encode_cursor(*values):
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor, *types):
+    """Decode a cursor back into values, casting each one with the matching type"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+        if len(values) != len(types):
+            return None
+        return [datetime.fromisoformat(v) if t is datetime else t(v) for v, t in zip(values, types)]
+    except (ValueError, TypeError, UnicodeError):
+        return None
+
+def parse_date(value):
+    """Parse a YYYY-MM-DD query param, returning None when missing or invalid"""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        return None